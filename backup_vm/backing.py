@@ -0,0 +1,120 @@
+import subprocess
+import hashlib
+import json
+import os
+
+ARCHIVE_PREFIX = "backing-"
+
+
+class BackingFile:
+
+    """A read-only image in the backing chain of a disk (e.g. a golden image).
+
+    Has the same attributes as the Disks it's based on, so it can be laid out
+    by an ArchiveBuilder like any other disk. Its target is a name unique to
+    the image (see identity()), so each backing file is only backed up once
+    per repository, no matter how many disks are based on it.
+
+    Attributes:
+        type: The type of storage backing the image (file or dev).
+        path: The real path of the image.
+        format: The format of the image (qcow2, raw, etc.)
+        target: The image's name followed by its identity, e.g.
+            ubuntu-18.04-3f2a9c01d4e7.
+    """
+
+    def __init__(self, type, path, format):
+        self.type = type
+        self.path = os.path.realpath(path)
+        self.format = format
+        self.backup_path = None
+        self.failed = False
+        self.target = os.path.splitext(os.path.basename(self.path))[0] + "-" + identity(self.path)
+
+    @property
+    def archive(self):
+        """The name of the archive the image is backed up to in each repository."""
+        return ARCHIVE_PREFIX + self.target
+
+    def __eq__(self, other):
+        return isinstance(other, BackingFile) and self.target == other.target
+
+    def __hash__(self):
+        return hash(self.target)
+
+    def __repr__(self):
+        return "<{} (backing file) ({} format)>".format(self.path, self.format)
+
+
+def identity(path):
+    """Identifies the contents of a backing file without reading all of it.
+
+    Backing files must never change while anything is based on them (that
+    would corrupt every image on top), so their name, size & modification
+    time are enough to tell them apart. The directory is left out so copies
+    of the same image on different hosts get the same identity.
+
+    Returns:
+        A short hex string.
+    """
+    st = os.stat(path)
+    with open(path, "rb") as f:
+        # unlike st_size, this works for block devices too
+        size = f.seek(0, os.SEEK_END)
+    key = "{}\0{}\0{}".format(os.path.basename(path), size, st.st_mtime_ns)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+def xml_chain(disk):
+    """Reads the backing chain of a disk from the domain XML.
+
+    libvirt fills in <backingStore> for running domains; shut off domains
+    usually only have an empty one (if any). Only images in local files or
+    block devices can be backed up; any others (e.g. network or storage pool
+    volumes) are left out.
+
+    Returns:
+        A list of (type, path, format) tuples, top (closest to the disk)
+        first.
+    """
+    chain = []
+    store = disk.xml.find("backingStore")
+    while store is not None and store.find("source") is not None:
+        source = store.find("source")
+        if store.find("format") is not None:
+            format = store.find("format").get("type", "unknown")
+        else:
+            format = "unknown"
+        for type in ("file", "dev"):
+            if source.get(type) is not None:
+                chain.append((type, source.get(type), format))
+                break
+        store = store.find("backingStore")
+    return chain
+
+
+def image_chain(disk):
+    """Reads the backing chain of a qcow2 disk from the image itself."""
+    if disk.format != "qcow2":
+        return []
+    try:
+        out = subprocess.run(["qemu-img", "info", "--backing-chain", "--force-share", "--output=json",
+                              "-f", "qcow2", disk.path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             check=True).stdout
+    except (subprocess.CalledProcessError, OSError):
+        return []
+    images = json.loads(out.decode("utf-8"))[1:]
+    return [("dev" if image["filename"].startswith("/dev/") else "file", image["filename"],
+             image.get("format", "unknown")) for image in images]
+
+
+def chain(disk):
+    """Finds the backing files of a disk.
+
+    Args:
+        disk: A Disk to check.
+
+    Returns:
+        A list of BackingFiles, top (closest to the disk) first.
+    """
+    return [BackingFile(*image) for image in xml_chain(disk) or image_chain(disk)]
@@ -1,33 +1,381 @@
 #!/usr/bin/env python3
 
+from functools import partial
+from copy import copy
+import subprocess
+import contextlib
 import os.path
+import json
 import sys
-import libvirt
+from .lazy import lazy_import
 from . import parse
 from . import multi
+from . import fanout
 from . import builder
-from . import snapshot
+from . import pull
+from . import freeze
+from . import offline
+from . import backing
+from . import fingerprint
+from . import throttle
+from . import metrics
+from . import incremental
+from . import client
 
+libvirt = lazy_import("libvirt")
 
-def main():
-    args = parse.BVMArgumentParser()
-    conn = libvirt.open()
-    if conn is None:
-        print("Failed to open connection to libvirt", file=sys.stderr)
-        sys.exit(1)
-    try:
-        dom = conn.lookupByName(args.domain)
-    except libvirt.libvirtError:
-        print("Domain '{}' not found".format(args.domain))
-        sys.exit(1)
 
+def split_archives(archives, members):
+    """Splits each archive into one archive per file in the backup.
+
+    Args:
+        archives: A list of Location objects for the archives to create.
+        members: A list of builder.Member objects, one for each file.
+
+    Returns:
+        A tuple containing the list of new Location objects (named after the
+        original archive with the disk's name and shard number, if any,
+        appended, e.g. myVM-sda or myVM-vdb.0003) and a dictionary mapping
+        each new archive to the Member it should contain.
+    """
+    split = []
+    contents = {}
+    for member in members:
+        suffix = "-" + member.disk.target
+        if member.shard is not None:
+            suffix += ".{:04d}".format(member.shard)
+        for archive in archives:
+            new_archive = copy(archive)
+            new_archive.archive = archive.archive + suffix
+            new_archive.orig = archive.orig + suffix
+            new_archive.extra_args = list(archive.extra_args)
+            new_archive.parent = archive
+            split.append(new_archive)
+            contents[new_archive] = member
+    return split, contents
+
+
+def backup_split(args, members, sources=None, comments=None, split=None, passphrases=None, cwd=None):
+    """Backs up each file in the backup to its own archives.
+
+    Args:
+        args: The parsed command line arguments.
+        members: The builder.Members listing the files to back up.
+        sources: A dictionary mapping members to iterables of the blocks of
+            data to store for them. If this is given (or --read-once is used)
+            the data is streamed to borg over stdin, and each block is only
+            read once for all repositories. Members missing from it are read
+            from their files.
+        comments: A dictionary mapping members to comments to add to their
+            archives.
+        split: The archives to create, as returned by split_archives().
+            Defaults to splitting the archives given on the command line.
+        passphrases: A dictionary mapping the archives given on the command
+            line to their passphrases, if they have already been asked for.
+        cwd: The ArchiveBuilder directory the members are laid out in, for
+            borg to read the files that aren't streamed to it from.
+
+    Returns:
+        A boolean indicating if any borg processes failed (True = failed).
+    """
+    # only ask for each repository's passphrase once
+    if passphrases is None:
+        passphrases = multi.get_passphrases(args.archives) if sys.stdout.isatty() else {}
+    archives, contents = split or split_archives(args.archives, members)
+    index = None
+    results = args.metrics.borg
+    if args.skip_unchanged and split is None:
+        index = fingerprint.Index.for_domain(args.domain)
+        # the names of the new archives (from borg's --json output) go in
+        # the index, to check they haven't been pruned before skipping
+        if results is None:
+            results = {}
+        repos = {fingerprint.repo_name(a): a for a in args.archives}
+        listed = {}
+
+        def list_archives(repo):
+            # only listed if something could be skipped, & only once
+            if repo not in listed:
+                listed[repo] = multi.list_archives(repos[repo], passphrases.get(repos[repo]))
+            return listed[repo]
+
+        for member in members:
+            if (sources is None or member not in sources) and index.unchanged(member, repos, list_archives):
+                print("'{}' hasn't changed since it was last backed up, skipping it".format(member.name),
+                      file=sys.stderr)
+                archives = [a for a in archives if contents[a] is not member]
+        if len(archives) == 0:
+            return False
+    passphrases = {a: passphrases[a.parent] for a in archives if a.parent in passphrases}
+    paths = {a: contents[a].name for a in archives}
+    sizes = {a: contents[a].size for a in archives} if args.progress else None
+    # holes in sparse images take (next to) no time to back up
+    weights = {a: contents[a].allocated for a in archives if contents[a].allocated is not None}
+    for archive in archives:
+        member = contents[archive]
+        if comments is not None and member in comments:
+            archive.extra_args.extend(["--comment", comments[member]])
+    if sources is None and not args.read_once:
+        return multi.assimilate(archives, sizes, paths, passphrases, max_jobs=args.jobs, weights=weights,
+                                cpu_limit=args.cpu, results=args.metrics.borg, cwd=cwd, timeout=args.borg_timeout)
+
+    stdin = {}
+    started = {}
+    readers = []
+    for member in members:
+        member_archives = [a for a in archives if contents[a] is member]
+        if len(member_archives) == 0:
+            continue
+        if sources is not None and member in sources:
+            blocks = sources[member]
+        else:
+            blocks = fanout.read_file(member.path, member.offset, member.size, drop_cache=args.drop_cache)
+            if index is not None:
+                blocks = index.fingerprint(member, blocks)
+        blocks = args.metrics.count_bytes(blocks, disk=member.name)
+        if args.throttle is not None:
+            blocks = args.throttle.pace(blocks)
+        reader = fanout.FanOut(member.path, blocks, count=len(member_archives))
+        for idx, (archive, fd) in enumerate(zip(member_archives, reader.fds)):
+            stdin[archive] = fd
+            started[archive] = partial(reader.attach, idx)
+            paths[archive] = "-"
+            archive.extra_args.extend(["--stdin-name", member.name])
+        readers.append(reader.start())
+    # every archive of a disk has to be running for its reader to make
+    # progress, so never run fewer borg processes than there are repositories
+    max_jobs = max(args.jobs, len(args.archives))
+    borg_failed = multi.assimilate(archives, sizes, paths, passphrases, max_jobs=max_jobs, stdin=stdin,
+                                   weights=weights, cpu_limit=args.cpu, results=results,
+                                   started=started, timeout=args.borg_timeout)
+    for reader in readers:
+        reader.join()
+    borg_failed = borg_failed or any(reader.failed for reader in readers)
+    if index is not None and not borg_failed:
+        names = {}
+        for archive in archives:
+            name = results.get(archive, {}).get("name")
+            if name is None and "{" not in archive.archive:
+                name = archive.archive
+            if name is not None:
+                names.setdefault(contents[archive].name, {})[fingerprint.repo_name(archive)] = name
+        try:
+            index.commit(names)
+        except OSError as e:
+            print("Failed to save the fingerprint index: {}".format(e), file=sys.stderr)
+    return borg_failed
+
+
+def backup_raw_views(args, members):
+    """Backs up the guest-visible contents of qcow2 images instead of the files.
+
+    Each qcow2 image is backed up as a raw image (e.g. sda.raw, never split
+    into shards) read through qcow2.RawView, with the options needed to turn
+    it back into a qcow2 image stored as JSON in the archive's comment. Other
+    disks are backed up as usual.
+
+    Returns:
+        A boolean indicating if any borg processes failed (True = failed).
+    """
+    from . import qcow2
+    with contextlib.ExitStack() as stack:
+        raw_members = []
+        sources = {}
+        comments = {}
+        for disk in sorted({m.disk for m in members}, key=lambda d: d.target):
+            disk_members = [m for m in members if m.disk is disk]
+            if disk.format != "qcow2":
+                raw_members.extend(disk_members)
+                continue
+            try:
+                view = stack.enter_context(qcow2.RawView(disk, disk_members[0].path))
+            except (subprocess.CalledProcessError, OSError, ValueError, SystemExit):
+                # (SystemExit if libnbd isn't installed, which pull.connect()
+                # has already said)
+                print("Can't read the contents of '{}', backing up the qcow2 image instead".format(disk.target),
+                      file=sys.stderr)
+                raw_members.extend(disk_members)
+                continue
+            member = view.member()
+            raw_members.append(member)
+            sources[member] = view.blocks()
+            comments[member] = json.dumps(view.metadata, sort_keys=True)
+        return backup_split(args, raw_members, sources, comments)
+
+
+def backup_backing_files(args, disks):
+    """Backs up the backing files of disks that repositories don't have yet.
+
+    Each backing file (e.g. the golden image a VM was cloned from) gets an
+    archive of its own in each repository, named after the file and its
+    identity (e.g. backing-ubuntu-3f2a9c01d4e7), so a base shared by many VMs
+    is only backed up once. The backups of the VMs themselves only contain
+    their own top layers, with the names of the archives of the rest of each
+    disk's chain (top first) stored as JSON in their comments.
+
+    Args:
+        args: The parsed command line arguments.
+        disks: The Disks to back up the backing files of.
+
+    Returns:
+        A boolean indicating if any borg processes failed (True = failed).
+    """
+    chains = {}
+    for disk in disks:
+        try:
+            chains[disk] = backing.chain(disk)
+        except (OSError, ValueError) as e:
+            print("Can't back up the backing files of '{}' ({}), backing up only the disk itself".format(
+                disk.target, e), file=sys.stderr)
+            chains[disk] = []
+    backing_files = {f for c in chains.values() for f in c}
+    if len(backing_files) == 0:
+        return False
+    extra_args = {a: list(a.extra_args) for a in args.archives}
+    comment = json.dumps({d.target: [f.archive for f in c] for d, c in chains.items() if c}, sort_keys=True)
+    for archive in args.archives:
+        if "--comment" not in archive.extra_args:
+            archive.extra_args.extend(["--comment", comment])
+
+    passphrases = multi.get_passphrases(args.archives) if sys.stdout.isatty() else {}
+    needed = {}
+    for archive in args.archives:
+        existing = multi.list_archives(archive, passphrases.get(archive))
+        if existing is None:
+            print("Can't list the archives in '{}', backing up all backing files".format(archive.orig),
+                  file=sys.stderr)
+            existing = set()
+        needed[archive] = {f for f in backing_files if f.archive not in existing}
+    backing_files = set.union(*needed.values())
+    if len(backing_files) == 0:
+        return False
+
+    with builder.ArchiveBuilder(sorted(backing_files, key=lambda f: f.target),
+                                mount=not args.read_once) as archive_dir:
+        archives = []
+        contents = {}
+        for member in archive_dir.members:
+            for archive in args.archives:
+                if member.disk not in needed[archive]:
+                    continue
+                new_archive = copy(archive)
+                new_archive.archive = member.disk.archive
+                new_archive.orig = archive.orig.rpartition("::")[0] + "::" + member.disk.archive
+                new_archive.extra_args = list(extra_args[archive])
+                new_archive.parent = archive
+                archives.append(new_archive)
+                contents[new_archive] = member
+        return backup_split(args, archive_dir.members, split=(archives, contents), passphrases=passphrases,
+                            cwd=archive_dir.name)
+
+
+def backup_pull(args, dom, all_disks, disks_to_backup):
+    """Backs up a running domain through a pull-mode backup job.
+
+    Starts a pull-mode backup job and streams each disk from its NBD export
+    to borg (as sda.raw etc.), so there is no overlay to commit afterwards.
+
+    With --incremental, the job also creates a new checkpoint and exports the
+    bitmap of the previous one, and only the changed extents of each disk are
+    streamed, as delta files (see the incremental module). If there is no
+    previous checkpoint, or its bitmap can't be used (e.g. it was lost), the
+    whole of each disk is backed up instead (and an unusable checkpoint is
+    deleted).
+
+    Returns:
+        A boolean indicating if any borg processes failed (True = failed).
+    """
+    if not args.incremental:
+        checkpoint = parent = None
+    else:
+        checkpoint = incremental.new_checkpoint_name()
+        parent = incremental.latest_checkpoint(dom)
+    # the guest is frozen only while the job is started, like a snapshot
+    quiesce = freeze.Freeze(dom, args.freeze_mountpoints, args.freeze_timeout, args.metrics)
+    job = pull.PullBackup(dom, all_disks, disks_to_backup, checkpoint, parent, quiesce)
+    unusable = None
+    if parent is not None:
+        try:
+            job.start()
+        except libvirt.libvirtError:
+            print("Checkpoint '{}' can't be used, making a full backup instead".format(parent), file=sys.stderr)
+            job.tempdir.cleanup()
+            unusable, parent = parent, None
+            job = pull.PullBackup(dom, all_disks, disks_to_backup, checkpoint, quiesce=quiesce)
+    elif args.incremental and args.progress:
+        print("No previous checkpoint found, making a full backup")
+
+    with job:
+        if unusable is not None:
+            # only once the full backup's new checkpoint has taken over, in
+            # case the job failed for some other reason
+            incremental.delete_checkpoint(dom, unusable, broken=True)
+        members = []
+        sources = {}
+        comments = {}
+        for disk in sorted(disks_to_backup, key=lambda d: d.target):
+            if parent is None:
+                handle = job.connect(disk)
+                size = handle.get_size()
+                member = builder.Member(disk, disk.target + ".raw", job.uri(disk), 0, size, None)
+                sources[member] = pull.read_blocks(handle, [(0, size)])
+            else:
+                context = job.bitmap_context(disk)
+                handle = job.connect(disk, [context])
+                size = handle.get_size()
+                extents = incremental.dirty_extents(handle, context, size)
+                header = incremental.delta_header(size, extents, parent, checkpoint)
+                delta_size = len(header) + sum(length for offset, length in extents)
+                member = builder.Member(disk, disk.target + ".raw.delta", job.uri(disk), 0, delta_size, None)
+                sources[member] = incremental.delta_blocks(handle, header, extents)
+            if checkpoint is not None:
+                comments[member] = incremental.archive_comment(checkpoint, parent)
+            members.append(member)
+        borg_failed = backup_split(args, members, sources, comments)
+
+    if checkpoint is None:
+        pass
+    elif borg_failed:
+        # merge the new bitmap back into the old one so the next backup
+        # still includes everything changed since the last successful one
+        incremental.delete_checkpoint(dom, checkpoint)
+    elif parent is not None:
+        # the new checkpoint has taken over tracking changes
+        incremental.delete_checkpoint(dom, parent)
+    return borg_failed
+
+
+def backup_domain(args, dom, limits=None):
+    """Backs up a domain.
+
+    Args:
+        args: The parsed command line arguments (for this domain).
+        dom: The libvirt domain to back up.
+        limits: A batch.Limits to keep the domain's storage pools &
+            repositories from being used by too many backups at once.
+
+    Returns:
+        A boolean indicating if anything failed (True = failed).
+    """
+    # these are only imported when needed, so e.g. --help doesn't have to
+    # wait for asyncio to be imported
+    from . import snapshot
+    from . import batch
+    if limits is None:
+        limits = batch.Limits()
     all_disks = set(parse.Disk.get_disks(dom))
     if len(all_disks) == 0:
         print("Domain has no disks(!)", file=sys.stderr)
         sys.exit(1)
 
     disks_to_backup = args.disks and {x for x in all_disks if x.target in args.disks} or all_disks
-    if len(disks_to_backup) != len(args.disks or all_disks):
+    if args.batch and args.disks:
+        # the domains of a batch don't all have the same disks
+        if len(disks_to_backup) == 0:
+            print("Domain '{}' has none of the disks to back up, skipping it".format(args.domain),
+                  file=sys.stderr)
+            return False
+    elif len(disks_to_backup) != len(args.disks or all_disks):
         print("Some disks to be backed up don't exist on the domain:",
               *sorted(x.target for x in all_disks if x.target not in args.disks), file=sys.stderr)
         sys.exit(1)
@@ -43,19 +391,119 @@ def main():
         else:
             disk.snapshot_path = os.path.join(os.path.dirname(disk.path), filename)
 
-    for archive in args.archives:
-        archive.extra_args.append("--read-special")
+    if args.raw_view or args.skip_unchanged or args.drop_cache or args.adaptive \
+            or args.read_bandwidth is not None:
+        args.read_once = True
+    if args.incremental:
+        args.backend = "pull"
+    if args.backend == "pull" and not dom.isActive():
+        # pull-mode backups need qemu to be running to serve the disks
+        print("Domain is not running, can't make a pull-mode backup", file=sys.stderr)
+        args.backend = "snapshot"
+        args.incremental = False
 
-    with snapshot.Snapshot(dom, all_disks, args.progress), \
-            builder.ArchiveBuilder(disks_to_backup) as archive_dir:
-        if args.progress:
-            borg_failed = multi.assimilate(args.archives, archive_dir.total_size)
-        else:
-            borg_failed = multi.assimilate(args.archives)
+    if args.read_once or args.backend == "pull":
+        if multi.get_borg_version() < (1, 2, 0):
+            print("--read-once and pull-mode backups need borg 1.2 or newer", file=sys.stderr)
+            sys.exit(1)
+    else:
+        for archive in args.archives:
+            archive.extra_args.append("--read-special")
+
+    # reading is paced (& the pace adapted) in backup-vm's own read path, so
+    # these are shared by every backup_*() function through args
+    args.metrics = metrics.Metrics(args.domain, args.metrics_path)
+    args.throttle = None
+    if args.read_bandwidth is not None or args.adaptive:
+        args.throttle = throttle.Throttle(args.read_bandwidth)
+    args.cpu = None if args.cpu_limit is None else throttle.CPULimit(args.cpu_limit)
+    failed = True
+    try:
+        with contextlib.ExitStack() as stack:
+            # the storage is used from the snapshot until the commit afterwards
+            stack.enter_context(limits.hold(pools=limits.storage_pools(dom, disks_to_backup)))
+            if args.cpu is not None:
+                stack.enter_context(args.cpu)
+            if args.adaptive and dom.isActive():
+                stack.enter_context(throttle.LatencyMonitor(dom, disks_to_backup, args.throttle))
+            if args.backend == "pull":
+                with limits.hold(repos=args.archives):
+                    borg_failed = backup_pull(args, dom, all_disks, disks_to_backup)
+            else:
+                borg_failed = False
+                if args.backing_chain and not args.raw_view:
+                    # backing files never change, so they can be backed up before
+                    # (& without) a snapshot
+                    with limits.hold(repos=args.archives):
+                        borg_failed = backup_backing_files(args, disks_to_backup)
+                # the repositories are held from before the snapshot, so it isn't
+                # left to grow while waiting for them
+                repos = stack.enter_context(limits.hold(repos=args.archives))
+                guard = None
+                if not dom.isActive():
+                    # back up the images directly if we can keep the domain shut off
+                    # in the meantime, so there is nothing to commit afterwards
+                    guard = offline.OfflineLock(dom, disks_to_backup)
+                    if not guard.acquire():
+                        guard = None
+                if guard is None:
+                    guard = snapshot.Snapshot(dom, all_disks, args.progress, args.commit_jobs, args.commit_bandwidth,
+                                              args.storage_snapshots, args.freeze_mountpoints, args.freeze_timeout,
+                                              args.metrics)
+                archive_builder = builder.ArchiveBuilder(disks_to_backup, shard_size=args.shard_size,
+                                                         mount=not args.read_once)
+                with guard, args.metrics.entering(archive_builder, "archive_setup") as archive_dir:
+                    if args.raw_view:
+                        borg_failed |= backup_raw_views(args, archive_dir.members)
+                    elif args.per_disk or args.read_once or args.shard_size is not None:
+                        borg_failed |= backup_split(args, archive_dir.members, cwd=archive_dir.name)
+                    elif args.progress:
+                        borg_failed |= multi.assimilate(args.archives, archive_dir.total_size, cpu_limit=args.cpu,
+                                                        weights=archive_dir.allocated_size, results=args.metrics.borg,
+                                                        cwd=archive_dir.name, timeout=args.borg_timeout)
+                    else:
+                        borg_failed |= multi.assimilate(args.archives, cpu_limit=args.cpu, results=args.metrics.borg,
+                                                        cwd=archive_dir.name, timeout=args.borg_timeout)
+                    # let the next domain use the repositories while this one's
+                    # snapshot is committed
+                    repos.release()
+        failed = borg_failed or any(disk.failed for disk in disks_to_backup)
+    finally:
+        try:
+            args.metrics.write(not failed)
+        except OSError as e:
+            print("Failed to write metrics: {}".format(e), file=sys.stderr)
+    return failed
+
+
+def main():
+    args = parse.BVMArgumentParser()
+    if args.submit:
+        sys.exit(client.submit(args, sys.argv[1:]))
+    from . import snapshot
+    from . import batch
+    if sys.stdout.isatty():
+        # find out which repositories need passphrases while the domain is
+        # looked up & snapshotted
+        multi.start_passphrase_probes(args.archives)
+    snapshot.start_event_loop()
+    conn = libvirt.open()
+    if conn is None:
+        print("Failed to open connection to libvirt", file=sys.stderr)
+        sys.exit(1)
+    if args.batch:
+        sys.exit(batch.run(args, conn, backup_domain))
+    try:
+        dom = conn.lookupByName(args.domain)
+    except libvirt.libvirtError:
+        print("Domain '{}' not found".format(args.domain))
+        sys.exit(1)
+
+    failed = backup_domain(args, dom)
 
     # bug in libvirt python wrapper(?): sometimes it tries to delete
     # the connection object before the domain, which references it
     del dom
     del conn
 
-    sys.exit(borg_failed or any(disk.failed for disk in disks_to_backup))
+    sys.exit(failed)
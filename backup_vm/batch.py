@@ -0,0 +1,217 @@
+"""Backs up many domains at once over one libvirt connection.
+
+Each domain is backed up in a thread of its own, so one domain's snapshot can
+be committed while another's disks are read and a third is being snapshotted.
+Limits keeps any one storage pool or borg repository from being used by too
+many of them at once.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from copy import copy
+import threading
+import traceback
+import sys
+import os
+from .lazy import lazy_import
+from . import fingerprint
+from . import multi
+
+libvirt = lazy_import("libvirt")
+
+PLACEHOLDER = "{domain}"
+
+
+class Hold:
+
+    """Holds a set of semaphores, acquired in a fixed order to avoid deadlocks.
+
+    Can be released early with release() (e.g. to let another domain use a
+    repository while this one's snapshot is being committed).
+    """
+
+    def __init__(self, semaphores):
+        self.semaphores = semaphores
+        self.held = []
+
+    def __enter__(self):
+        for semaphore in self.semaphores:
+            semaphore.acquire()
+            self.held.append(semaphore)
+        return self
+
+    def release(self):
+        while self.held:
+            self.held.pop().release()
+
+    def __exit__(self, *args):
+        self.release()
+        return False
+
+
+class Limits:
+
+    """Limits how many domains use each storage pool & repository at once.
+
+    Storage pools are held by a domain from its snapshot to its commit, and
+    repositories only until its archives have been created. A domain always
+    takes all of its pools before any of its repositories, so no two domains
+    can wait for each other. Each domain is also held for its whole backup, so
+    it's never backed up twice at once (e.g. by overlapping daemon jobs).
+
+    Attributes:
+        pool_jobs: The most domains to back up from one storage pool at once,
+            or None for no limit.
+        repo_jobs: The most domains to back up to one repository at once, or
+            None for no limit.
+    """
+
+    def __init__(self, pool_jobs=None, repo_jobs=None):
+        self.pool_jobs = pool_jobs
+        self.repo_jobs = repo_jobs
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def semaphore(self, key, value):
+        with self.lock:
+            if key not in self.semaphores:
+                self.semaphores[key] = threading.BoundedSemaphore(value)
+            return self.semaphores[key]
+
+    def hold(self, domains=(), pools=(), repos=()):
+        """Returns a Hold on the given domains, storage pools & repositories.
+
+        Args:
+            domains: The names of domains, which are only ever backed up by
+                one job at a time.
+            pools: The names of storage pools (see storage_pools()).
+            repos: Archive Locations, whose repositories are held.
+        """
+        # every key is sorted by its kind first, so domains are always held
+        # before pools, & pools before repositories
+        keys = {("domain", domain, 1) for domain in domains}
+        if self.pool_jobs is not None:
+            keys.update(("pool", pool, self.pool_jobs) for pool in pools)
+        if self.repo_jobs is not None:
+            keys.update(("repo", fingerprint.repo_name(a), self.repo_jobs) for a in repos)
+        return Hold([self.semaphore(key[:2], key[2]) for key in sorted(keys)])
+
+    def storage_pools(self, dom, disks):
+        """Finds the storage pools the disks of a domain are stored in.
+
+        Disks that aren't in a libvirt storage pool are grouped by the device
+        they are stored on instead.
+
+        Returns:
+            A set of names identifying the pools (empty if pools aren't
+            limited anyway).
+        """
+        pools = set()
+        if self.pool_jobs is None:
+            return pools
+        conn = dom.connect()
+        for disk in disks:
+            try:
+                pools.add(conn.storageVolLookupByPath(disk.path).storagePoolLookupByVolume().name())
+                continue
+            except libvirt.libvirtError:
+                pass
+            try:
+                st = os.stat(disk.path)
+            except OSError:
+                pools.add(disk.path)
+                continue
+            dev = st.st_rdev if disk.type == "dev" else st.st_dev
+            pools.add("dev-{}:{}".format(os.major(dev), os.minor(dev)))
+        return pools
+
+
+def find_domains(conn, patterns, filter=None):
+    """Lists the domains matching any of a list of patterns.
+
+    Args:
+        conn: A libvirt connection.
+        patterns: A list of shell-style wildcards (e.g. web-*) to match the
+            names of domains against.
+        filter: The name of a libvirt domain list filter (e.g. active or
+            autostart), or None to list every domain.
+
+    Returns:
+        A list of libvirt domains, sorted by name.
+    """
+    flags = 0 if filter is None else getattr(libvirt, "VIR_CONNECT_LIST_DOMAINS_" + filter.upper())
+    doms = conn.listAllDomains(flags)
+    return sorted((d for d in doms if any(fnmatchcase(d.name(), p) for p in patterns)),
+                  key=lambda d: d.name())
+
+
+def domain_args(args, name):
+    """Makes a copy of the arguments for backing up one domain of a batch."""
+    dom_args = copy(args)
+    dom_args.domain = name
+    dom_args.disks = set(args.disks)
+    # progress bars of several domains at once would overwrite each other
+    dom_args.progress = False
+    dom_args.archives = []
+    for archive in args.archives:
+        archive = copy(archive)
+        archive.orig = archive.orig.replace(PLACEHOLDER, name)
+        archive.archive = archive.archive.replace(PLACEHOLDER, name)
+        archive.extra_args = list(archive.extra_args)
+        dom_args.archives.append(archive)
+    return dom_args
+
+
+def run(args, conn, backup_domain, limits=None):
+    """Backs up every domain matching args.domain.
+
+    Args:
+        args: The parsed command line arguments.
+        conn: A libvirt connection.
+        backup_domain: The function backing up a single domain.
+        limits: The Limits to share with other backups, if any (by default,
+            they are made from args).
+
+    Returns:
+        A boolean indicating if the backup of any domain failed (True =
+        failed).
+    """
+    if sys.version_info < (3, 8):
+        # asyncio can only watch for processes exiting outside the main thread
+        # since 3.8
+        print("--batch needs Python 3.8 or newer", file=sys.stderr)
+        return True
+    if any(PLACEHOLDER not in archive.archive for archive in args.archives):
+        print("Archive names must contain {} with --batch".format(PLACEHOLDER), file=sys.stderr)
+        return True
+    doms = find_domains(conn, args.domain.split(","), args.batch_filter)
+    if len(doms) == 0:
+        print("No domains match '{}'".format(args.domain), file=sys.stderr)
+        return True
+    if sys.stdout.isatty():
+        # ask for every passphrase before the backups start printing over the
+        # prompts
+        multi.get_passphrases(args.archives)
+    if limits is None:
+        limits = Limits(args.pool_jobs, args.repo_jobs)
+
+    def back_up(dom):
+        name = dom.name()
+        print("Backing up domain '{}'".format(name), file=sys.stderr)
+        try:
+            with limits.hold(domains=[name]):
+                failed = backup_domain(domain_args(args, name), dom, limits)
+        except SystemExit as e:
+            failed = e.code not in {None, 0, False}
+        except Exception:
+            traceback.print_exc()
+            failed = True
+        print("Backup of domain '{}' {}".format(name, "failed" if failed else "done"), file=sys.stderr)
+        return failed
+
+    with ThreadPoolExecutor(max_workers=args.batch_jobs) as executor:
+        results = list(executor.map(back_up, doms))
+    failed = [dom.name() for dom, failed in zip(doms, results) if failed]
+    if failed:
+        print("Failed to back up:", *failed, file=sys.stderr)
+    return len(failed) > 0
@@ -1,6 +1,25 @@
+from collections import namedtuple
 import subprocess
 import tempfile
 import os.path
+from . import extents
+
+
+Member = namedtuple("Member", ["disk", "name", "path", "offset", "size", "shard", "allocated"])
+Member.__new__.__defaults__ = (None,)
+Member.__doc__ = """A single file laid out in an ArchiveBuilder directory.
+
+Attributes:
+    disk: The Disk the file was created for.
+    name: The name of the file in the archive directory (e.g. sda.raw).
+    path: The real path of the disk image or block device backing the file.
+    offset: The offset into the disk the file starts at.
+    size: The size of the file in bytes, or None if it couldn't be read.
+    shard: The index of the slice of the disk the file contains, or None if
+        the file contains the whole disk.
+    allocated: The number of bytes of the file that are actually allocated
+        (i.e. aren't holes in a sparse image), or None if unknown.
+"""
 
 
 class ArchiveBuilder(tempfile.TemporaryDirectory):
@@ -8,44 +27,102 @@ class ArchiveBuilder(tempfile.TemporaryDirectory):
     """Creates the folder to be turned into a VM backup.
 
     Creates a temporary folder populated with symlinks to each disk to backup.
-    Essentially lays out the contents of the archive to be created.
+    Essentially lays out the contents of the archive to be created. The
+    working directory is left alone (several domains can be backed up at once
+    in one process), so borg should be run with cwd set to name.
+
+    Disks larger than shard_size (if given) are split into slices of exactly
+    shard_size bytes (except for the last one), named sda.raw.0000,
+    sda.raw.0001, etc. Because each slice starts at a multiple of shard_size,
+    the boundaries stay the same between backups (as long as the shard size
+    does), so borg can still deduplicate them. Concatenating the slices in
+    order gives back the original image.
+
+    If mount is False, the members are only listed and no files are created,
+    for when the disks are read by backup-vm itself instead of by borg.
 
     Attributes:
         name: The path of the temporary directory.
         total_size: The total size of every disk linked to in the directory.
+        allocated_size: The total number of allocated bytes of every disk
+            (which excludes holes in sparse images), or None if unknown.
+        members: A list of Members, one for each file in the directory.
     """
 
-    def __init__(self, disks, *args, **kwargs):
+    def __init__(self, disks, *args, shard_size=None, mount=True, **kwargs):
         super().__init__(*args, **kwargs)
         self.total_size = 0
+        self.allocated_size = 0
         self.disks = disks
-        self.old_cwd = os.getcwd()
-        os.chdir(self.name)
+        self.shard_size = shard_size
+        self.mount = mount
+        self.members = []
+        self.loop_devices = []
 
     def __enter__(self):
         for disk in self.disks:
-            realpath = os.path.realpath(disk.path)
-            if self.total_size is not None:
-                try:
-                    with open(realpath) as f:
-                        # add size of disk to total
-                        f.seek(0, os.SEEK_END)
-                        self.total_size += f.tell()
-                except (PermissionError, OSError):
-                    self.total_size = None
+            realpath = os.path.realpath(disk.backup_path or disk.path)
+            estimate = None
+            try:
+                with open(realpath) as f:
+                    f.seek(0, os.SEEK_END)
+                    size = f.tell()
+            except (PermissionError, OSError):
+                # the size (& allocation) can often still be estimated from
+                # the file's metadata, to show progress with
+                size, estimate = extents.stat_size(realpath)
+            if size is None:
+                self.total_size = None
+            elif self.total_size is not None:
+                # add size of disk to total
+                self.total_size += size
             linkpath = disk.target + "." + disk.format
-            with open(linkpath, "w") as f:
-                # simulate 'touch'
-                pass
-            # following symlinks for --read-special is still broken :(
-            # when issue gets fixed should switch to symlinks:
-            # https://github.com/borgbackup/borg/issues/1215
-            subprocess.run(["mount", "--bind", realpath, linkpath], check=True)
+            if self.shard_size is None or size is None or size <= self.shard_size:
+                allocated = extents.allocated_size(realpath, 0, size)
+                if allocated is None:
+                    allocated = estimate
+                self.add_member(Member(disk, linkpath, realpath, 0, size, None, allocated))
+                continue
+            for shard, offset in enumerate(range(0, size, self.shard_size)):
+                shard_size = min(self.shard_size, size - offset)
+                allocated = extents.allocated_size(realpath, offset, shard_size)
+                if allocated is None and estimate is not None:
+                    allocated = estimate * shard_size // size
+                member = Member(disk, "{}.{:04d}".format(linkpath, shard), realpath, offset, shard_size, shard,
+                                allocated)
+                self.add_member(member)
+        for member in self.members:
+            if member.allocated is None or self.allocated_size is None:
+                self.allocated_size = None
+            else:
+                self.allocated_size += member.allocated
         return self
 
+    def add_member(self, member):
+        if not self.mount:
+            self.members.append(member)
+            return
+        source = member.path
+        if member.shard is not None:
+            # expose the slice of the disk as its own (read-only) block device
+            source = subprocess.run(["losetup", "--find", "--show", "--read-only",
+                                     "--offset", str(member.offset), "--sizelimit", str(member.size),
+                                     member.path], stdout=subprocess.PIPE, check=True).stdout
+            source = source.decode("utf-8").strip()
+            self.loop_devices.append(source)
+        target = os.path.join(self.name, member.name)
+        with open(target, "w") as f:
+            # simulate 'touch'
+            pass
+        # following symlinks for --read-special is still broken :(
+        # when issue gets fixed should switch to symlinks:
+        # https://github.com/borgbackup/borg/issues/1215
+        subprocess.run(["mount", "--bind", source, target], check=True)
+        self.members.append(member)
+
     def cleanup(self):
-        for disk in self.disks:
-            linkpath = disk.target + "." + disk.format
-            subprocess.run(["umount", linkpath], check=True)
-        os.chdir(self.old_cwd)
+        for member in self.members if self.mount else []:
+            subprocess.run(["umount", os.path.join(self.name, member.name)], check=True)
+        for loop_device in self.loop_devices:
+            subprocess.run(["losetup", "--detach", loop_device], check=True)
         return super().cleanup()
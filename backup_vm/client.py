@@ -0,0 +1,51 @@
+"""Submits backups to a running backup-vm-daemon (see the daemon module).
+
+Kept apart from the daemon itself, which needs asyncio & everything else a
+backup does, so backup-vm --submit starts (& exits) quickly.
+"""
+
+import socket
+import json
+import sys
+import os
+
+FINISHED = {"done", "failed"}
+
+
+def submit(args, argv):
+    """Submits a backup to a running backup-vm-daemon.
+
+    Args:
+        args: The parsed command line arguments.
+        argv: The command line arguments to send to the daemon (which ignores
+            the ones about submitting).
+
+    Returns:
+        A boolean indicating if the submission or the backup failed (True =
+        failed).
+    """
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(args.socket)
+    except OSError as e:
+        print("Can't connect to backup-vm-daemon at {}: {}".format(args.socket, e.strerror), file=sys.stderr)
+        sock.close()
+        return True
+    # relative paths (e.g. of repositories) are relative to this directory,
+    # not the daemon's
+    request = {"command": "submit", "args": argv, "cwd": os.getcwd(), "priority": args.priority,
+               "watch": args.wait}
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps(request).encode("utf-8") + b"\n")
+        f.flush()
+        for line in f:
+            msg = json.loads(line.decode("utf-8"))
+            if msg["type"] == "error":
+                print("backup-vm-daemon: " + msg["message"], file=sys.stderr)
+                return True
+            note = " (merged into an identical job)" if msg.get("duplicate") else ""
+            print("Job {} {}{}".format(msg["id"], msg["state"], note), file=sys.stderr)
+            if not args.wait or msg["state"] in FINISHED:
+                return msg["state"] == "failed"
+    print("Lost connection to backup-vm-daemon", file=sys.stderr)
+    return True
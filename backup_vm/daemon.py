@@ -0,0 +1,291 @@
+"""A resident backup-vm that runs backups submitted over a Unix socket.
+
+Everything a backup-vm process sets up before it gets to the backup itself
+(the libvirt connection & event loop, the borg version check) is done once
+and kept for every job. Jobs are submitted with backup-vm --submit, which
+sends its arguments as they are, along with its working directory (which
+relative paths in them are resolved against).
+
+The protocol is JSON, one object per line. A client sends requests:
+
+    {"command": "submit", "args": ["myVM", "myrepo::myVM-{now}"], "cwd": "/root", "priority": 0, "watch": true}
+    {"command": "status"}
+    {"command": "watch"}
+
+and gets back a {"type": "job", ...} object (see Job.status()) whenever a job
+it submitted (or, after "watch", any job) changes state, a {"type": "jobs",
+"jobs": [...]} object with every known job for "status", or {"type":
+"error", "message": ...} if a request is invalid. A job submitted again while
+an identical one (same domain, disks & archives) is still queued or running
+is merged into it. Jobs are submitted by client.submit().
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import subprocess
+import traceback
+import itertools
+import threading
+import asyncio
+import json
+import sys
+import os
+import socket
+from .lazy import lazy_import
+from . import parse
+from . import multi
+from . import engine
+from . import batch
+from . import backup
+from . import snapshot
+from .client import FINISHED
+
+libvirt = lazy_import("libvirt")
+
+
+class Job:
+
+    """A backup submitted to the daemon.
+
+    Attributes:
+        id: A number identifying the job.
+        key: Identifies the job by what it backs up (& where to).
+        args: The parsed arguments of the job (as for backup-vm).
+        priority: Jobs with a higher priority are started first.
+        state: queued, running, done or failed.
+        watchers: The asyncio.StreamWriters of the clients to send the job's
+            state to.
+    """
+
+    ids = itertools.count(1)
+
+    def __init__(self, args, priority=0):
+        self.id = next(self.ids)
+        self.args = args
+        self.priority = priority
+        self.state = "queued"
+        self.watchers = set()
+        # the backup adds to args (e.g. borg arguments), so this is saved now
+        self.key = (args.domain, args.batch, frozenset(args.disks),
+                    tuple((str(a), tuple(a.extra_args)) for a in args.archives))
+
+    def status(self, **extra):
+        status = {
+            "type": "job",
+            "id": self.id,
+            "state": self.state,
+            "domain": self.args.domain,
+            "priority": self.priority,
+        }
+        status.update(extra)
+        return status
+
+
+def send(writer, msg):
+    if not writer.is_closing():
+        writer.write(json.dumps(msg).encode("utf-8") + b"\n")
+
+
+class Daemon:
+
+    """Queues & runs jobs, and tells clients about them.
+
+    Everything but the backups themselves (which run in threads) happens on
+    the event loop, so none of the job bookkeeping needs locks.
+
+    Attributes:
+        args: The parsed arguments of the daemon.
+        limits: The batch.Limits shared by every job.
+        active: A dictionary mapping the keys of queued & running jobs to the
+            jobs.
+        finished: The most recently finished jobs.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.limits = batch.Limits(args.pool_jobs, args.repo_jobs)
+        self.queue = None
+        self.active = {}
+        self.finished = deque(maxlen=args.history)
+        self.watchers = set()
+        self.executor = ThreadPoolExecutor(max_workers=args.jobs)
+        self.conn = None
+        self.conn_lock = threading.Lock()
+
+    def connection(self):
+        """Returns the libvirt connection, reconnecting if it was lost."""
+        with self.conn_lock:
+            if self.conn is None or not self.conn.isAlive():
+                self.conn = libvirt.open()
+                if self.conn is None:
+                    raise libvirt.libvirtError("Failed to open connection to libvirt")
+            return self.conn
+
+    def run_job(self, job):
+        """Runs a job (in a thread of the executor).
+
+        Returns:
+            A boolean indicating if the job failed (True = failed).
+        """
+        args = job.args
+        try:
+            conn = self.connection()
+            if args.batch:
+                return batch.run(args, conn, backup.backup_domain, self.limits)
+            dom = conn.lookupByName(args.domain)
+            with self.limits.hold(domains=[args.domain]):
+                return backup.backup_domain(args, dom, self.limits)
+        except SystemExit as e:
+            return e.code not in {None, 0, False}
+        except libvirt.libvirtError as e:
+            print("Job {}: {}".format(job.id, e), file=sys.stderr)
+            return True
+        except Exception:
+            traceback.print_exc()
+            return True
+
+    def update(self, job, state):
+        job.state = state
+        for writer in job.watchers | self.watchers:
+            send(writer, job.status())
+        if state in FINISHED:
+            job.watchers.clear()
+
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            _, _, job = await self.queue.get()
+            self.update(job, "running")
+            print("Job {} ({}) started".format(job.id, job.args.domain), file=sys.stderr)
+            failed = await loop.run_in_executor(self.executor, self.run_job, job)
+            del self.active[job.key]
+            self.finished.append(job)
+            print("Job {} ({}) {}".format(job.id, job.args.domain, "failed" if failed else "done"),
+                  file=sys.stderr)
+            self.update(job, "failed" if failed else "done")
+
+    def submit(self, request, writer):
+        argv = request.get("args")
+        if not isinstance(argv, list) or not all(isinstance(arg, str) for arg in argv):
+            send(writer, {"type": "error", "message": "args must be a list of strings"})
+            return
+        cwd = request.get("cwd")
+        if cwd is not None and not (isinstance(cwd, str) and os.path.isabs(cwd)):
+            send(writer, {"type": "error", "message": "cwd must be an absolute path"})
+            return
+        try:
+            args = parse.BVMArgumentParser(args=["backup-vm"] + argv, cwd=cwd)
+        except SystemExit:
+            send(writer, {"type": "error", "message": "invalid arguments: {}".format(" ".join(argv))})
+            return
+        # nobody is watching the daemon's terminal (if it even has one)
+        args.progress = False
+        priority = request.get("priority", args.priority)
+        if not isinstance(priority, int):
+            send(writer, {"type": "error", "message": "priority must be an integer"})
+            return
+        job = Job(args, priority)
+        duplicate = job.key in self.active
+        if duplicate:
+            job = self.active[job.key]
+        else:
+            self.active[job.key] = job
+            self.queue.put_nowait((-job.priority, job.id, job))
+        if request.get("watch", True):
+            job.watchers.add(writer)
+        send(writer, job.status(duplicate=duplicate))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    command = request["command"]
+                except (ValueError, KeyError, TypeError):
+                    send(writer, {"type": "error", "message": "malformed request"})
+                    continue
+                if command == "submit":
+                    self.submit(request, writer)
+                elif command == "status":
+                    jobs = list(self.finished) + sorted(self.active.values(), key=lambda j: j.id)
+                    send(writer, {"type": "jobs", "jobs": [job.status() for job in jobs]})
+                elif command == "watch":
+                    self.watchers.add(writer)
+                else:
+                    send(writer, {"type": "error", "message": "unknown command '{}'".format(command)})
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.watchers.discard(writer)
+            for job in self.active.values():
+                job.watchers.discard(writer)
+            writer.close()
+
+    async def serve(self):
+        self.queue = asyncio.PriorityQueue()
+        # anyone who can submit jobs can read any disk of any domain, so the
+        # socket is only accessible to its owner from the moment it exists
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path=self.args.socket)
+        finally:
+            os.umask(umask)
+        workers = [asyncio.ensure_future(self.worker()) for _ in range(self.args.jobs)]
+        print("Listening on {}".format(self.args.socket), file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            os.unlink(self.args.socket)
+
+
+def remove_stale_socket(path):
+    """Removes the socket of a daemon that is no longer running.
+
+    Returns:
+        False if another daemon is still listening on the socket.
+    """
+    with socket.socket(socket.AF_UNIX) as sock:
+        try:
+            sock.connect(path)
+        except FileNotFoundError:
+            return True
+        except ConnectionRefusedError:
+            os.unlink(path)
+            return True
+    return False
+
+
+def main():
+    args = parse.DaemonArgumentParser()
+    if sys.version_info < (3, 8):
+        # asyncio can only watch for processes exiting outside the main thread
+        # since 3.8
+        print("backup-vm-daemon needs Python 3.8 or newer", file=sys.stderr)
+        sys.exit(1)
+    if not remove_stale_socket(args.socket):
+        print("backup-vm-daemon is already running on {}".format(args.socket), file=sys.stderr)
+        sys.exit(1)
+    snapshot.start_event_loop()
+    try:
+        # check for (& cache) borg now rather than in the first job
+        multi.get_borg_version()
+    except (OSError, subprocess.CalledProcessError):
+        print("Can't run borg (is it installed?)", file=sys.stderr)
+        sys.exit(1)
+    daemon = Daemon(args)
+    try:
+        daemon.connection()
+    except libvirt.libvirtError:
+        print("Failed to open connection to libvirt", file=sys.stderr)
+        sys.exit(1)
+    try:
+        engine.run(daemon.serve())
+    except KeyboardInterrupt:
+        pass
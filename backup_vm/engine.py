@@ -0,0 +1,244 @@
+"""A small asyncio core shared by borg process management & block commits.
+
+Everything that used to be polled (borg processes exiting, block jobs
+becoming ready, progress being redrawn) is an event on one event loop here,
+so each step starts as soon as whatever it waits for has happened.
+"""
+
+import asyncio
+import codecs
+import json
+import re
+import os
+
+WHITESPACE = re.compile(r"[ \t\r\n]")
+
+
+def run(coro):
+    """Runs a coroutine to completion on a new event loop.
+
+    If it's interrupted (e.g. by ^C), the coroutine is cancelled and given the
+    chance to clean up (e.g. kill its processes) before the exception is
+    raised again.
+
+    Returns:
+        The result of the coroutine.
+    """
+    loop = asyncio.new_event_loop()
+    # setting the loop in the main thread also attaches the child watcher
+    # asyncio.create_subprocess_exec needs to notice processes exit
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(coro)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except BaseException:
+            pass
+        raise
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def gather_limited(coros, limit=None, timeout=None):
+    """Runs coroutines concurrently, but at most limit of them at once.
+
+    The rest are started (in order) as earlier ones finish. If any of them
+    raises an exception, the others are cancelled.
+
+    Args:
+        coros: An iterable of the coroutines to run.
+        limit: The most coroutines to run at once, or None for no limit.
+        timeout: The most seconds each coroutine may run for once started
+            (not counting the time it waits for its turn), or None for no
+            limit. A coroutine that takes longer is cancelled (so it can
+            clean up, e.g. kill its process), and its result is the
+            asyncio.TimeoutError instead.
+
+    Returns:
+        A list of the results of the coroutines, in order.
+    """
+    semaphore = asyncio.Semaphore(limit) if limit is not None else None
+
+    async def timed(coro):
+        if timeout is None:
+            return await coro
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except asyncio.TimeoutError as e:
+            return e
+
+    async def limited(coro):
+        if semaphore is None:
+            return await timed(coro)
+        async with semaphore:
+            return await timed(coro)
+
+    tasks = [asyncio.ensure_future(limited(c)) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def every(interval, func):
+    """Calls func every interval seconds until cancelled (and once more then)."""
+    try:
+        while True:
+            func()
+            await asyncio.sleep(interval)
+    finally:
+        func()
+
+
+class MessageReader:
+
+    """Reads a stream of JSON messages mixed with plain text as it comes in.
+
+    Whenever the event loop notices the file descriptor is readable, as much
+    as possible is read at once into a buffer, and every complete JSON object
+    in it is parsed in place with JSONDecoder.raw_decode (so nothing is split
+    into lines or joined back together first); an object cut off by the end of
+    what has been read so far (even one spread over many lines, like borg's
+    --json output) is kept until the rest of it comes in. Anything else is
+    passed on a line at a time; a trailing partial line is only passed on once
+    nothing is left to read, as it's most likely a prompt waiting for an
+    answer.
+
+    Of several messages of a type in coalesce read at once, only the last one
+    is passed on (e.g. progress updates, which each replace the last).
+
+    Attributes:
+        closed: An asyncio.Event set once the other end is closed.
+    """
+
+    decoder = json.JSONDecoder()
+
+    def __init__(self, fd, on_message, on_text, coalesce=(), read_size=1024 * 1024):
+        self.fd = fd
+        self.on_message = on_message
+        self.on_text = on_text
+        self.coalesce = set(coalesce)
+        self.read_size = read_size
+        self.buf = ""
+        self.utf8 = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.closed = asyncio.Event()
+        self.loop = asyncio.get_event_loop()
+        self.loop.add_reader(fd, self.read)
+
+    def read(self):
+        """Reads & processes everything available right now."""
+        eof = False
+        while True:
+            try:
+                data = os.read(self.fd, self.read_size)
+            except BlockingIOError:
+                break
+            except OSError:
+                # a pty raises EIO once every process using it has exited
+                data = b""
+            if not data:
+                eof = True
+                break
+            self.buf += self.utf8.decode(data)
+            if len(data) < self.read_size:
+                break
+        self.parse(final=True)
+        if eof:
+            self.stop()
+
+    def parse(self, final=False):
+        messages = []
+        pos = 0
+        buf = self.buf
+        while pos < len(buf):
+            if buf[pos] in " \t\r\n":
+                pos += 1
+                continue
+            newline = buf.find("\n", pos)
+            if buf[pos] == "{":
+                try:
+                    msg, end = self.decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    if incomplete(buf, e):
+                        # the rest of the object hasn't been read yet
+                        break
+                else:
+                    messages.append(msg)
+                    pos = end
+                    continue
+            if newline == -1:
+                if final and buf[pos] != "{":
+                    messages.append(buf[pos:])
+                    pos = len(buf)
+                break
+            messages.append(buf[pos:newline].rstrip("\r"))
+            pos = newline + 1
+        self.buf = buf[pos:]
+
+        last = {}
+        for i, msg in enumerate(messages):
+            if isinstance(msg, dict) and msg.get("type") in self.coalesce:
+                last[msg["type"]] = i
+        for i, msg in enumerate(messages):
+            if not isinstance(msg, dict):
+                self.on_text(msg)
+            elif msg.get("type") not in last or last[msg["type"]] == i:
+                self.on_message(msg)
+
+    def stop(self):
+        if not self.closed.is_set():
+            self.loop.remove_reader(self.fd)
+            if self.buf.strip():
+                self.on_text(self.buf.strip())
+            self.buf = ""
+            self.closed.set()
+
+
+def incomplete(buf, error):
+    """Whether raw_decode() failed only because buf ends partway through a value.
+
+    An object cut off partway through a string (which can't contain a newline,
+    so it runs to the end of buf), a literal, a number or an escape only has
+    an error in its last token; anything with an error followed by more
+    whitespace (e.g. the end of a line) isn't JSON at all.
+
+    Args:
+        buf: The string being decoded.
+        error: The json.JSONDecodeError raw_decode() raised.
+    """
+    if error.msg.startswith("Unterminated string"):
+        return True
+    return WHITESPACE.search(buf, error.pos) is None
+
+
+class ThreadsafeQueue(asyncio.Queue):
+
+    """An asyncio.Queue that other threads (e.g. libvirt's event loop) can put to."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner = asyncio.get_event_loop()
+
+    def put_threadsafe(self, item):
+        self.owner.call_soon_threadsafe(self.put_nowait, item)
+
+
+async def read_chunks(stream, callback, size=65536):
+    """Calls callback with every chunk read from an asyncio stream until EOF."""
+    while True:
+        data = await stream.read(size)
+        if not data:
+            return
+        callback(data)
+
+
+def close_quietly(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
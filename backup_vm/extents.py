@@ -0,0 +1,85 @@
+import errno
+import stat
+import os
+
+
+def data_extents(fd, offset=0, size=None):
+    """Maps out the allocated parts of (a range of) a sparse file.
+
+    Uses SEEK_DATA/SEEK_HOLE, so no data is actually read. If the file (or
+    the filesystem it's on) doesn't support them, the whole range is assumed
+    to be allocated.
+
+    Args:
+        fd: A file descriptor of the file.
+        offset: The offset into the file to start mapping at.
+        size: The length of the range to map, or None to map until EOF.
+
+    Returns:
+        A sorted list of (offset, length) tuples covering every part of the
+        range that contains data. Anything in between is a hole (reads as
+        zeros).
+    """
+    if size is None:
+        # unlike fstat, this works for block devices too
+        size = os.lseek(fd, 0, os.SEEK_END) - offset
+    end = offset + size
+    extents = []
+    pos = offset
+    try:
+        while pos < end:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # nothing but a hole until EOF
+                    break
+                raise
+            if start >= end:
+                break
+            stop = min(os.lseek(fd, start, os.SEEK_HOLE), end)
+            extents.append((start, stop - start))
+            pos = stop
+    except (OSError, AttributeError):
+        # not supported here (e.g. a block device or an old kernel)
+        return [(offset, size)] if size > 0 else []
+    return extents
+
+
+def allocated_size(path, offset=0, size=None):
+    """Returns the number of allocated bytes in (a range of) a file.
+
+    Returns None if the file can't be opened.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return sum(length for start, length in data_extents(fd, offset, size))
+    finally:
+        os.close(fd)
+
+
+def stat_size(path):
+    """Estimates the size & allocated bytes of a file without opening it.
+
+    For when it can't be opened (e.g. without permission to read it). The
+    size of block devices is looked up in sysfs, and they are assumed to be
+    fully allocated.
+
+    Returns:
+        A (size, allocated) tuple; both are None if unknown.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    if not stat.S_ISBLK(st.st_mode):
+        return st.st_size, st.st_blocks * 512
+    try:
+        with open("/sys/dev/block/{}:{}/size".format(os.major(st.st_rdev), os.minor(st.st_rdev))) as f:
+            size = int(f.read()) * 512
+    except (OSError, ValueError):
+        return None, None
+    return size, size
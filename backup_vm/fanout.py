@@ -0,0 +1,209 @@
+import threading
+import signal
+import queue
+import fcntl
+import sys
+import os
+from . import extents
+
+# not exported by the fcntl module until Python 3.10
+F_SETPIPE_SZ = getattr(fcntl, "F_SETPIPE_SZ", 1031)
+
+BLOCK_SIZE = 4 * 1024 * 1024
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def pipe(size=1024 * 1024):
+    """Creates a pipe, with a bigger buffer than the default if possible.
+
+    Bigger pipes mean fewer context switches between the ends of the pipe.
+
+    Returns:
+        A (read end, write end) tuple of file descriptors.
+    """
+    read_fd, write_fd = os.pipe()
+    try:
+        fcntl.fcntl(write_fd, F_SETPIPE_SZ, size)
+    except OSError:
+        pass
+    return read_fd, write_fd
+
+
+def advise(fd, offset, length, advice):
+    """Gives the kernel a hint about how a file will be read, if possible.
+
+    Args:
+        advice: The name of the hint, e.g. SEQUENTIAL for POSIX_FADV_SEQUENTIAL.
+    """
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, "POSIX_FADV_" + advice))
+    except (AttributeError, OSError):
+        # only a hint, so it doesn't matter if it's not supported
+        pass
+
+
+def read_file(path, offset=0, size=None, block_size=BLOCK_SIZE, drop_cache=False):
+    """Reads (part of) a file sequentially in large blocks.
+
+    Holes in sparse files are skipped over (see extents.data_extents) instead
+    of being read; zeros are generated for them instead.
+
+    Args:
+        path: The path of the file to read.
+        offset: The offset into the file to start reading at.
+        size: The number of bytes to read, or None to read until EOF.
+        block_size: The size of each read.
+        drop_cache: Whether to keep the file out of the page cache. The
+            kernel is told to read ahead aggressively, and each block is
+            dropped from the cache as soon as it has been read, so backing up
+            a disk doesn't evict everything else (e.g. other VMs' data).
+
+    Yields:
+        The contents of the file in blocks of at most block_size bytes.
+
+    Raises:
+        EOFError: The file ended before size bytes could be read.
+    """
+    with open(path, "rb", buffering=0) as f:
+        if size is None:
+            size = f.seek(0, os.SEEK_END) - offset
+        if drop_cache:
+            advise(f.fileno(), offset, size, "SEQUENTIAL")
+        pos = offset
+        for start, length in [*extents.data_extents(f.fileno(), offset, size), (offset + size, 0)]:
+            yield from zeros(start - pos, block_size)
+            f.seek(start)
+            pos = start + length
+            while length > 0:
+                block = f.read(min(block_size, length))
+                if not block:
+                    raise EOFError("unexpected end of file")
+                if drop_cache:
+                    # the block is a copy, so the cached pages aren't needed
+                    advise(f.fileno(), start, len(block), "DONTNEED")
+                start += len(block)
+                length -= len(block)
+                yield block
+
+
+def zeros(length, block_size=BLOCK_SIZE):
+    """Generates length zero bytes in blocks of at most block_size bytes."""
+    zero_block = memoryview(ZERO_BLOCK if block_size == BLOCK_SIZE else bytes(block_size))
+    while length > 0:
+        yield zero_block[:min(block_size, length)]
+        length -= block_size
+
+
+class FanOut:
+
+    """Reads a stream of data once and copies it to several pipes.
+
+    The data is pulled from an iterable of blocks (e.g. read_file()) by one
+    thread and each block is handed to a writer thread per pipe through a
+    bounded queue. A slow reader on the other end of a pipe fills up its
+    queue, which then blocks the source until it catches up; this means at
+    most queue_depth blocks are held in memory per pipe, and the source never
+    has to be read a second time. If a pipe is closed early (e.g. its borg
+    process dies), it is dropped and the others keep going.
+
+    If the source fails partway through, the processes consuming the data
+    (see attach()) are killed before their pipes are closed, so they can't
+    mistake the end of the data for the end of the disk (e.g. borg would
+    commit a truncated archive).
+
+    Attributes:
+        name: The name of the data source, used in error messages.
+        fds: The read ends of the pipes, to be handed to the processes
+            consuming the data.
+        failed: True if the source could not be read completely.
+    """
+
+    def __init__(self, name, blocks, count=1, queue_depth=8):
+        self.name = name
+        self.blocks = blocks
+        self.failed = False
+        self.fds = []
+        self.queues = []
+        self.alive = [True] * count
+        self.pids = [None] * count
+        self.lock = threading.Lock()
+        self.threads = []
+        for idx in range(count):
+            read_fd, write_fd = pipe()
+            q = queue.Queue(queue_depth)
+            self.fds.append(read_fd)
+            self.queues.append(q)
+            self.threads.append(threading.Thread(target=self._write, args=(idx, write_fd, q), daemon=True))
+        self.threads.append(threading.Thread(target=self._read, daemon=True))
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def attach(self, idx, pid):
+        """Sets the process reading from a pipe, to kill if the source fails.
+
+        The process is killed along with its process group (e.g. the ssh
+        process of a remote repository), so it has to lead one.
+
+        Args:
+            idx: The index of the pipe in fds.
+            pid: The process ID of the process.
+        """
+        with self.lock:
+            self.pids[idx] = pid
+            failed = self.failed
+        if failed:
+            self._kill(idx)
+
+    def _kill(self, idx):
+        if self.pids[idx] is None or not self.alive[idx]:
+            # if the pipe broke, the process may be gone (& its ID reused)
+            return
+        try:
+            os.killpg(self.pids[idx], signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _fail(self):
+        with self.lock:
+            self.failed = True
+        for idx in range(len(self.pids)):
+            self._kill(idx)
+
+    def _read(self):
+        try:
+            for block in self.blocks:
+                if not any(self.alive):
+                    # nobody is listening anymore
+                    break
+                for q in self.queues:
+                    q.put(block)
+        except Exception as e:
+            # whatever went wrong, the writers still need to be told to stop
+            print("Failed to read '{}': {}".format(self.name, e), file=sys.stderr)
+            # only close the pipes once nothing will take their end for the
+            # end of the data
+            self._fail()
+        finally:
+            for q in self.queues:
+                q.put(None)
+
+    def _write(self, idx, fd, q):
+        try:
+            for block in iter(q.get, None):
+                # keep draining the queue after the pipe breaks so the reader
+                # isn't blocked waiting for us
+                block = memoryview(block)
+                while self.alive[idx] and block:
+                    try:
+                        block = block[os.write(fd, block):]
+                    except BrokenPipeError:
+                        self.alive[idx] = False
+        finally:
+            os.close(fd)
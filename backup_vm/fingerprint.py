@@ -0,0 +1,208 @@
+"""A local index of what each disk image looked like when last backed up.
+
+borg's files cache can't tell if a block device (or a bind mount of an image
+read with --read-special) has changed, so every disk is read & chunked in full
+on every backup. The index keeps the size, modification time & a fast hash of
+each block of every disk image backed up with --skip-unchanged, which is
+enough to skip images that haven't been touched since, and to report how much
+of the others changed. The hashes are computed as the data streams past on its
+way to borg, so nothing is read twice.
+"""
+
+from copy import copy
+import hashlib
+import stat
+import json
+import sys
+import os
+from .fanout import BLOCK_SIZE
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+INDEX_DIR = "/var/lib/backup-vm"
+INDEX_VERSION = 1
+HASH_NAME = "blake2b-64" if xxhash is None else "xxh64"
+
+
+def new_hash():
+    if xxhash is None:
+        return hashlib.blake2b(digest_size=8)
+    return xxhash.xxh64()
+
+
+def repo_name(archive):
+    """Returns the repository of an archive Location, as a string."""
+    repo = copy(archive)
+    repo.archive = None
+    return str(repo)
+
+
+class Index:
+
+    """The fingerprints of the disk images of one domain.
+
+    Entries are keyed by the name of each file in the backup (e.g. sda.raw or
+    vdb.qcow2.0003), and only updated by commit() once the backup they were
+    made for has succeeded.
+
+    Attributes:
+        path: Where the index is stored.
+        entries: A dictionary mapping names to their fingerprints.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.pending = {}
+        try:
+            with open(path) as f:
+                index = json.load(f)
+            if index.get("version") == INDEX_VERSION:
+                self.entries = index["entries"]
+        except (OSError, ValueError, KeyError):
+            # a missing or broken index just means everything is read again
+            pass
+
+    @classmethod
+    def for_domain(cls, domain):
+        return cls(os.path.join(INDEX_DIR, domain + ".json"))
+
+    @staticmethod
+    def identify(member):
+        """Describes the state of a member's file without reading it.
+
+        A storage-level snapshot (e.g. a reflink copy) is a new file on every
+        backup, so a member read from one is identified by the disk it was
+        taken of instead, as it was when the snapshot was taken.
+        """
+        path = member.path
+        st = getattr(member.disk, "snapshot_stat", None)
+        if st is not None:
+            path = os.path.realpath(member.disk.path)
+        else:
+            st = os.stat(path)
+        return {
+            "path": path,
+            "offset": member.offset,
+            "size": member.size,
+            "inode": st.st_ino,
+            "mtime": st.st_mtime_ns,
+            # writes to a block device don't touch the mtime of its node
+            "mtime_reliable": stat.S_ISREG(st.st_mode),
+        }
+
+    def unchanged(self, member, repos, list_archives):
+        """Checks if a member is the same as when it was last backed up.
+
+        The archives it was last backed up to have to still be there, too: if
+        one of them is gone (e.g. pruned), the member's entry is dropped, so
+        it's backed up again now.
+
+        Args:
+            member: The builder.Member to check.
+            repos: The repositories (see repo_name()) it is being backed up to.
+            list_archives: A function returning the set of the names of the
+                archives in one of repos, or None if they can't be listed.
+
+        Returns:
+            True if the member's file hasn't been modified since it was last
+            backed up to every one of repos, in archives that still exist.
+        """
+        entry = self.entries.get(member.name)
+        if entry is None or not set(repos) <= set(entry.get("archives", {})):
+            return False
+        try:
+            current = self.identify(member)
+        except OSError:
+            return False
+        if not current["mtime_reliable"] or any(entry[k] != v for k, v in current.items()):
+            return False
+        for repo in repos:
+            existing = list_archives(repo)
+            if existing is None:
+                # can't tell if it's still there, so better back it up again
+                return False
+            if entry["archives"][repo] not in existing:
+                print("'{}' is no longer in {}, backing up {} again".format(
+                    entry["archives"][repo], repo, member.name), file=sys.stderr)
+                del self.entries[member.name]
+                return False
+        return True
+
+    def fingerprint(self, member, blocks, block_size=BLOCK_SIZE):
+        """Fingerprints the contents of a member as they are read.
+
+        Args:
+            member: The builder.Member the data belongs to.
+            blocks: An iterable of the blocks of the member's data (of any
+                size).
+            block_size: The size of each hashed block.
+
+        Yields:
+            The blocks, unchanged. Once the last one has been passed on, the
+            new fingerprint is waiting to be saved by commit().
+        """
+        entry = self.identify(member)
+        hashes = []
+        h = new_hash()
+        filled = 0
+        for block in blocks:
+            view = memoryview(block)
+            while view:
+                part = view[:block_size - filled]
+                h.update(part)
+                filled += len(part)
+                view = view[len(part):]
+                if filled == block_size:
+                    hashes.append(h.hexdigest())
+                    h = new_hash()
+                    filled = 0
+            yield block
+        if filled > 0:
+            hashes.append(h.hexdigest())
+        entry.update(hash=HASH_NAME, block_size=block_size, blocks=hashes)
+        self.pending[member.name] = entry
+
+    def changed_fraction(self, name):
+        """Compares a pending fingerprint to the last one saved.
+
+        Returns:
+            The fraction of blocks that changed, or None if there is nothing
+            comparable to compare to.
+        """
+        old = self.entries.get(name)
+        new = self.pending[name]
+        if old is None or (old["hash"], old["block_size"]) != (new["hash"], new["block_size"]):
+            return None
+        total = max(len(old["blocks"]), len(new["blocks"]))
+        if total == 0:
+            return 0.0
+        same = sum(a == b for a, b in zip(old["blocks"], new["blocks"]))
+        return (total - same) / total
+
+    def commit(self, archives):
+        """Saves the fingerprints of everything just backed up.
+
+        Prints how much of each file changed since its last backup.
+
+        Args:
+            archives: A dictionary mapping the name of each file backed up to
+                a dictionary mapping the repositories (see repo_name()) it
+                was backed up to to the names of the archives it is now in.
+                Only the repositories listed are skipped by unchanged().
+        """
+        for name in sorted(self.pending):
+            fraction = self.changed_fraction(name)
+            if fraction is not None:
+                print("{}: {:.1%} changed since the last backup".format(name, fraction), file=sys.stderr)
+            self.pending[name]["archives"] = archives.get(name, {})
+            self.entries[name] = self.pending[name]
+        self.pending = {}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": INDEX_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,89 @@
+import threading
+import time
+import sys
+from .lazy import lazy_import
+from . import errors
+
+libvirt = lazy_import("libvirt")
+
+
+class Freeze:
+
+    """Quiesces a domain's filesystems (with its guest agent) while in use.
+
+    Used as a context manager around whatever takes the point-in-time view of
+    the disks (a snapshot or the start of a pull-mode backup job), which should
+    be as quick as possible, as the guest can't write to the frozen
+    filesystems in the meantime. If there is no guest agent, nothing is frozen
+    and the view is only crash-consistent.
+
+    Attributes:
+        dom: The libvirt domain to freeze.
+        mountpoints: The guest mountpoints to freeze, or None for all.
+        timeout: The most seconds to keep the guest frozen for; if whatever
+            is done while it is frozen takes longer, it is thawed anyway.
+        frozen_for: How many seconds the guest was last frozen for, or None if
+            it wasn't.
+        metrics: The metrics.Metrics to record the time spent frozen in, if
+            any.
+    """
+
+    def __init__(self, dom, mountpoints=None, timeout=10, metrics=None):
+        self.dom = dom
+        self.mountpoints = mountpoints
+        self.timeout = timeout
+        self.metrics = metrics
+        self.frozen_for = None
+        self.frozen_at = None
+        self.thaw_timer = None
+        self.lock = threading.Lock()
+
+    def freeze(self):
+        """Freezes the guest's filesystems, if a guest agent is installed.
+
+        A timer thaws them again after timeout seconds, in case whatever they
+        were frozen for stalls.
+        """
+        start = time.monotonic()
+        try:
+            with errors.ignoring(libvirt.VIR_ERR_OPERATION_INVALID, libvirt.VIR_ERR_ARGUMENT_UNSUPPORTED):
+                self.dom.fsFreeze(self.mountpoints)
+        except libvirt.libvirtError:
+            if self.mountpoints is not None:
+                print("Couldn't freeze {}, the backup won't be quiesced".format(
+                    ", ".join(self.mountpoints)), file=sys.stderr)
+            return
+        self.frozen_at = start
+        self.thaw_timer = threading.Timer(self.timeout, self.thaw, kwargs={"timed_out": True})
+        self.thaw_timer.daemon = True
+        self.thaw_timer.start()
+
+    def thaw(self, timed_out=False):
+        """Thaws the guest's filesystems (if they were frozen by freeze())."""
+        with self.lock:
+            if self.frozen_at is None:
+                return
+            if timed_out:
+                print("The guest was frozen for over {} s, thawing it early (the backup may not be "
+                      "quiesced)".format(self.timeout), file=sys.stderr)
+            else:
+                self.thaw_timer.cancel()
+            try:
+                self.dom.fsThaw(self.mountpoints)
+            except libvirt.libvirtError:
+                print("Failed to thaw the guest's filesystems!", file=sys.stderr)
+            # measured from before the freeze to after the thaw, so this is
+            # never less than the time the guest actually spent frozen
+            self.frozen_for = time.monotonic() - self.frozen_at
+            self.frozen_at = None
+        if self.metrics is not None:
+            self.metrics.add("phase_duration_seconds", self.frozen_for, phase="freeze")
+        print("Guest filesystems were frozen for {:.0f} ms".format(self.frozen_for * 1000), file=sys.stderr)
+
+    def __enter__(self):
+        self.freeze()
+        return self
+
+    def __exit__(self, *args):
+        self.thaw()
+        return False
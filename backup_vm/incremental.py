@@ -0,0 +1,217 @@
+"""Incremental backups based on libvirt checkpoints.
+
+Each incremental backup stores, for every disk, a "delta" file instead of the
+whole image: one line of JSON describing the changed extents, followed by the
+contents of those extents in order. Applying the deltas of every later backup
+on top of the image from the last full backup gives back the latest image::
+
+    {"format": "backup-vm-delta", "version": 1, "size": 1073741824,
+     "parent": "backup-vm-1500000000", "checkpoint": "backup-vm-1500086400",
+     "extents": [[0, 65536], [1048576, 4194304]]}
+    <65536 bytes for the first extent><4194304 bytes for the second>
+
+(The header is a single line in the actual file.)
+
+The archives of every backup made with --incremental (full or not) have the
+name of the checkpoint made along with them stored as JSON in their comment
+(see archive_comment()), so the full backup a chain of deltas starts from
+can be found by their parents.
+"""
+
+import json
+import time
+import sys
+from .lazy import lazy_import
+from . import errors
+from .fanout import BLOCK_SIZE
+from . import pull
+
+libvirt = lazy_import("libvirt")
+
+CHECKPOINT_PREFIX = "backup-vm-"
+DELTA_FORMAT = "backup-vm-delta"
+DELTA_VERSION = 1
+
+# the first flag of an entry in a qemu:dirty-bitmap: NBD metadata context
+DIRTY = 1
+
+
+def new_checkpoint_name():
+    return CHECKPOINT_PREFIX + str(int(time.time()))
+
+
+def latest_checkpoint(dom):
+    """Finds the checkpoint made by the last backup of a domain.
+
+    Args:
+        dom: A libvirt domain object.
+
+    Returns:
+        The name of the newest checkpoint created by backup-vm, or None if
+        there isn't one (and a full backup is needed).
+    """
+    try:
+        checkpoints = dom.listAllCheckpoints(libvirt.VIR_DOMAIN_CHECKPOINT_LIST_LEAVES)
+    except libvirt.libvirtError:
+        return None
+    names = [c.getName() for c in checkpoints if c.getName().startswith(CHECKPOINT_PREFIX)]
+    names = [n for n in names if n[len(CHECKPOINT_PREFIX):].isdigit()]
+    if len(names) == 0:
+        return None
+    return max(names, key=lambda n: int(n[len(CHECKPOINT_PREFIX):]))
+
+
+def delete_checkpoint(dom, name, broken=False):
+    """Deletes a checkpoint, merging its bitmap into the previous one (if any).
+
+    Args:
+        dom: A libvirt domain object.
+        name: The name of the checkpoint.
+        broken: Whether the checkpoint's bitmaps may be missing or unusable,
+            in which case libvirt is only made to forget about it if they
+            can't be deleted.
+
+    Returns:
+        True if the checkpoint was deleted.
+    """
+    expected = (libvirt.VIR_ERR_OPERATION_FAILED,) if broken else ()
+    try:
+        with errors.ignoring(*expected):
+            checkpoint = dom.checkpointLookupByName(name)
+            try:
+                checkpoint.delete()
+            except libvirt.libvirtError:
+                if not broken:
+                    raise
+                checkpoint.delete(libvirt.VIR_DOMAIN_CHECKPOINT_DELETE_METADATA_ONLY)
+        return True
+    except libvirt.libvirtError:
+        print("Failed to delete checkpoint '{}'".format(name), file=sys.stderr)
+        return False
+
+
+def dirty_extents(handle, context, size, step=1024 ** 3):
+    """Lists the changed extents of a disk.
+
+    Args:
+        handle: A connected libnbd handle with the bitmap context requested.
+        context: The name of the NBD metadata context of the dirty bitmap.
+        size: The size of the disk.
+        step: The maximum number of bytes to query at once.
+
+    Returns:
+        A sorted list of (offset, length) tuples, with adjacent extents merged.
+
+    Raises:
+        ValueError: The NBD server didn't report the status of the bitmap.
+    """
+    extents = []
+    offset = 0
+    while offset < size:
+        entries = []
+
+        def callback(metacontext, start, status, err):
+            if metacontext == context:
+                entries.extend(zip(status[::2], status[1::2]))
+            return 0
+
+        handle.block_status(min(step, size - offset), offset, callback)
+        if len(entries) == 0:
+            raise ValueError("no block status reported for " + context)
+        for length, flags in entries:
+            length = min(length, size - offset)
+            if flags & DIRTY:
+                if extents and extents[-1][0] + extents[-1][1] == offset:
+                    extents[-1] = (extents[-1][0], extents[-1][1] + length)
+                else:
+                    extents.append((offset, length))
+            offset += length
+    return extents
+
+
+def archive_comment(checkpoint, parent=None):
+    """Returns the comment of an archive made at a checkpoint.
+
+    Args:
+        checkpoint: The name of the checkpoint made along with the backup.
+        parent: The name of the checkpoint the backup's deltas start from, or
+            None for a full backup.
+    """
+    comment = {"checkpoint": checkpoint}
+    if parent is not None:
+        comment["parent"] = parent
+    return json.dumps(comment, sort_keys=True)
+
+
+def delta_header(size, extents, parent, checkpoint):
+    return (json.dumps({
+        "format": DELTA_FORMAT,
+        "version": DELTA_VERSION,
+        "size": size,
+        "parent": parent,
+        "checkpoint": checkpoint,
+        "extents": extents,
+    }, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+def delta_blocks(handle, header, extents, block_size=BLOCK_SIZE):
+    """Generates the contents of a delta file.
+
+    Args:
+        handle: A connected libnbd handle to read the changed data from.
+        header: The header of the delta, from delta_header().
+        extents: The list of (offset, length) tuples to include.
+
+    Yields:
+        The delta file in blocks of at most block_size bytes.
+    """
+    yield header
+    yield from pull.read_blocks(handle, extents, block_size)
+
+
+def apply_delta(delta, image):
+    """Applies a delta file to a raw disk image in place.
+
+    Args:
+        delta: A binary file object to read the delta from.
+        image: A binary file object (opened for reading & writing) of the
+            image from the previous backup.
+
+    Returns:
+        The parsed header of the delta.
+
+    Raises:
+        ValueError: The delta is malformed or truncated.
+    """
+    header = json.loads(delta.readline().decode("utf-8"))
+    if header.get("format") != DELTA_FORMAT or header.get("version") != DELTA_VERSION:
+        raise ValueError("not a backup-vm delta file")
+    image.truncate(header["size"])
+    for offset, length in header["extents"]:
+        image.seek(offset)
+        while length > 0:
+            block = delta.read(min(BLOCK_SIZE, length))
+            if not block:
+                raise ValueError("delta file is truncated")
+            image.write(block)
+            length -= len(block)
+    return header
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] in {"-h", "--help"}:
+        print("usage: python3 -m backup_vm.incremental DELTA IMAGE", file=sys.stderr)
+        print("Apply an incremental backup (e.g. sda.raw.delta) to the raw image of the previous backup.",
+              file=sys.stderr)
+        sys.exit(2)
+    with open(sys.argv[1], "rb") as delta, open(sys.argv[2], "r+b") as image:
+        try:
+            header = apply_delta(delta, image)
+        except ValueError as e:
+            print("{}: {}".format(sys.argv[1], e), file=sys.stderr)
+            sys.exit(1)
+    print("Applied changes since checkpoint '{}'".format(header["parent"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import importlib.util
+import types
+import sys
+
+
+class MissingModule(types.ModuleType):
+
+    """Stands in for a module that isn't installed until it's actually used."""
+
+    def __getattr__(self, attr):
+        if attr.startswith("__"):
+            raise AttributeError(attr)
+        raise ImportError("No module named '{}'".format(self.__name__), name=self.__name__)
+
+
+def lazy_import(name):
+    """Imports a module only once one of its attributes is first used.
+
+    Used for libvirt, which takes a while to load, so commands that end
+    before it's needed (e.g. --help) don't have to wait for it. Code that
+    doesn't use it at all (e.g. restoring an incremental backup) works even if
+    it isn't installed.
+
+    Raises:
+        ImportError: The module isn't installed (once one of its attributes
+            is used).
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return MissingModule(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
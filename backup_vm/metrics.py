@@ -0,0 +1,162 @@
+"""Timings & sizes of each backup, for spotting regressions & planning.
+
+The metrics of each domain's backup are collected as it runs and written out
+once it's done, either as a Prometheus textfile (for node_exporter's textfile
+collector, if the path ends in .prom) or appended as JSON lines (one object
+per metric) otherwise:
+
+    backup_vm_phase_duration_seconds  how long each phase took (phase=freeze,
+                                      snapshot, archive_setup, borg, commit or
+                                      pivot; per disk or archive where it
+                                      applies)
+    backup_vm_read_bytes              bytes read from each disk by backup-vm
+                                      itself (not by borg)
+    backup_vm_archive_*_bytes         the original, compressed & deduplicated
+                                      size of each archive, from borg's --json
+                                      stats
+    backup_vm_retries                 retried block commits & pivots
+    backup_vm_success                 1 if the backup succeeded, 0 if not
+    backup_vm_last_run_timestamp_seconds
+                                      when the backup started
+
+Every metric is labelled with the domain it belongs to, and only the
+domain's own metrics are replaced in a textfile, so any number of domains
+can share one.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import fcntl
+import json
+import time
+import re
+import os
+from . import fingerprint
+
+PREFIX = "backup_vm_"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_sample(name, labels, value):
+    return "{}{{{}}} {}\n".format(PREFIX + name, ",".join(
+        '{}="{}"'.format(k, escape(v)) for k, v in labels), repr(float(value)))
+
+
+@contextmanager
+def locked(path):
+    """Holds a lock on a file (next to path) shared by every backup-vm process."""
+    with open(path + ".lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+class Metrics:
+
+    """Collects the metrics of the backup of one domain.
+
+    Attributes:
+        domain: The name of the domain.
+        path: Where to write the metrics to, or None to not keep any.
+        borg: A dictionary to pass to multi.assimilate() as results, or None
+            if metrics aren't kept.
+    """
+
+    def __init__(self, domain, path=None):
+        self.domain = domain
+        self.path = path
+        self.borg = {} if path is not None else None
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def add(self, name, value, **labels):
+        """Adds value to a metric (starting from 0)."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    @contextmanager
+    def phase(self, name, **labels):
+        """Times the code run in the with statement as a phase."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add("phase_duration_seconds", time.monotonic() - start, phase=name, **labels)
+
+    @contextmanager
+    def entering(self, context_manager, phase, **labels):
+        """Enters a context manager, timing only how long that takes."""
+        start = time.monotonic()
+        with context_manager as value:
+            self.add("phase_duration_seconds", time.monotonic() - start, phase=phase, **labels)
+            yield value
+
+    def count_bytes(self, blocks, **labels):
+        """Passes on an iterable of blocks, adding up their size as bytes read."""
+        total = 0
+        try:
+            for block in blocks:
+                total += len(block)
+                yield block
+        finally:
+            self.add("read_bytes", total, **labels)
+
+    def samples(self, success):
+        """Lists every metric as (name, labels, value) tuples."""
+        samples = [(name, labels, value) for (name, labels), value in self.values.items()]
+        for archive, result in (self.borg or {}).items():
+            labels = (("archive", archive.archive), ("repository", fingerprint.repo_name(archive)))
+            samples.append(("phase_duration_seconds", (("phase", "borg"),) + labels, result["duration"]))
+            stats = result.get("stats", {})
+            for stat in ("original_size", "compressed_size", "deduplicated_size"):
+                if stat in stats:
+                    samples.append(("archive_{}_bytes".format(stat[:-len("_size")]), labels, stats[stat]))
+        samples.append(("success", (), int(success)))
+        samples.append(("last_run_timestamp_seconds", (), self.start))
+        return [(name, (("domain", self.domain),) + labels, value) for name, labels, value in samples]
+
+    def write(self, success):
+        """Writes out the metrics (if a path was given).
+
+        Args:
+            success: Whether the backup succeeded.
+        """
+        if self.path is None:
+            return
+        samples = self.samples(success)
+        with locked(self.path):
+            if self.path.endswith(".prom"):
+                self.write_textfile(samples)
+            else:
+                with open(self.path, "a") as f:
+                    for name, labels, value in samples:
+                        f.write(json.dumps({"time": self.start, "metric": PREFIX + name,
+                                            "labels": dict(labels), "value": value}) + "\n")
+
+    def write_textfile(self, samples):
+        """Replaces the domain's metrics in a Prometheus textfile."""
+        lines = OrderedDict()
+        own_label = 'domain="{}"'.format(escape(self.domain))
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    m = re.match(r"(\w+)\{(.*)\} ", line)
+                    if m is not None and own_label not in re.findall(r'\w+="(?:[^"\\]|\\.)*"', m.group(2)):
+                        lines.setdefault(m.group(1), []).append(line)
+        except FileNotFoundError:
+            pass
+        for name, labels, value in samples:
+            lines.setdefault(PREFIX + name, []).append(format_sample(name, labels, value))
+        # node_exporter may read the file at any time, so never leave it
+        # half-written
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for name, samples in lines.items():
+                f.write("# TYPE {} gauge\n".format(name))
+                f.writelines(samples)
+        os.replace(tmp_path, self.path)
@@ -1,24 +1,108 @@
-from distutils.version import LooseVersion
 from base64 import b64encode
 from getpass import getpass
 from pty import openpty
 from copy import copy
 import subprocess
-import selectors
-import termios
-import fcntl
+import time
+import shutil
 import json
+import re
+import termios
 import sys
 import pty
 import os
+from . import fanout
 from . import parse
+from . import fingerprint
+from .progress import Progress
+
+
+# environment variables borg checks before asking a yes/no question on stdin
+NO_PROMPT_VARS = [
+    "BORG_UNKNOWN_UNENCRYPTED_REPO_ACCESS_IS_OK",
+    "BORG_RELOCATED_REPO_ACCESS_IS_OK",
+]
+
+
+BORG_VERSION_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                                  "backup-vm", "borg-version.json")
+# versions of borg binaries already found out, by their path, mtime & size
+borg_versions = {}
+
+# results of probe_passphrase(), by repository location (as a string)
+passphrase_probes = {}
+# passphrases entered by the user, by repository ID (or location, if the ID
+# can't be found out)
+passphrase_cache = {}
+probe_executor = None
+
+
+def probe_passphrase(repo):
+    """Checks if a repository needs a passphrase that isn't set.
+
+    Instead of listing every archive, only the last one is listed (which
+    only needs the repository's manifest, unlike e.g. `borg info`, which may
+    have to rebuild the local cache first), and the repository's ID is read
+    from its config (which isn't encrypted) to tell repositories apart no
+    matter how they are accessed.
+
+    Args:
+        repo: A Location object of the repository.
+
+    Returns:
+        A tuple of the repository's ID (or location, if the ID couldn't be
+        read) and a boolean indicating if a passphrase needs to be entered.
+    """
+    env = os.environ.copy()
+    for var in NO_PROMPT_VARS:
+        env.setdefault(var, "no")
+    try:
+        repo_id = subprocess.run(["borg", "config", str(repo), "id"], stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env,
+                                 check=True).stdout.decode("utf-8").strip() or str(repo)
+    except subprocess.CalledProcessError:
+        repo_id = str(repo)
+    # check if we need a password as recommended by the docs:
+    # https://borgbackup.readthedocs.io/en/stable/internals/frontends.html#passphrase-prompts
+    if len({"BORG_PASSPHRASE", "BORG_PASSCOMMAND", "BORG_NEWPASSPHRASE"} - set(env)) == 3:
+        # generate random password that would be incorrect were it needed
+        env["BORG_PASSPHRASE"] = b64encode(os.urandom(16)).decode("utf-8")
+    proc = subprocess.run(["borg", "list", "--short", "--last", "1", str(repo)], stdin=subprocess.DEVNULL,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    err = proc.stderr.decode("utf-8").rstrip("\n").split("\n")[-1]
+    # exact error message changes between borg versions
+    needed = proc.returncode != 0 and err.startswith("passphrase supplied") and err.endswith("is incorrect.")
+    return repo_id, needed
+
+
+def start_passphrase_probes(archives):
+    """Starts checking which repositories need passphrases in the background.
+
+    The results are kept for the rest of the run, so each repository is only
+    checked once however many times get_passphrases() is called.
+
+    Args:
+        archives: A list of Location objects to check the repositories of.
+    """
+    global probe_executor
+    # only imported when needed, as it takes a while (see assimilate())
+    from concurrent.futures import ThreadPoolExecutor
+    for archive in archives:
+        repo = copy(archive)
+        repo.archive = None
+        if str(repo) not in passphrase_probes:
+            if probe_executor is None:
+                probe_executor = ThreadPoolExecutor(max_workers=8)
+            passphrase_probes[str(repo)] = probe_executor.submit(probe_passphrase, repo)
 
 
 def get_passphrases(archives):
     """Prompts the user for their archive passphrases.
 
     Checks for archives that won't open without a (non-blank, non-random)
-    BORG_PASSPHRASE and prompts the user for their passphrases.
+    BORG_PASSPHRASE and prompts the user for their passphrases. The checks
+    of all repositories run at once (see start_passphrase_probes()), and
+    each passphrase is only asked for once per repository.
 
     Args:
         archives: A list of Location objects to check the repositories of.
@@ -27,29 +111,47 @@ def get_passphrases(archives):
         A dictionary mapping archives to their (purported) passphrases. The
         entered passphrases are not checked to actually open the archives.
     """
+    start_passphrase_probes(archives)
     passphrases = {}
-    env = os.environ.copy()
     for archive in archives:
         repo = copy(archive)
         repo.archive = None
-        # check if we need a password as recommended by the docs:
-        # https://borgbackup.readthedocs.io/en/stable/internals/frontends.html#passphrase-prompts
-        if len({"BORG_PASSPHRASE", "BORG_PASSCOMMAND", "BORG_NEWPASSPHRASE"} - set(env)) == 3:
-            # generate random password that would be incorrect were it needed
-            env["BORG_PASSPHRASE"] = b64encode(os.urandom(16)).decode("utf-8")
-        with subprocess.Popen(["borg", "list", str(repo)], stdin=subprocess.PIPE,
-                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env) as proc:
-            # manually close stdin instead of /dev/null so borg knows it won't get input
-            proc.stdin.close()
-            proc.stdin = None
-            err = proc.communicate(input)[1].decode("utf-8").rstrip("\n").split("\n")[-1]
-            if proc.poll() != 0:
-                # exact error message changes between borg versions
-                if err.startswith("passphrase supplied") and err.endswith("is incorrect."):
-                    passphrases[archive] = getpass("Enter passphrase for key {!s}: ".format(repo))
+        repo_id, needed = passphrase_probes[str(repo)].result()
+        if needed:
+            if repo_id not in passphrase_cache:
+                passphrase_cache[repo_id] = getpass("Enter passphrase for key {!s}: ".format(repo))
+            passphrases[archive] = passphrase_cache[repo_id]
     return passphrases
 
 
+def list_archives(repo, passphrase=None):
+    """Lists the archives in a repository.
+
+    Args:
+        repo: A Location object of the repository (any archive is ignored).
+        passphrase: The passphrase of the repository, if it needs one.
+
+    Returns:
+        A set of the names of the archives in the repository, or None if they
+        couldn't be listed.
+    """
+    repo = copy(repo)
+    repo.archive = None
+    env = os.environ.copy()
+    if passphrase is not None:
+        env["BORG_PASSPHRASE"] = passphrase
+    elif len({"BORG_PASSPHRASE", "BORG_PASSCOMMAND", "BORG_NEWPASSPHRASE"} - set(env)) == 3:
+        # fail instead of prompting for a passphrase
+        env["BORG_PASSPHRASE"] = b64encode(os.urandom(16)).decode("utf-8")
+    for var in NO_PROMPT_VARS:
+        env.setdefault(var, "no")
+    proc = subprocess.run(["borg", "list", "--short", str(repo)], stdin=subprocess.DEVNULL,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env)
+    if proc.returncode != 0:
+        return None
+    return set(proc.stdout.decode("utf-8").splitlines())
+
+
 def log(name, msg, *args, file=sys.stderr, end="\n", **kwargs):
     """Logs a string to a file, prepending a "tag" to each line.
 
@@ -70,172 +172,349 @@ def log(name, msg, *args, file=sys.stderr, end="\n", **kwargs):
     print("[{}] {}".format(name, msg[-1]), file=file, end=end, **kwargs)
 
 
-def process_line(p, line, total_size=None, prompt_answers={}):
-    """Process a line coming from a borg process.
+def process_message(p, msg, total_size=None, prompt_answers={}):
+    """Process a JSON message coming from a borg process.
 
-    Processes JSON emitted by a borg process with --log-json turned on. The
-    lines are cached, so 1 line does not have to equal 1 JSON message.
+    Processes JSON emitted by a borg process with --log-json turned on.
 
     Args:
-        p: The process the line came from (with some extra properties added to
-            the Popen object).
-        line: The line read from the process's stdout or stderr. If it contains
-            progress information, update the stored progress value. If it is a
-            prompt for the user, ask for and return the answer (& cache it for
-            later.) If it is a log message or some other non-JSON, print it out.
+        p: The process the message came from (with some extra properties
+            added to the process object).
+        msg: The parsed message. If it contains progress information, update
+            the stored progress value. If it is a prompt for the user, ask for
+            and return the answer (& cache it for later.) If it is a log
+            message, print it out. If it is the output of --json, store the
+            stats of the archive.
         total_size: The total size of all files being backed up. This can be set
             to None to disable progress calculation.
         prompt_answers: A dictionary of previous answers from users' prompts.
             Prompts with msgids in the dictionary will be automatically answered
             with the value given (ostensibly from an earlier prompt).
     """
-    if len(p.json_buf) > 0 or line.startswith("{"):
-        p.json_buf.append(line)
-    if len(p.json_buf) > 0 and line.endswith("}"):
-        try:
-            msg = json.loads("\n".join(p.json_buf))
-            p.json_buf = []
-            if msg["type"] == "archive_progress" and total_size is not None:
-                p.progress = msg["original_size"] / total_size
-            elif msg["type"] == "log_message":
-                log(p.archive.orig, msg["message"].split("\n"))
-            elif msg["type"].startswith("question"):
-                if "msgid" in msg:
-                    prompt_id = msg["msgid"]
-                elif "message" in msg:
-                    prompt_id = msg["message"]
-                else:
-                    raise ValueError("No msgid or message for prompt")
-                if msg.get("is_prompt", False) or msg["type"].startswith("question_prompt"):
-                    if prompt_id not in prompt_answers:
-                        log(p.archive.orig, msg["message"].split("\n"), end="")
-                        try:
-                            prompt_answers[prompt_id] = input()
-                            print(prompt_answers[prompt_id], file=p.stdin, flush=True)
-                        except EOFError:
-                            p.stdin.close()
-                elif not msg["type"].startswith("question_accepted"):
-                    log(p.archive.orig, msg["message"].split("\n"))
-        except json.decoder.JSONDecodeError:
-            log(p.archive.orig, p.json_buf)
-            p.json_buf = []
-    elif line.startswith("Enter passphrase for key "):
+    if msg.get("type") == "archive_progress":
+        if total_size is not None and "original_size" in msg:
+            p.progress = msg["original_size"] / total_size
+    elif msg.get("type") == "log_message":
+        log(p.archive.orig, msg["message"].split("\n"))
+    elif msg.get("type", "").startswith("question"):
+        if "msgid" in msg:
+            prompt_id = msg["msgid"]
+        elif "message" in msg:
+            prompt_id = msg["message"]
+        else:
+            raise ValueError("No msgid or message for prompt")
+        if p.stdin is None:
+            log(p.archive.orig, msg["message"].split("\n"))
+        elif msg.get("is_prompt", False) or msg["type"].startswith("question_prompt"):
+            if prompt_id not in prompt_answers:
+                log(p.archive.orig, msg["message"].split("\n"), end="")
+                try:
+                    prompt_answers[prompt_id] = input()
+                    print(prompt_answers[prompt_id], file=p.stdin, flush=True)
+                except EOFError:
+                    p.stdin.close()
+        elif not msg["type"].startswith("question_accepted"):
+            log(p.archive.orig, msg["message"].split("\n"))
+    elif isinstance(msg.get("archive"), dict) and "stats" in msg["archive"]:
+        # the final output of borg create --json
+        p.stats = msg["archive"]["stats"]
+        # (with any placeholders like {now} filled in)
+        p.name = msg["archive"].get("name")
+    elif "message" in msg:
+        log(p.archive.orig, str(msg["message"]).split("\n"))
+
+
+def process_text(p, line):
+    """Process a line of plain text coming from a borg process.
+
+    Answers passphrase prompts (if the process's stdin is still available)
+    and prints out anything else.
+    """
+    if line.startswith("Enter passphrase for key ") and p.stdin is not None:
         log(p.archive.orig, [line], end="")
         passphrase = getpass("")
         print(passphrase, file=p.stdin, flush=True)
         print("", file=sys.stderr)
     elif line != "":
-        # line is not json?
         log(p.archive.orig, [line])
-    # TODO: process password here for efficiency & simplicity
+
+
+def parse_version(version):
+    """Turns a version string into a tuple of numbers to compare.
+
+    Any suffix of a part of the version is ignored (e.g. 1.2.0b3 is parsed
+    as (1, 2, 0)).
+    """
+    parts = []
+    for part in version.split("."):
+        m = re.match(r"\d+", part)
+        if m is None:
+            break
+        parts.append(int(m.group()))
+    return tuple(parts)
 
 
 def get_borg_version():
     """
     Get the version of the system borg.
 
+    The version is cached (in memory & in BORG_VERSION_CACHE) along with the
+    path & modification time of the borg binary, so borg only has to be run
+    again when it's replaced (e.g. upgraded).
+
     Returns:
-        The version of the system borg as a distutils.version.LooseVersion (for
-        easy comparison with other versions).
+        The version of the system borg as a tuple of numbers (see
+        parse_version()), for easy comparison with other versions.
     """
-    version_bytes = subprocess.run(["borg", "--version"], stdout=subprocess.PIPE, check=True).stdout
-    return LooseVersion(version_bytes.decode("utf-8").split(" ")[1])
+    path = shutil.which("borg")
+    key = None
+    if path is not None:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        if key in borg_versions:
+            return parse_version(borg_versions[key])
+        try:
+            with open(BORG_VERSION_CACHE) as f:
+                cached = json.load(f)
+            if tuple(cached["key"]) == key:
+                borg_versions[key] = cached["version"]
+                return parse_version(cached["version"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    version_bytes = subprocess.run([path or "borg", "--version"], stdout=subprocess.PIPE, check=True).stdout
+    version = version_bytes.decode("utf-8").split(" ")[1].strip()
+    if key is not None:
+        borg_versions[key] = version
+        try:
+            os.makedirs(os.path.dirname(BORG_VERSION_CACHE), exist_ok=True)
+            with open(BORG_VERSION_CACHE, "w") as f:
+                json.dump({"key": key, "version": version}, f)
+        except OSError:
+            pass
+    return parse_version(version)
 
 
-def assimilate(archives, total_size=None, dir_to_archive=".", passphrases=None, verb="create"):
+def per_archive(value, archive):
+    """Looks up a setting that may be given per archive.
+
+    Args:
+        value: Either a single value shared by all archives or a dictionary
+            mapping archives to their own values.
+        archive: The Location object to look up the setting for.
+
+    Returns:
+        The value of the setting for the given archive.
+    """
+    if isinstance(value, dict):
+        return value.get(archive)
+    return value
+
+
+def assimilate(archives, total_size=None, dir_to_archive=".", passphrases=None, verb="create", max_jobs=None,
+               stdin=None, weights=None, cpu_limit=None, interactive=None, results=None, cwd=None,
+               started=None, timeout=None):
     """
     Run and manage multiple `borg create` commands.
 
+    The processes are run (and their output processed) on an asyncio event
+    loop, so the next one starts as soon as an earlier one exits.
+
     Args:
         archives: A list containing Location objects for the archives to create.
         total_size: The total size of all files being backed up. As borg
             normally only makes one pass over the data, it can't calculate
             percentages on its own. Setting this to None disables progress
-            calculation.
+            calculation. A dictionary mapping archives to the size of their
+            own files can also be given.
         dir_to_archive: The directory to archive. Defaults to the current
-            directory.
+            directory. A dictionary mapping archives to their own list of
+            paths can also be given.
+        max_jobs: The maximum number of borg processes to run at once. The
+            rest are started (in order) as earlier ones finish. Setting this
+            to None runs every process at once.
+        stdin: A dictionary mapping archives to file descriptors to use as
+            the standard input of their borg processes (e.g. to archive data
+            from a pipe with `borg create -`). The file descriptors are closed
+            once the processes are started. As stdin is taken, these processes
+            can't be sent answers to prompts.
+        weights: A dictionary mapping archives to how much work (e.g. bytes
+            to actually read) each one represents, to weigh their progress by
+            in the total. Defaults to their total_size.
+        cpu_limit: A throttle.CPULimit to put the borg processes under.
+        interactive: Whether borg's prompts can be answered by the user. If
+            so, each process gets a pty to ask its questions over; otherwise
+            plain pipes are used for its output (and none for its input).
+            Defaults to whether stdin is a tty.
+        results: A dictionary to fill in with the outcome of each process,
+            mapping archives to dictionaries with its duration (in seconds),
+            return code & (for borg create, which is then run with --json
+            if borg is 1.1 or newer) the stats & name of the new archive.
+        cwd: The directory to run the borg processes in (which relative
+            paths are relative to). Defaults to the current directory.
+        started: A dictionary mapping archives to functions to call with the
+            process ID of their borg processes as soon as they are started
+            (e.g. fanout.FanOut.attach(), to kill them if their stdin turns
+            out to be incomplete). Each process leads its own process group.
+        timeout: The most seconds each borg process may run for, or None for
+            no limit. A process that takes longer is killed (and counts as
+            failed).
 
     Returns:
         A boolean indicating if any borg processes failed (True = failed).
     """
-
-    if dir_to_archive is None:
-        dir_to_archive = []
-    else:
-        dir_to_archive = [dir_to_archive]
+    # asyncio takes longer to import than the rest of backup-vm, so it's only
+    # imported once there is something to run (not e.g. for --help)
+    import asyncio
+    from . import engine
 
     if passphrases is None:
         passphrases = get_passphrases(archives) if sys.stdout.isatty() else {}
+    if interactive is None:
+        interactive = sys.stdin.isatty()
 
-    if get_borg_version() < LooseVersion("1.1.0"):
+    if get_borg_version() < (1, 1, 0):
         # borg <1.1 doesn't support --log-json for the progress display
         print("You are using an old version of borg, progress indication is disabled", file=sys.stderr)
         recent_borg = False
         progress = False
     else:
         recent_borg = True
-        progress = total_size is not None
+        progress = all(per_archive(total_size, a) is not None for a in archives)
 
+    async def run_borg(archive):
+        if progress:
+            archive.extra_args.append("--progress")
+        if recent_borg:
+            archive.extra_args.append("--log-json")
+        if results is not None and verb == "create" and recent_borg:
+            # (like --log-json, borg <1.1 doesn't support it, so there are no
+            # stats to report then)
+            archive.extra_args.append("--json")
+        paths = per_archive(dir_to_archive, archive)
+        if paths is None:
+            paths = []
+        elif isinstance(paths, str):
+            paths = [paths]
+        env = os.environ.copy()
+        passphrase = passphrases.get(archive, os.environ.get("BORG_PASSPHRASE"))
+        if passphrase is not None:
+            env["BORG_PASSPHRASE"] = passphrase
+        stdin_fd = stdin.pop(archive, None)
+        if stdin_fd is None and interactive:
+            # a pty, so borg asks its questions (& we can answer them)
+            master, slave = openpty()
+            settings = termios.tcgetattr(master)
+            settings[3] &= ~termios.ECHO
+            termios.tcsetattr(master, termios.TCSADRAIN, settings)
+            child_fds = {"stdin": slave, "stdout": slave, "stderr": slave}
+            read_fds = [master]
+            parent_fds = [slave]
+        else:
+            # nobody is around to answer prompts, so plain pipes will do
+            # (borg answers its yes/no questions from the environment)
+            for var in NO_PROMPT_VARS:
+                env.setdefault(var, "no")
+            stdout_r, stdout_w = fanout.pipe()
+            stderr_r, stderr_w = fanout.pipe()
+            child_fds = {"stdin": subprocess.DEVNULL if stdin_fd is None else stdin_fd,
+                         "stdout": stdout_w, "stderr": stderr_w}
+            read_fds = [stdout_r, stderr_r]
+            parent_fds = [stdout_w, stderr_w]
+        start = time.monotonic()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                "borg", verb, str(archive), *paths, *archive.extra_args, env=env, cwd=cwd,
+                close_fds=True, start_new_session=True,
+                preexec_fn=cpu_limit.preexec if cpu_limit is not None else None, **child_fds)
+        finally:
+            if stdin_fd is not None:
+                os.close(stdin_fd)
+            if len(read_fds) > 1:
+                # the pipes close on the child's exit only if this end is closed
+                for fd in parent_fds:
+                    os.close(fd)
+                parent_fds = []
+        if started is not None and archive in started:
+            started[archive](proc.pid)
+        for fd in read_fds:
+            os.set_blocking(fd, False)
+        proc.stdin = os.fdopen(read_fds[0], "w", closefd=False) if len(read_fds) == 1 else None
+        proc.archive = archive
+        proc.progress = 0
+        proc.stats = None
+        proc.name = None
+        proc.total_size = per_archive(total_size, archive)
+        borg_processes.append(proc)
+        # progress messages can come by the thousands per second, and only
+        # the latest one matters
+        readers = [engine.MessageReader(fd, lambda msg: process_message(proc, msg, proc.total_size),
+                                        lambda line: process_text(proc, line), coalesce={"archive_progress"})
+                   for fd in read_fds]
+        try:
+            await proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                # (e.g. after a timeout) reap it before the event loop goes
+                await proc.wait()
+            for reader in readers:
+                # pick up whatever was written right before the process exited
+                reader.read()
+                reader.stop()
+            for fd in parent_fds + read_fds:
+                os.close(fd)
+        proc.progress = 1
+        draw()
+        if results is not None:
+            results[archive] = {"duration": time.monotonic() - start, "returncode": proc.returncode}
+            if proc.stats is not None:
+                results[archive]["stats"] = proc.stats
+            if proc.name is not None:
+                results[archive]["name"] = proc.name
+        return proc.returncode != 0
+
+    # weigh each process's progress by the amount of data it has to back up
+    if progress:
+        tracker = Progress("backup progress")
+        for archive in archives:
+            weight = per_archive(weights, archive)
+            if weight is None:
+                weight = per_archive(total_size, archive)
+            tracker.add(archive, weight, group=fingerprint.repo_name(archive))
+
+    def draw():
+        if progress:
+            for p in borg_processes:
+                tracker.update(p.archive, p.progress)
+            tracker.draw()
+
+    async def run_all():
+        if not progress:
+            # give the user some feedback so the program doesn't look frozen
+            print("starting backup", flush=True)
+            return await engine.gather_limited(map(run_borg, archives), max_jobs, timeout)
+        redraw = asyncio.ensure_future(engine.every(1, draw))
+        try:
+            return await engine.gather_limited(map(run_borg, archives), max_jobs, timeout)
+        finally:
+            redraw.cancel()
+            await asyncio.wait([redraw])
+            print()
+
+    stdin = dict(stdin or {})
     borg_processes = []
-    borg_failed = False
     try:
-        with selectors.DefaultSelector() as sel:
-            for idx, archive in enumerate(archives):
-                if progress:
-                    archive.extra_args.append("--progress")
-                if recent_borg:
-                    archive.extra_args.append("--log-json")
-                env = os.environ.copy()
-                passphrase = passphrases.get(archive, os.environ.get("BORG_PASSPHRASE"))
-                if passphrase is not None:
-                    env["BORG_PASSPHRASE"] = passphrase
-                master, slave = openpty()
-                settings = termios.tcgetattr(master)
-                settings[3] &= ~termios.ECHO
-                termios.tcsetattr(master, termios.TCSADRAIN, settings)
-                proc = subprocess.Popen(["borg", verb, str(archive), *dir_to_archive, *archive.extra_args], env=env,
-                                        stdout=slave, stderr=slave, stdin=slave, close_fds=True, start_new_session=True)
-                fl = fcntl.fcntl(master, fcntl.F_GETFL)
-                fcntl.fcntl(master, fcntl.F_SETFL, fl | os.O_NONBLOCK)
-                proc.stdin = os.fdopen(master, "w")
-                proc.stdout = os.fdopen(master, "r")
-                proc.archive = archive
-                proc.json_buf = []
-                proc.progress = 0
-                borg_processes.append(proc)
-                sel.register(proc.stdout, selectors.EVENT_READ, data=proc)
-
-            if progress:
-                print("backup progress: 0%".ljust(25), end="\u001b[25D", flush=True)
-            else:
-                # give the user some feedback so the program doesn't look frozen
-                print("starting backup", flush=True)
-            while len(sel.get_map()) > 0:
-                for key, mask in sel.select(1):
-                    for line in iter(key.fileobj.readline, ""):
-                        process_line(key.data, line.rstrip("\n"), total_size)
-                for key in [*sel.get_map().values()]:
-                    if key.data.poll() is not None:
-                        key.data.wait()
-                        key.data.progress = 1
-                        if key.data.returncode != 0:
-                            borg_failed = True
-                        sel.unregister(key.fileobj)
-                if progress:
-                    total_progress = sum(p.progress for p in borg_processes)
-                    print("backup progress: {}%".format(
-                        int(total_progress / len(borg_processes) * 100)).ljust(25), end="\u001b[25D")
-            if progress:
-                print()
+        failed = engine.run(run_all())
+        for archive, result in zip(archives, failed):
+            if isinstance(result, asyncio.TimeoutError):
+                log(archive.orig, ["borg took longer than {} s and was killed".format(timeout)])
+        # a timeout (an exception) counts as failed too
+        return any(failed)
     finally:
-        for p in borg_processes:
-            if p.poll() is not None:
-                p.kill()
-                try:
-                    p.communicate()
-                except (ValueError, OSError):
-                    p.wait()
-    return borg_failed
+        # the read ends of the pipes of borg processes that never started
+        for fd in stdin.values():
+            engine.close_quietly(fd)
 
 
 def main():
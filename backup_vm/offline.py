@@ -0,0 +1,79 @@
+import subprocess
+import tempfile
+import signal
+import sys
+import os
+
+
+class OfflineLock:
+
+    """Keeps a shut off domain from starting while its disks are backed up.
+
+    Opens each disk image read-only with qemu-nbd. qemu's image locking then
+    stops anything (including the domain's own qemu process) from opening the
+    images for writing until the lock is released, so the images can be
+    backed up directly, with no overlay to create and commit afterwards.
+
+    Attributes:
+        dom: The libvirt domain to lock.
+        disks: The Disks to lock.
+    """
+
+    def __init__(self, dom, disks):
+        self.dom = dom
+        self.disks = disks
+        self.tempdir = None
+        self.pids = []
+
+    def acquire(self):
+        """Locks the disk images of the domain.
+
+        Returns:
+            True if every disk was locked while the domain is shut off. If
+            not, nothing is left locked, and the disks should be backed up
+            some other way (e.g. with a snapshot).
+        """
+        self.tempdir = tempfile.TemporaryDirectory()
+        for disk in self.disks:
+            socket_path = os.path.join(self.tempdir.name, disk.target + ".sock")
+            pid_path = os.path.join(self.tempdir.name, disk.target + ".pid")
+            cmd = ["qemu-nbd", "--fork", "--read-only", "--pid-file", pid_path, "--socket", socket_path]
+            if disk.format != "unknown":
+                cmd.extend(["--format", disk.format])
+            try:
+                # --fork makes qemu-nbd exit once the image is open (& locked)
+                subprocess.run([*cmd, disk.path], stdout=subprocess.DEVNULL,
+                               stderr=subprocess.PIPE, check=True)
+                with open(pid_path) as f:
+                    self.pids.append(int(f.read()))
+            except FileNotFoundError:
+                print("Install qemu-nbd to back up shut off domains without a snapshot", file=sys.stderr)
+                self.release()
+                return False
+            except (subprocess.CalledProcessError, OSError, ValueError):
+                # most likely the domain was started & is using the image
+                self.release()
+                return False
+        if self.dom.isActive():
+            # started before we could lock all of its disks
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        self.pids = []
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
+            self.tempdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+        return False
@@ -7,6 +7,8 @@ import os
 import re
 from . import __version__
 
+DAEMON_SOCKET = "/run/backup-vm.sock"
+
 
 class Location:
     # see https://github.com/borgbackup/borg/blob/5e2de8b/src/borg/helpers/parseformat.py#L277
@@ -153,10 +155,17 @@ class Disk:
         target: The block device name on the guest (sda, xvdb, etc.)
         type: The type of storage backing the disk (file, block, etc.)
         path: The location of the disk storage (image file, block device, etc.)
+        backup_path: Where to read the disk's contents from for the backup, if
+            not path (e.g. a storage-level snapshot of it).
+        snapshot_stat: The os.stat_result of path from right before the
+            storage-level snapshot at backup_path was taken, if there is one.
     """
 
     def __init__(self, xml):
         self.xml = xml
+        self.failed = False
+        self.backup_path = None
+        self.snapshot_stat = None
         self.target = xml.find("target").get("dev")
         # sometimes there won't be a source entry, e.g. a cd drive without a
         # virtual cd in it
@@ -196,6 +205,84 @@ class Disk:
         yield from {d for d in map(cls, tree.findall("devices/disk")) if d.type is not None}
 
 
+def positive_int(text):
+    """Parses a positive integer.
+
+    Raises:
+        ValueError: The text is not a positive integer.
+    """
+    try:
+        value = int(text)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ValueError("expected a positive integer, got '{}'".format(text))
+    return value
+
+
+def positive_float(text):
+    """Parses a positive number (e.g. 0.5).
+
+    Raises:
+        ValueError: The text is not a positive number.
+    """
+    try:
+        value = float(text)
+    except ValueError:
+        value = 0
+    if not value > 0:
+        raise ValueError("expected a positive number, got '{}'".format(text))
+    return value
+
+
+def comma_list(text):
+    """Parses a comma-separated list (e.g. /,/var/lib/mysql).
+
+    Raises:
+        ValueError: The list is empty.
+    """
+    items = [item for item in text.split(",") if item]
+    if len(items) == 0:
+        raise ValueError("expected a comma-separated list, got '{}'".format(text))
+    return items
+
+
+def choice(*choices):
+    """Returns a function checking that a value is one of the given choices."""
+    def convert(text):
+        if text not in choices:
+            raise ValueError("invalid choice: '{}' (choose from {})".format(
+                text, ", ".join("'{}'".format(c) for c in choices)))
+        return text
+    return convert
+
+
+def parse_bytes(text):
+    """Parses a number of bytes with an optional binary suffix (K, M, G, T).
+
+    Args:
+        text: The number to parse, e.g. "64G" or "1048576".
+
+    Returns:
+        The number of bytes.
+
+    Raises:
+        ValueError: The number is malformed or zero.
+    """
+    m = re.fullmatch(r"(\d+)([KMGT]?)(?:i?B)?", text.strip(), re.IGNORECASE)
+    if m is None or int(m.group(1)) == 0:
+        raise ValueError("invalid size '{}'".format(text))
+    return int(m.group(1)) * 1024 ** " KMGT".index(m.group(2).upper() or " ")
+
+
+def parse_size(text):
+    """Parses a size like parse_bytes(), requiring a multiple of 512 bytes."""
+    size = parse_bytes(text)
+    if size % 512 != 0:
+        raise ValueError("size must be a multiple of 512 bytes")
+    return size
+
+
 # TODO: reimplement this mess with getopt (argparse doesn't support --borg-args stuff)
 class ArgumentParser(metaclass=ABCMeta):
 
@@ -205,7 +292,10 @@ class ArgumentParser(metaclass=ABCMeta):
     --borg-args, multiple archive locations, etc.).
     """
 
-    def __init__(self, default_name, args=sys.argv):
+    def __init__(self, default_name, args=sys.argv, cwd=None):
+        # what relative repository paths are relative to (if not the current
+        # directory, e.g. for a job submitted to backup-vm-daemon)
+        self.cwd = cwd
         try:
             self.prog = os.path.basename(args[0])
         except Exception:
@@ -213,6 +303,7 @@ class ArgumentParser(metaclass=ABCMeta):
         self.progress = sys.stdout.isatty()
         self.disks = set()
         self.archives = []
+        self.pending_option = None
         self.parse_args(args[1:])
 
     def parse_arg(self, arg, needs_archive=True, lookahead=None):
@@ -234,7 +325,7 @@ class ArgumentParser(metaclass=ABCMeta):
         if needs_archive and l is not None and l.path is not None and \
                 (l.proto == "file" or l._host is not None) and l.archive is not None:
             self.parsing_borg_args = False
-            l.canonicalize_path()
+            l.canonicalize_path(self.cwd)
             self.archives.append(l)
         elif arg == "--borg-args":
             if len(self.archives) == 0:
@@ -244,7 +335,7 @@ class ArgumentParser(metaclass=ABCMeta):
         elif not needs_archive and lookahead is not None and lookahead == "--borg-args" and \
                 l is not None and l.path is not None and (l.proto == "file" or l._host is not None):
             self.parsing_borg_args = False
-            l.canonicalize_path()
+            l.canonicalize_path(self.cwd)
             self.archives.append(l)
         elif self.parsing_borg_args:
             self.archives[-1].extra_args.append(arg)
@@ -254,13 +345,23 @@ class ArgumentParser(metaclass=ABCMeta):
             return False
         return True
 
+    def parse_value(self, option, value):
+        """Sets the attribute of an option in value_options from its value."""
+        attr, convert = self.value_options[option]
+        try:
+            setattr(self, attr, convert(value))
+        except ValueError as e:
+            self.error("argument {}: {}".format(option, e))
+
     def parse_args(self, args):
         if len(args) == 0:
             self.help()
             sys.exit(2)
         self.parsing_borg_args = False
         for arg, lookahead in itertools.zip_longest(args, args[1:]):
-            if arg.startswith("-") and not arg.startswith("--") and "=" not in arg:
+            # the value of an option can be negative (e.g. --priority -10)
+            if arg.startswith("-") and not arg.startswith("--") and "=" not in arg \
+                    and self.pending_option is None:
                 for c in arg[1:]:
                     if not self.parse_arg("-" + c, lookahead=lookahead):
                         self.error("unrecognized argument: '-{}'".format(c))
@@ -362,12 +463,103 @@ class BVMArgumentParser(ArgumentParser):
     well as those of backup-vm (domain).
     """
 
-    def __init__(self, default_name="backup-vm", args=sys.argv):
+    # options taking a value, mapped to the attribute they set and a function
+    # converting the value (raising ValueError if it is invalid)
+    value_options = {
+        "--jobs": ("jobs", positive_int),
+        "--shard-size": ("shard_size", parse_size),
+        "--backend": ("backend", choice("snapshot", "pull")),
+        "--commit-jobs": ("commit_jobs", positive_int),
+        "--commit-bandwidth": ("commit_bandwidth", parse_bytes),
+        "--read-bandwidth": ("read_bandwidth", parse_bytes),
+        "--cpu-limit": ("cpu_limit", positive_int),
+        "--freeze": ("freeze_mountpoints", comma_list),
+        "--freeze-timeout": ("freeze_timeout", positive_float),
+        "--borg-timeout": ("borg_timeout", positive_float),
+        "--metrics": ("metrics_path", str),
+        "--batch-jobs": ("batch_jobs", positive_int),
+        "--batch-filter": ("batch_filter", choice("active", "inactive", "persistent", "transient",
+                                                  "running", "paused", "shutoff", "autostart")),
+        "--pool-jobs": ("pool_jobs", positive_int),
+        "--repo-jobs": ("repo_jobs", positive_int),
+        "--socket": ("socket", str),
+        "--priority": ("priority", int),
+    }
+    short_options = {
+        "-j": "--jobs",
+    }
+
+    def __init__(self, default_name="backup-vm", args=sys.argv, cwd=None):
         self.domain = None
-        super().__init__(default_name, args)
+        self.per_disk = False
+        self.read_once = False
+        self.raw_view = False
+        self.backing_chain = False
+        self.skip_unchanged = False
+        self.drop_cache = False
+        self.storage_snapshots = True
+        self.incremental = False
+        self.jobs = os.cpu_count() or 1
+        self.shard_size = None
+        self.backend = "snapshot"
+        self.commit_jobs = 4
+        self.commit_bandwidth = None
+        self.read_bandwidth = None
+        self.cpu_limit = None
+        self.adaptive = False
+        self.freeze_mountpoints = None
+        self.freeze_timeout = 10
+        self.borg_timeout = None
+        self.metrics_path = None
+        self.batch = False
+        self.batch_jobs = 4
+        self.batch_filter = None
+        self.pool_jobs = 2
+        self.repo_jobs = 1
+        self.submit = False
+        self.wait = True
+        self.socket = DAEMON_SOCKET
+        self.priority = 0
+        super().__init__(default_name, args, cwd)
+        if self.metrics_path is not None:
+            self.metrics_path = os.path.join(cwd or os.getcwd(), self.metrics_path)
 
     def parse_arg(self, arg, *args, **kwargs):
-        if not super().parse_arg(arg, *args, **kwargs):
+        option = self.short_options.get(arg, arg)
+        if self.pending_option is not None:
+            self.parse_value(self.pending_option, arg)
+            self.pending_option = None
+        elif self.parsing_borg_args:
+            return super().parse_arg(arg, *args, **kwargs)
+        elif arg == "--per-disk":
+            self.per_disk = True
+        elif arg == "--read-once":
+            self.read_once = True
+        elif arg == "--raw-view":
+            self.raw_view = True
+        elif arg == "--backing-chain":
+            self.backing_chain = True
+        elif arg == "--skip-unchanged":
+            self.skip_unchanged = True
+        elif arg == "--drop-cache":
+            self.drop_cache = True
+        elif arg == "--adaptive":
+            self.adaptive = True
+        elif arg == "--no-storage-snapshots":
+            self.storage_snapshots = False
+        elif arg == "--incremental":
+            self.incremental = True
+        elif arg == "--batch":
+            self.batch = True
+        elif arg == "--submit":
+            self.submit = True
+        elif arg == "--no-wait":
+            self.wait = False
+        elif option in self.value_options:
+            self.pending_option = option
+        elif arg.split("=", 1)[0] in self.value_options:
+            self.parse_value(*arg.split("=", 1))
+        elif not super().parse_arg(arg, *args, **kwargs):
             if self.domain is None:
                 self.domain = arg
             else:
@@ -376,12 +568,22 @@ class BVMArgumentParser(ArgumentParser):
 
     def parse_args(self, args):
         super().parse_args(args)
-        if self.domain is None or len(self.archives) == 0:
+        if self.pending_option is not None:
+            self.error("argument {}: expected one argument".format(self.pending_option))
+        elif self.domain is None or len(self.archives) == 0:
             self.error("the following arguments are required: domain, archive")
 
     def help(self, short=False):
         print(dedent("""
-            usage: {} [-hpv] domain [disk [disk ...]] archive
+            usage: {} [-hpv] [--backend BACKEND] [--per-disk] [--read-once]
+                [--raw-view] [--backing-chain] [--skip-unchanged] [--drop-cache]
+                [--incremental] [-j JOBS] [--shard-size SIZE] [--commit-jobs JOBS]
+                [--commit-bandwidth RATE] [--read-bandwidth RATE] [--adaptive]
+                [--cpu-limit PERCENT] [--borg-timeout SECONDS] [--no-storage-snapshots]
+                [--freeze MOUNTPOINTS] [--freeze-timeout SECONDS] [--metrics PATH]
+                [--batch] [--batch-jobs JOBS] [--batch-filter FILTER]
+                [--pool-jobs JOBS] [--repo-jobs JOBS] [--submit] [--socket PATH]
+                [--priority N] [--no-wait] domain [disk [disk ...]] archive
                 [--borg-args ...] [archive [--borg-args ...] ...]
         """.format(self.prog).lstrip("\n")))
         if not short:
@@ -389,7 +591,8 @@ class BVMArgumentParser(ArgumentParser):
             Back up a libvirt-based VM using borg.
 
             positional arguments:
-              domain           libvirt domain to back up
+              domain           libvirt domain to back up (with --batch, a comma-separated
+                               list of wildcards, e.g. 'web-*,db')
               disk             a domain block device to back up (default: all disks)
               archive          a borg archive path (same format as borg create)
 
@@ -397,5 +600,149 @@ class BVMArgumentParser(ArgumentParser):
               -h, --help       show this help message and exit
               -v, --version    show version of the backup-vm package
               -p, --progress   force progress display even if stdout isn't a tty
+              --backend        how to get a consistent view of a running domain's
+                               disks: 'snapshot' (external snapshot, committed
+                               afterwards) or 'pull' (libvirt backup job over NBD,
+                               nothing to commit; implies --per-disk)
+              --no-storage-snapshots
+                               always use qcow2 overlays, even for disks on LVM
+                               thin pools, ZFS volumes or reflink filesystems
+              --freeze         only freeze these guest mountpoints (comma-separated,
+                               e.g. /,/var/lib/mysql) while snapshotting or starting
+                               a pull backup (default: all, if a guest agent is
+                               installed)
+              --freeze-timeout thaw the guest if that takes longer than this many
+                               seconds (default: 10)
+              --metrics        write the duration of each step, bytes read & archive
+                               sizes to PATH, as a Prometheus textfile (if it ends
+                               in .prom) or JSON lines
+              --per-disk       back up each disk to its own archive (name-sda, ...)
+              --read-once      read each disk once & stream it to every archive
+                               (implies --per-disk, needs borg >=1.2)
+              --raw-view       back up the contents of qcow2 images as raw images
+                               (e.g. sda.raw) for better deduplication (implies
+                               --read-once)
+              --backing-chain  back up the backing files of disks (e.g. golden images)
+                               once per repository, to archives of their own
+              --skip-unchanged don't back up disk images that haven't been modified
+                               since their last backup to the same repositories
+                               (implies --read-once)
+              --drop-cache     keep the disks being read out of the host's page cache
+                               (implies --read-once)
+              --incremental    only back up blocks changed since the last backup
+                               made with --incremental (implies --backend pull)
+              -j, --jobs       max borg processes to run at once with --per-disk
+                               (default: number of CPUs)
+              --shard-size     split disks larger than SIZE (e.g. 64G) into slices
+                               backed up in parallel (implies --per-disk)
+              --commit-jobs    max disks of a shut off domain to commit at once
+                               (default: 4)
+              --commit-bandwidth
+                               max bytes/s (e.g. 100M) to commit each disk's
+                               snapshot at
+              --read-bandwidth max bytes/s (e.g. 100M) to read disks at, in total
+                               (implies --read-once)
+              --adaptive       read disks slower while the domain's disk latency is
+                               high, faster while it is idle (implies --read-once)
+              --cpu-limit      max CPU time for borg to use, in % of one core
+                               (cgroup v2 cpu.max; otherwise borg is niced)
+              --borg-timeout   kill (& fail) any borg process still running after this
+                               many seconds (default: no limit)
+              --batch          back up every domain matching domain, several at once
+                               (archive names must contain {domain})
+              --batch-jobs     max domains to back up at once with --batch (default: 4)
+              --batch-filter   only back up domains that are active, inactive,
+                               persistent, transient, running, paused, shutoff or
+                               autostart with --batch
+              --pool-jobs      max domains to back up from one storage pool at once
+                               with --batch (default: 2)
+              --repo-jobs      max domains to back up to one repository at once with
+                               --batch (default: 1)
+              --submit         queue the backup in backup-vm-daemon instead of
+                               running it here, & wait until it's done
+              --socket         the socket of backup-vm-daemon to submit to
+                               (default: /run/backup-vm.sock)
+              --priority       the priority of the submitted backup; higher ones
+                               are run first (default: 0)
+              --no-wait        exit as soon as the backup is queued with --submit
               --borg-args ...  extra arguments passed straight to borg
             """).strip("\n"))
+
+
+class DaemonArgumentParser(ArgumentParser):
+
+    """Argument parser for backup-vm-daemon.
+
+    Unlike the other scripts, backup-vm-daemon takes no archives (they come
+    with each job instead).
+    """
+
+    value_options = {
+        "--socket": ("socket", str),
+        "--jobs": ("jobs", positive_int),
+        "--pool-jobs": ("pool_jobs", positive_int),
+        "--repo-jobs": ("repo_jobs", positive_int),
+        "--history": ("history", positive_int),
+    }
+    short_options = {
+        "-j": "--jobs",
+    }
+
+    def __init__(self, default_name="backup-vm-daemon", args=sys.argv):
+        self.socket = DAEMON_SOCKET
+        self.jobs = 4
+        self.pool_jobs = 2
+        self.repo_jobs = 1
+        self.history = 1000
+        super().__init__(default_name, args)
+
+    def parse_arg(self, arg, *args, **kwargs):
+        option = self.short_options.get(arg, arg)
+        if self.pending_option is not None:
+            self.parse_value(self.pending_option, arg)
+            self.pending_option = None
+        elif option in self.value_options:
+            self.pending_option = option
+        elif arg.split("=", 1)[0] in self.value_options:
+            self.parse_value(*arg.split("=", 1))
+        elif arg in {"-h", "--help"}:
+            self.help()
+            sys.exit()
+        elif arg in {"-v", "--version"}:
+            self.version()
+            sys.exit()
+        else:
+            return False
+        return True
+
+    def parse_args(self, args):
+        for arg in args:
+            if arg.startswith("-") and not arg.startswith("--") and len(arg) > 2:
+                self.error("unrecognized argument: '{}'".format(arg))
+            elif not self.parse_arg(arg):
+                self.error("unrecognized argument: '{}'".format(arg))
+        if self.pending_option is not None:
+            self.error("argument {}: expected one argument".format(self.pending_option))
+
+    def help(self, short=False):
+        print(dedent("""
+            usage: {} [-hv] [--socket PATH] [-j JOBS] [--pool-jobs JOBS]
+                [--repo-jobs JOBS] [--history JOBS]
+        """.format(self.prog).lstrip("\n")))
+        if not short:
+            print(dedent("""
+            Run backups submitted with backup-vm --submit.
+
+            optional arguments:
+              -h, --help       show this help message and exit
+              -v, --version    show version of the backup-vm package
+              --socket         the socket to listen for jobs on
+                               (default: /run/backup-vm.sock)
+              -j, --jobs       max jobs to run at once (default: 4)
+              --pool-jobs      max jobs to run on one storage pool at once
+                               (default: 2)
+              --repo-jobs      max jobs to run on one repository at once
+                               (default: 1)
+              --history        how many finished jobs to remember the state of
+                               (default: 1000)
+            """).strip("\n"))
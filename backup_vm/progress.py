@@ -0,0 +1,137 @@
+"""A progress line weighted by bytes, with a rolling throughput & ETA.
+
+Shared by the borg processes of a backup (grouped by repository) and the
+block commits afterwards (one group per disk), so both read the same:
+
+    backup progress: 42% (12.3 GiB/29.1 GiB, 210.5 MiB/s, ETA 0:01:22) | /backups/a 45% 105.2 MiB/s, ...
+"""
+
+from collections import deque
+import shutil
+import time
+
+
+def format_bytes(n):
+    for unit in ("B", "KiB", "MiB", "GiB", "TiB"):
+        if n < 1024 or unit == "TiB":
+            return "{:.1f} {}".format(n, unit) if unit != "B" else "{} B".format(int(n))
+        n /= 1024
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class Rate:
+
+    """Measures the rate a number increases at over the last window seconds."""
+
+    def __init__(self, window=30):
+        self.window = window
+        self.samples = deque()
+
+    def sample(self, value, now):
+        self.samples.append((now, value))
+        while len(self.samples) > 2 and now - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def rate(self):
+        """Returns the rate per second, or None if it can't be told yet."""
+        if len(self.samples) < 2:
+            return None
+        (t0, v0), (t1, v1) = self.samples[0], self.samples[-1]
+        return (v1 - v0) / (t1 - t0) if t1 > t0 else None
+
+
+class Progress:
+
+    """Tracks the progress of several tasks, each weighted by its size.
+
+    Attributes:
+        title: What is being done (e.g. "backup progress").
+        tasks: A dictionary mapping each task to its [group, weight, fraction
+            done].
+    """
+
+    def __init__(self, title, window=30):
+        self.title = title
+        self.window = window
+        self.tasks = {}
+        self.rates = {}
+        self.last_len = 0
+
+    def add(self, task, weight, group=None):
+        """Adds a task of weight bytes (e.g. a disk's allocated size)."""
+        group = task if group is None else group
+        self.tasks[task] = [group, weight or 0, 0]
+        self.rates.setdefault(group, Rate(self.window))
+
+    def update(self, task, fraction, weight=None):
+        """Updates how much of a task is done (& optionally its weight)."""
+        if weight is not None:
+            self.tasks[task][1] = weight
+        self.tasks[task][2] = min(max(fraction, 0), 1)
+
+    def totals(self, group=None):
+        """Returns the done & total bytes of a group (or of every task)."""
+        tasks = [t for t in self.tasks.values() if group is None or t[0] == group]
+        total = sum(weight for _, weight, _ in tasks)
+        if total == 0:
+            # nothing to weigh the tasks by, so count them instead
+            return sum(fraction for _, _, fraction in tasks), len(tasks), False
+        return sum(weight * fraction for _, weight, fraction in tasks), total, True
+
+    def summary(self, done, total, rate, in_bytes, eta=None):
+        """Formats how far along (part of) the tasks are.
+
+        Returns:
+            A tuple of the percentage done & the throughput & ETA.
+        """
+        percent = "{}%".format(int(100 * done / total) if total else 100)
+        if done >= total:
+            return percent, "done"
+        if eta is None and rate:
+            eta = (total - done) / rate
+        eta = "ETA ?" if eta is None else "ETA " + format_duration(eta)
+        if in_bytes and rate is not None:
+            return percent, "{}/s, {}".format(format_bytes(rate), eta)
+        return percent, eta
+
+    def line(self):
+        """Samples the current progress & formats it as one line."""
+        now = time.monotonic()
+        groups = sorted(set(t[0] for t in self.tasks.values()), key=str)
+        parts = []
+        etas = []
+        for group in groups:
+            done, total, in_bytes = self.totals(group)
+            rate = self.rates[group]
+            rate.sample(done, now)
+            if done < total:
+                etas.append((total - done) / rate.rate() if rate.rate() else None)
+            percent, details = self.summary(done, total, rate.rate(), in_bytes)
+            parts.append("{} {} {}".format(group, percent, details))
+        done, total, in_bytes = self.totals()
+        rates = [self.rates[group].rate() for group in groups]
+        rate = sum(rates) if None not in rates else None
+        eta = None
+        if rate and None not in etas:
+            # everything can't be done before the slowest group is, nor
+            # faster than all of them together get through the rest
+            eta = max(etas + [(total - done) / rate])
+        percent, details = self.summary(done, total, rate, in_bytes, eta)
+        if in_bytes:
+            details = "{}/{}, {}".format(format_bytes(done), format_bytes(total), details)
+        line = "{}: {} ({})".format(self.title, percent, details)
+        if len(groups) > 1:
+            line = " | ".join([line] + parts)
+        return line
+
+    def draw(self):
+        """Shows the progress line, overwriting the last one."""
+        # a line wrapping around the terminal can't be overwritten
+        line = self.line()[:shutil.get_terminal_size().columns - 1]
+        padded = line.ljust(self.last_len)
+        self.last_len = len(line)
+        print(padded, end="\u001b[{}D".format(len(padded)), flush=True)
@@ -0,0 +1,212 @@
+from xml.etree import ElementTree
+import contextlib
+import tempfile
+import sys
+import os
+from .lazy import lazy_import
+from .fanout import BLOCK_SIZE
+
+libvirt = lazy_import("libvirt")
+
+
+def socket_dir(parent="/var/lib/libvirt/qemu"):
+    """Creates a private directory qemu can create its NBD socket in.
+
+    The directory is put inside (and owned by the owner of) qemu's own state
+    directory if it exists, so the socket is only reachable by root and qemu.
+
+    Returns:
+        A tempfile.TemporaryDirectory.
+    """
+    if not os.path.isdir(parent):
+        return tempfile.TemporaryDirectory()
+    tempdir = tempfile.TemporaryDirectory(prefix="backup-vm-", dir=parent)
+    st = os.stat(parent)
+    try:
+        os.chown(tempdir.name, st.st_uid, st.st_gid)
+    except PermissionError:
+        pass
+    return tempdir
+
+
+def connect(socket_path, export, meta_contexts=()):
+    """Connects to an NBD export served over a Unix socket.
+
+    Args:
+        socket_path: The path of the Unix socket the NBD server listens on.
+        export: The name of the export to open.
+        meta_contexts: Names of NBD metadata contexts (e.g. base:allocation)
+            to request from the server for block status queries.
+
+    Returns:
+        A connected libnbd handle.
+
+    Raises:
+        OSError: The connection failed.
+    """
+    try:
+        import nbd
+    except ImportError:
+        print("Install the libnbd Python bindings (python3-libnbd) for pull-mode backups", file=sys.stderr)
+        sys.exit(1)
+    handle = nbd.NBD()
+    handle.set_export_name(export)
+    for context in meta_contexts:
+        handle.add_meta_context(context)
+    try:
+        handle.connect_unix(socket_path)
+    except nbd.Error as e:
+        raise OSError(e.errno, "Can't connect to {}: {}".format(socket_path, e.string)) from e
+    return handle
+
+
+def coalesce(extents):
+    """Merges extents that directly follow each other (& drops empty ones).
+
+    Returns:
+        A list of [offset, length] lists.
+    """
+    merged = []
+    for offset, length in extents:
+        if length == 0:
+            continue
+        if merged and merged[-1][0] + merged[-1][1] == offset:
+            merged[-1][1] += length
+        else:
+            merged.append([offset, length])
+    return merged
+
+
+def read_blocks(handle, extents, block_size=BLOCK_SIZE):
+    """Reads ranges of an NBD export sequentially in large blocks.
+
+    Extents that directly follow each other are read as one, so many small
+    ones still take few large reads.
+
+    Args:
+        handle: A connected libnbd handle.
+        extents: A list of (offset, length) tuples to read, in order.
+        block_size: The maximum size of each read.
+
+    Yields:
+        The contents of the extents, one after the other, in blocks of at most
+        block_size bytes. None of them reach past the end of an extent, so
+        nothing past the end of the export is read unless an extent does.
+    """
+    for offset, length in coalesce(extents):
+        end = offset + length
+        while offset < end:
+            count = min(block_size, end - offset)
+            yield handle.pread(count, offset)
+            offset += count
+
+
+class PullBackup:
+
+    """Exports the disks of a running domain over NBD using libvirt's backup API.
+
+    Starts a pull-mode backup job, which makes qemu serve a point-in-time view
+    of each disk over a local NBD socket while the guest keeps writing to the
+    original images. Unlike an external snapshot there is no overlay to commit
+    or pivot afterwards; stopping the job just discards the view.
+
+    If checkpoint is given, a new checkpoint (a persistent dirty bitmap in
+    each qcow2 image) is created along with the backup. If incremental is
+    given, the bitmap of that earlier checkpoint is exported along with each
+    disk, listing the blocks changed since then.
+
+    Attributes:
+        dom: The libvirt domain to back up.
+        disks: The Disks to export.
+        socket_path: The path of the Unix socket the NBD server listens on.
+        quiesce: The freeze.Freeze to hold while the job is started (which is
+            when the point-in-time view is taken), or None to not freeze the
+            guest.
+    """
+
+    def __init__(self, dom, disks, disks_to_backup, checkpoint=None, incremental=None, quiesce=None):
+        self.dom = dom
+        self.disks = disks
+        self.disks_to_backup = disks_to_backup
+        self.checkpoint = checkpoint
+        self.incremental = incremental
+        self.quiesce = quiesce
+        self.tempdir = socket_dir()
+        self.socket_path = os.path.join(self.tempdir.name, "nbd.sock")
+        self.started = False
+
+    def generate_backup_xml(self):
+        root_xml = ElementTree.Element("domainbackup")
+        root_xml.attrib["mode"] = "pull"
+        if self.incremental is not None:
+            incremental_xml = ElementTree.SubElement(root_xml, "incremental")
+            incremental_xml.text = self.incremental
+        server_xml = ElementTree.SubElement(root_xml, "server")
+        server_xml.attrib["transport"] = "unix"
+        server_xml.attrib["socket"] = self.socket_path
+        disks_xml = ElementTree.SubElement(root_xml, "disks")
+        for disk in self.disks:
+            disk_xml = ElementTree.SubElement(disks_xml, "disk")
+            disk_xml.attrib["name"] = disk.target
+            disk_xml.attrib["backup"] = "yes" if disk in self.disks_to_backup else "no"
+        return ElementTree.tostring(root_xml).decode("utf-8")
+
+    def generate_checkpoint_xml(self):
+        root_xml = ElementTree.Element("domaincheckpoint")
+        name_xml = ElementTree.SubElement(root_xml, "name")
+        name_xml.text = self.checkpoint
+        desc_xml = ElementTree.SubElement(root_xml, "description")
+        desc_xml.text = "Checkpoint used for incremental backups of " + self.dom.name()
+        disks_xml = ElementTree.SubElement(root_xml, "disks")
+        for disk in self.disks:
+            disk_xml = ElementTree.SubElement(disks_xml, "disk")
+            disk_xml.attrib["name"] = disk.target
+            disk_xml.attrib["checkpoint"] = "bitmap" if disk in self.disks_to_backup else "no"
+        return ElementTree.tostring(root_xml).decode("utf-8")
+
+    def start(self):
+        """Starts the backup job.
+
+        Raises:
+            libvirt.libvirtError: The job could not be started, e.g. because
+                the bitmap of the incremental checkpoint is missing.
+        """
+        checkpoint_xml = self.generate_checkpoint_xml() if self.checkpoint is not None else None
+        backup_xml = self.generate_backup_xml()
+        with contextlib.ExitStack() as stack:
+            if self.quiesce is not None:
+                stack.enter_context(self.quiesce)
+            self.dom.backupBegin(backup_xml, checkpoint_xml)
+        self.started = True
+
+    def export_name(self, disk):
+        return disk.target
+
+    def bitmap_context(self, disk):
+        """Returns the NBD metadata context listing the disk's changed blocks."""
+        return "qemu:dirty-bitmap:backup-" + disk.target
+
+    def connect(self, disk, meta_contexts=()):
+        return connect(self.socket_path, self.export_name(disk), meta_contexts)
+
+    def uri(self, disk):
+        return "nbd+unix:///{}?socket={}".format(self.export_name(disk), self.socket_path)
+
+    def __enter__(self):
+        if not self.started:
+            try:
+                self.start()
+            except libvirt.libvirtError:
+                print("Failed to start backup job", file=sys.stderr)
+                sys.exit(1)
+        return self
+
+    def __exit__(self, *args):
+        if self.started:
+            try:
+                self.dom.abortJob()
+            except libvirt.libvirtError:
+                print("Failed to stop backup job", file=sys.stderr)
+            self.started = False
+        self.tempdir.cleanup()
+        return False
@@ -0,0 +1,134 @@
+import subprocess
+import tempfile
+import signal
+import json
+import os
+from . import builder
+from . import fanout
+from . import pull
+
+# qemu-img info fields needed to recreate an image with the same layout, and
+# the qemu-img create options they correspond to
+REBUILD_OPTIONS = {
+    "cluster-size": "cluster_size",
+    "compat": "compat",
+    "lazy-refcounts": "lazy_refcounts",
+    "refcount-bits": "refcount_bits",
+    "extended-l2": "extended_l2",
+    "compression-type": "compression_type",
+}
+
+
+def qemu_img(*args):
+    """Runs a qemu-img subcommand with JSON output and returns the result.
+
+    The images are opened with --force-share, as they are usually in use by
+    the domain (as the read-only base of the overlay) or by an OfflineLock.
+    """
+    out = subprocess.run(["qemu-img", args[0], "--force-share", "--output=json", *args[1:]],
+                         stdout=subprocess.PIPE, check=True).stdout
+    return json.loads(out.decode("utf-8"))
+
+
+def rebuild_metadata(info):
+    """Picks out what is needed to rebuild a qcow2 image from its raw contents.
+
+    Args:
+        info: The output of `qemu-img info --output=json` for the image.
+
+    Returns:
+        A dictionary with the image's virtual size, backing file (if any) and
+        the qemu-img create options (-o) giving it the same layout.
+    """
+    specific = info.get("format-specific", {}).get("data", {})
+    options = {}
+    if "cluster-size" in info:
+        options["cluster_size"] = info["cluster-size"]
+    for field, option in REBUILD_OPTIONS.items():
+        if field in specific:
+            options[option] = specific[field]
+    return {
+        "format": "qcow2",
+        "virtual-size": info["virtual-size"],
+        "backing-filename": info.get("backing-filename"),
+        "options": options,
+    }
+
+
+class RawView:
+
+    """The guest-visible contents of a qcow2 image, as a raw image.
+
+    Archiving the qcow2 file itself means borg sees the image's metadata and
+    a cluster layout that moves around as the guest writes, which is bad for
+    deduplication. Instead, this serves the image with a read-only qemu-nbd,
+    and uses its allocation map (from `qemu-img map`) to only read the
+    clusters that contain data; everything else reads as zeros without
+    touching the disk. The result has the same layout as the virtual disk
+    every time, so unchanged data deduplicates between backups.
+
+    The layout options of the image are kept in metadata, so it can be
+    rebuilt with `qemu-img convert -O qcow2 -o ...` on restore.
+
+    Attributes:
+        disk: The Disk the image belongs to.
+        path: The path of the qcow2 image.
+        metadata: See rebuild_metadata().
+        mapping: A list of (offset, length, data) tuples covering the whole
+            virtual disk, where data is False for ranges reading as zeros.
+    """
+
+    def __init__(self, disk, path):
+        self.disk = disk
+        self.path = path
+        self.tempdir = None
+        self.pid = None
+        self.handle = None
+
+    def __enter__(self):
+        self.metadata = rebuild_metadata(qemu_img("info", "-f", "qcow2", self.path))
+        self.mapping = [(e["start"], e["length"], e["data"] and not e.get("zero", False))
+                        for e in qemu_img("map", "-f", "qcow2", self.path)]
+        self.tempdir = tempfile.TemporaryDirectory()
+        socket_path = os.path.join(self.tempdir.name, "nbd.sock")
+        pid_path = os.path.join(self.tempdir.name, "nbd.pid")
+        try:
+            # --fork makes qemu-nbd exit once the socket is ready
+            subprocess.run(["qemu-nbd", "--fork", "--read-only", "--force-share", "--pid-file", pid_path,
+                            "--socket", socket_path, "--format", "qcow2", self.path], check=True)
+            with open(pid_path) as f:
+                self.pid = int(f.read())
+            self.handle = pull.connect(socket_path, "")
+        except BaseException:
+            # (including the SystemExit of pull.connect() if libnbd is missing)
+            self.__exit__(None, None, None)
+            raise
+        self.uri = "nbd+unix:///?socket=" + socket_path
+        return self
+
+    def __exit__(self, *args):
+        self.handle = None
+        if self.pid is not None:
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            self.pid = None
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
+            self.tempdir = None
+        return False
+
+    def member(self):
+        """Returns a builder.Member standing for the raw view."""
+        allocated = sum(length for offset, length, data in self.mapping if data)
+        return builder.Member(self.disk, self.disk.target + ".raw", self.uri, 0,
+                              self.metadata["virtual-size"], None, allocated)
+
+    def blocks(self, block_size=fanout.BLOCK_SIZE):
+        """Generates the raw contents of the image."""
+        for offset, length, data in self.mapping:
+            if data:
+                yield from pull.read_blocks(self.handle, [(offset, length)], block_size)
+            else:
+                yield from fanout.zeros(length, block_size)
@@ -1,55 +1,168 @@
 from xml.etree import ElementTree
 import subprocess
-import time
+import threading
+import asyncio
 import sys
+import re
 import os
-import libvirt
+from .lazy import lazy_import
+from . import storage
+from . import errors
+from . import engine
+from .freeze import Freeze
+from .metrics import Metrics
+from .progress import Progress
 
+libvirt = lazy_import("libvirt")
 
-def error_handler(ctx, err):
-    if err[0] not in libvirt.ignored_errors:
-        print("libvirt: error code {0}: {2}".format(*err), file=sys.stderr)
 
+def start_event_loop():
+    """Runs libvirt's default event loop in a background thread.
 
-libvirt.ignored_errors = []
-libvirt.registerErrorHandler(error_handler, None)
+    This has to be called before opening a connection to libvirt for domain
+    events (e.g. block job completion) to be delivered. It also installs the
+    error handler that hides errors expected by the caller (see the errors
+    module).
+    """
+    libvirt.registerErrorHandler(errors.error_handler, None)
+    libvirt.virEventRegisterDefaultImpl()
+
+    def run():
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    threading.Thread(target=run, daemon=True).start()
 
 
 class Snapshot:
 
-    def __init__(self, dom, disks, progress=True):
+    """Takes a crash-consistent snapshot of a domain's disks for the backup.
+
+    Disks on storage with cheap snapshots of its own (see the storage module)
+    get a storage-level snapshot, which the backup is made from (the disk's
+    backup_path). The rest get an external qcow2 overlay, which the domain
+    writes to during the backup and which is committed back afterwards.
+    Both are created while the guest's filesystems are frozen, if a guest
+    agent is installed; everything that can be prepared beforehand is (and
+    storage-level snapshots are only made readable afterwards), to keep the
+    guest frozen as briefly as possible.
+
+    Attributes:
+        quiesce: The freeze.Freeze of the guest's filesystems (freeze_mountpoints
+            & freeze_timeout are passed on to it).
+        frozen_for: How many seconds the guest was frozen for, or None if it
+            wasn't.
+        metrics: The metrics.Metrics to record the time taken by each step
+            (& the number of retries) in.
+    """
+
+    def __init__(self, dom, disks, progress=True, commit_jobs=4, commit_bandwidth=None, native_snapshots=True,
+                 freeze_mountpoints=None, freeze_timeout=10, metrics=None):
         self.dom = dom
         self.disks = disks
         self.progress = progress
+        self.commit_jobs = commit_jobs
+        self.commit_bandwidth = commit_bandwidth
+        self.metrics = metrics if metrics is not None else Metrics(dom.name())
+        self.quiesce = Freeze(dom, freeze_mountpoints, freeze_timeout, self.metrics)
+        self.native_snapshots = []
+        if native_snapshots:
+            for disk in disks:
+                if disk.snapshot_path is not None:
+                    native_snapshot = storage.detect(disk)
+                    if native_snapshot is not None:
+                        self.native_snapshots.append(native_snapshot)
         self.snapshotted = False
         self._do_snapshot()
 
+    def create_native_snapshots(self):
+        created = []
+        for native_snapshot in self.native_snapshots:
+            disk = native_snapshot.disk
+            try:
+                # taken first, so any write after the snapshot counts as a
+                # change (see fingerprint.Index.identify())
+                snapshot_stat = os.stat(disk.path)
+                native_snapshot.create()
+            except (subprocess.CalledProcessError, OSError):
+                # fall back to a qcow2 overlay
+                continue
+            disk.backup_path = native_snapshot.path
+            disk.snapshot_stat = snapshot_stat
+            disk.snapshot_path = None
+            created.append(native_snapshot)
+        self.native_snapshots = created
+
+    def expose_native_snapshots(self):
+        """Makes the storage-level snapshots readable (once the guest is thawed).
+
+        Returns:
+            False if any of them couldn't be.
+        """
+        for native_snapshot in self.native_snapshots:
+            try:
+                native_snapshot.expose()
+            except (subprocess.CalledProcessError, OSError):
+                print("Couldn't set up {} snapshot of disk '{}'".format(
+                    native_snapshot.kind, native_snapshot.disk.target).ljust(65), file=sys.stderr)
+                return False
+        return True
+
+    def remove_native_snapshots(self):
+        for native_snapshot in self.native_snapshots:
+            try:
+                native_snapshot.remove()
+            except (subprocess.CalledProcessError, OSError):
+                print("Couldn't remove {} snapshot '{}'".format(
+                    native_snapshot.kind, native_snapshot.path).ljust(65), file=sys.stderr)
+        self.native_snapshots = []
+
+    @property
+    def frozen_for(self):
+        return self.quiesce.frozen_for
+
     def _do_snapshot(self):
         snapshot_flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA \
             | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC \
             | libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY
-        libvirt.ignored_errors = [
-            libvirt.VIR_ERR_OPERATION_INVALID,
-            libvirt.VIR_ERR_ARGUMENT_UNSUPPORTED
-        ]
-        try:
-            self.dom.fsFreeze()
-            guest_agent_installed = True
-        except libvirt.libvirtError:
-            guest_agent_installed = False
-        libvirt.ignored_errors = []
-        try:
-            snapshot_xml = self.generate_snapshot_xml()
-            self.dom.snapshotCreateXML(snapshot_xml, snapshot_flags)
-        except libvirt.libvirtError:
-            print("Failed to create domain snapshot", file=sys.stderr)
-            sys.exit(1)
-        finally:
-            if guest_agent_installed:
-                self.dom.fsThaw()
-        self.snapshotted = True
+        # prepare everything for the snapshot before freezing the guest,
+        # assuming every storage-level snapshot will work out
+        native_disks = {native_snapshot.disk for native_snapshot in self.native_snapshots}
+        overlays = [d for d in self.disks if d.snapshot_path is not None and d not in native_disks]
+        for disk in overlays:
+            if os.path.exists(disk.snapshot_path):
+                print("Snapshot '{}' already exists (left over from an earlier backup?)".format(
+                    disk.snapshot_path), file=sys.stderr)
+                sys.exit(1)
+        snapshot_xml = self.generate_snapshot_xml(native_disks)
+        with self.metrics.phase("snapshot"):
+            self.quiesce.freeze()
+            try:
+                self.create_native_snapshots()
+                if len(self.native_snapshots) != len(native_disks):
+                    # some disks fell back to qcow2 overlays
+                    snapshot_xml = self.generate_snapshot_xml()
+                if any(disk.snapshot_path is not None for disk in self.disks):
+                    self.dom.snapshotCreateXML(snapshot_xml, snapshot_flags)
+            except libvirt.libvirtError:
+                print("Failed to create domain snapshot", file=sys.stderr)
+                self.remove_native_snapshots()
+                sys.exit(1)
+            finally:
+                self.quiesce.thaw()
+            self.snapshotted = True
+            if not self.expose_native_snapshots():
+                # the snapshot can't be backed up, so undo all of it
+                self.__exit__(None, None, None)
+                sys.exit(1)
 
-    def generate_snapshot_xml(self):
+    def generate_snapshot_xml(self, native_disks=()):
+        """Builds the XML of the snapshot.
+
+        Args:
+            native_disks: Disks getting a storage-level snapshot instead of a
+                qcow2 overlay, if they still have a snapshot_path.
+        """
         root_xml = ElementTree.Element("domainsnapshot")
         name_xml = ElementTree.SubElement(root_xml, "name")
         name_xml.text = self.dom.name() + "-tempsnap"
@@ -60,7 +173,7 @@ class Snapshot:
         disks_xml = ElementTree.SubElement(root_xml, "disks")
         for disk in self.disks:
             disk_xml = ElementTree.SubElement(disks_xml, "disk")
-            if disk.snapshot_path is not None:
+            if disk.snapshot_path is not None and disk not in native_disks:
                 disk_xml.attrib["name"] = disk.path
                 source_xml = ElementTree.SubElement(disk_xml, "source")
                 source_xml.attrib["file"] = disk.snapshot_path
@@ -71,96 +184,271 @@ class Snapshot:
                 disk_xml.attrib["snapshot"] = "no"
         return ElementTree.tostring(root_xml).decode("utf-8")
 
-    def blockcommit(self, disks):
-        for idx, disk in enumerate(disks):
-            for commit_try in range(3):
-                disk.failed = False
-                if self.dom.blockCommit(
-                    disk.target, None, None,
-                    flags=libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
-                        | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW) < 0:
-                    print("Failed to start block commit for disk '{}'".format(
-                        disk.target).ljust(65), file=sys.stderr)
-                    disk.failed = True
+    def status(self, msg):
+        """Shows a status line, overwriting the previous one."""
+        msg = msg.ljust(65)
+        print(msg, end="\u001b[{}D".format(len(msg)), flush=True)
+
+    def commit_progress(self, title, disks):
+        """Makes a Progress for committing disks, weighed by their overlays' sizes.
+
+        For live commits, the sizes are replaced by the actual amount to
+        commit once libvirt reports it.
+        """
+        progress = Progress(title)
+        for disk in disks:
+            try:
+                size = os.path.getsize(disk.snapshot_path)
+            except OSError:
+                size = None
+            progress.add(disk.target, size)
+        return progress
+
+    def register_block_job_events(self, events):
+        """Forwards block job events for the domain to a queue.
+
+        Args:
+            events: A dictionary mapping disk targets to the
+                engine.ThreadsafeQueues to put their job statuses into.
+
+        Returns:
+            The callback ID to deregister the callback with, or None if events
+            aren't available (in which case block jobs are only polled).
+        """
+        def callback(conn, dom, disk, type, status, opaque):
+            # called from libvirt's event loop thread
+            if disk in opaque:
+                opaque[disk].put_threadsafe(status)
+
+        try:
+            return self.dom.connect().domainEventRegisterAny(
+                self.dom, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2, callback, events)
+        except (libvirt.libvirtError, AttributeError):
+            return None
+
+    def start_blockcommit(self, disk):
+        disk.failed = False
+        try:
+            failed = self.dom.blockCommit(
+                disk.target, None, None, self.commit_bandwidth or 0,
+                libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE
+                | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW
+                | libvirt.VIR_DOMAIN_BLOCK_COMMIT_BANDWIDTH_BYTES) < 0
+        except libvirt.libvirtError:
+            failed = True
+        if failed:
+            print("Failed to start block commit for disk '{}'".format(
+                disk.target).ljust(65), file=sys.stderr)
+            disk.failed = True
+        return not failed
+
+    def pivot(self, disk):
+        try:
+            failed = self.dom.blockJobAbort(disk.target, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT) < 0
+        except libvirt.libvirtError:
+            failed = True
+        if failed:
+            disk.failed = True
+            return False
+        disk.failed = False
+        try:
+            os.remove(disk.snapshot_path)
+        except PermissionError:
+            print("Couldn't delete snapshot image '{}', please run as root".format(
+                disk.snapshot_path).ljust(65), file=sys.stderr)
+        return True
+
+    async def wait_for_block_job(self, disk, events, progress):
+        """Waits for the block job of a disk to be ready to pivot (or fail).
+
+        Args:
+            disk: The Disk with a running block commit.
+            events: The engine.ThreadsafeQueue its job statuses are put into,
+                or None if block job events aren't available.
+            progress: The Progress to keep the progress of the job updated in.
+
+        Returns:
+            True if the job is ready, False if it failed.
+        """
+        while True:
+            if events is None:
+                await asyncio.sleep(1)
+            else:
                 try:
-                    while True:
-                        info = self.dom.blockJobInfo(disk.target, 0)
-                        if info is not None and self.progress:
-                            progress = (idx + info["cur"] / info["end"]) / len(disks)
-                            print("block commit progress ({}): {}%".format(
-                                disk.target, int(100 * progress)).ljust(65), end="\u001b[65D")
-                        elif info is None:
-                            print("Failed to query block jobs for disk '{}'".format(
-                                disk.target).ljust(65), file=sys.stderr)
-                            disk.failed = True
-                            break
-                        if info["cur"] == info["end"]:
-                            break
-                        time.sleep(1)
-                    if not disk.failed:
-                        break
-                finally:
-                    if self.progress:
-                        print("...pivoting...".ljust(65), end="\u001b[65D")
-                    if self.dom.blockJobAbort(disk.target, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT) < 0:
-                        suffix = "retrying..." if commit_try != 2 else "it may be in an inconsistent state"
-                        print("Pivot failed for disk '{}', {}".format(disk.target, suffix).ljust(65), file=sys.stderr)
-                        disk.failed = True
-                        time.sleep(5)
-                    else:
-                        try:
-                            os.remove(disk.snapshot_path)
-                        except PermissionError:
-                            print("Couldn't delete snapshot image '{}', please run as root".format(
-                                disk.snapshot_path).ljust(65), file=sys.stderr)
-                        break
+                    status = await asyncio.wait_for(events.get(), 1)
+                except asyncio.TimeoutError:
+                    status = None
+                if status == libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+                    return True
+                elif status in {libvirt.VIR_DOMAIN_BLOCK_JOB_FAILED, libvirt.VIR_DOMAIN_BLOCK_JOB_CANCELED}:
+                    return False
+            info = self.dom.blockJobInfo(disk.target, 0)
+            if not info:
+                print("Failed to query block jobs for disk '{}'".format(
+                    disk.target).ljust(65), file=sys.stderr)
+                return False
+            progress.update(disk.target, info["cur"] / info["end"] if info["end"] else 0, info["end"] or None)
+            # without events, we have to guess when the job is ready
+            if events is None and info["end"] and info["cur"] == info["end"]:
+                return True
 
-    def offline_commit(self, disks):
+    async def commit_live(self, disk, events, progress):
+        """Commits the overlay of one disk & pivots back to the original.
+
+        Pivoting & restarting failed jobs are tried 3 times in total.
+        """
+        with self.metrics.phase("commit", disk=disk.target):
+            await self._commit_live(disk, events, progress)
+
+    async def _commit_live(self, disk, events, progress):
+        tries = 1
+        ready = False
+        if not self.start_blockcommit(disk):
+            return
+        while True:
+            if not ready:
+                ready = await self.wait_for_block_job(disk, events, progress)
+            if ready:
+                progress.update(disk.target, 1)
+                if self.progress:
+                    self.status("...pivoting {}...".format(disk.target))
+                with self.metrics.phase("pivot", disk=disk.target):
+                    pivoted = self.pivot(disk)
+                if pivoted:
+                    return
+                suffix = "retrying..." if tries < 3 else "it may be in an inconsistent state"
+                print("Pivot failed for disk '{}', {}".format(disk.target, suffix).ljust(65), file=sys.stderr)
+            if tries >= 3:
+                disk.failed = True
+                return
+            tries += 1
+            self.metrics.add("retries", 1, phase="pivot" if ready else "commit", disk=disk.target)
+            if ready:
+                # the job stays ready, so only the pivot needs another try
+                await asyncio.sleep(1)
+            elif not self.start_blockcommit(disk):
+                return
+
+    def blockcommit(self, disks):
+        """Commits the overlays of a running domain & pivots back to the originals.
+
+        The commits of all disks are started at once, and each disk is pivoted
+        as soon as libvirt reports its job is ready. The jobs are also polled
+        every second to show their progress (and to tell when they're ready
+        if block job events aren't available).
+        """
+        engine.run(self._blockcommit(disks))
+
+    async def _blockcommit(self, disks):
+        events = {disk.target: engine.ThreadsafeQueue() for disk in disks}
+        callback_id = self.register_block_job_events(events)
+        progress = self.commit_progress("block commit progress", disks)
+        redraw = None
         if self.progress:
-            print("image commit progress: 0%".ljust(65), end="\u001b[65D")
-        else:
+            redraw = asyncio.ensure_future(engine.every(1, progress.draw))
+        try:
+            await engine.gather_limited(
+                [self.commit_live(d, events[d.target] if callback_id is not None else None, progress)
+                 for d in disks])
+        finally:
+            if redraw is not None:
+                redraw.cancel()
+                await asyncio.wait([redraw])
+            if callback_id is not None:
+                self.dom.connect().domainEventDeregisterAny(callback_id)
+
+    async def start_offline_commit(self, disk):
+        cmd = ["qemu-img", "commit", "-p"]
+        if self.commit_bandwidth is not None:
+            cmd.extend(["-r", str(self.commit_bandwidth)])
+        disk.failed = False
+        return await asyncio.create_subprocess_exec(*cmd, disk.snapshot_path, stdout=subprocess.PIPE)
+
+    def finish_offline_commit(self, disk):
+        # restore the original image in domain definition
+        # this is done automatically when pivoting for live commit
+        new_xml = ElementTree.tostring(disk.xml).decode("utf-8")
+        try:
+            self.dom.updateDeviceFlags(new_xml)
+        except libvirt.libvirtError:
+            print("Device flags update failed for disk '{}'".format(
+                disk.target).ljust(65), file=sys.stderr)
+            print("Try replacing the path manually with 'virsh edit'", file=sys.stderr)
+            disk.failed = True
+            return
+        try:
+            os.remove(disk.snapshot_path)
+        except PermissionError:
+            print("Couldn't delete snapshot image '{}', please run as root".format(
+                disk.snapshot_path).ljust(65), file=sys.stderr)
+
+    async def commit_offline(self, disk, progress):
+        """Commits the overlay of one disk of a shut off domain (in up to 3 tries)."""
+        with self.metrics.phase("commit", disk=disk.target):
+            await self._commit_offline(disk, progress)
+
+    async def _commit_offline(self, disk, progress):
+        for tries in range(1, 4):
+            proc = await self.start_offline_commit(disk)
+            buf = b""
+
+            def parse_progress(data):
+                nonlocal buf
+                # progress is printed like "    (12.34/100%)\r"
+                *lines, buf = re.split(b"[\r\n]", buf + data)
+                for line in lines:
+                    m = re.search(rb"\((\d+(?:\.\d+)?)/100%\)", line)
+                    if m is not None:
+                        progress.update(disk.target, float(m.group(1)) / 100)
+
+            try:
+                await engine.read_chunks(proc.stdout, parse_progress)
+                await proc.wait()
+            finally:
+                if proc.returncode is None:
+                    proc.kill()
+            if proc.returncode == 0:
+                progress.update(disk.target, 1)
+                self.finish_offline_commit(disk)
+                return
+            elif tries < 3:
+                print("Commit failed for disk '{}', retrying...".format(
+                    disk.target).ljust(65), file=sys.stderr)
+                self.metrics.add("retries", 1, phase="commit", disk=disk.target)
+                progress.update(disk.target, 0)
+            else:
+                print("Commit failed for disk '{}'".format(disk.target).ljust(65), file=sys.stderr)
+                disk.failed = True
+
+    def offline_commit(self, disks):
+        """Commits the overlays of a shut off domain with qemu-img.
+
+        Up to commit_jobs disks are committed at once. The progress of each
+        one is read from the output of `qemu-img commit -p`.
+        """
+        if not self.progress:
             print("committing disk images")
-        for idx, disk in enumerate(disks):
-            for commit_try in range(3):
-                disk.failed = False
-                try:
-                    subprocess.run(["qemu-img", "commit", disk.snapshot_path],
-                                   stdout=subprocess.DEVNULL, check=True)
-                    # restore the original image in domain definition
-                    # this is done automatically when pivoting for live commit
-                    new_xml = ElementTree.tostring(disk.xml).decode("utf-8")
-                    try:
-                        self.dom.updateDeviceFlags(new_xml)
-                    except libvirt.libvirtError:
-                        print("Device flags update failed for disk '{}'".format(
-                            disk.target).ljust(65), file=sys.stderr)
-                        print("Try replacing the path manually with 'virsh edit'", file=sys.stderr)
-                        disk.failed = True
-                        continue
-                    try:
-                        os.remove(disk.snapshot_path)
-                    except PermissionError:
-                        print("Couldn't delete snapshot image '{}', please run as root".format(
-                            disk.snapshot_path).ljust(65), file=sys.stderr)
-                    if self.progress:
-                        progress = (idx + 1) / len(disks)
-                        print("image commit progress ({}): {}%".format(
-                            disk.target, int(100 * progress)).ljust(65), end="\u001b[65D")
-                    break
-                except FileNotFoundError:
-                    # not very likely as the qemu-img tool is normally installed
-                    # along with the libvirt/virsh stuff
-                    print("Install qemu-img to commit changes offline".ljust(65), file=sys.stderr)
-                    disk.failed = True
-                    return
-                except subprocess.CalledProcessError:
-                    if commit_try == 2:
-                        failed_str = "Commit failed for disk '{}', retrying..."
-                    else:
-                        failed_str = "Commit failed for disk '{}'"
-                    print(failed_str.format(disk.target).ljust(65), file=sys.stderr)
-                    disk.failed = True
-                    time.sleep(5)
+        progress = self.commit_progress("image commit progress", disks)
+
+        async def commit_all():
+            redraw = None
+            if self.progress:
+                redraw = asyncio.ensure_future(engine.every(1, progress.draw))
+            try:
+                await engine.gather_limited([self.commit_offline(d, progress) for d in disks], self.commit_jobs)
+            finally:
+                if redraw is not None:
+                    redraw.cancel()
+                    await asyncio.wait([redraw])
+
+        try:
+            engine.run(commit_all())
+        except FileNotFoundError:
+            # not very likely as the qemu-img tool is normally installed
+            # along with the libvirt/virsh stuff
+            print("Install qemu-img to commit changes offline".ljust(65), file=sys.stderr)
+            for disk in disks:
+                disk.failed = True
 
     def __enter__(self):
         return self
@@ -168,8 +456,11 @@ class Snapshot:
     def __exit__(self, *args):
         if not self.snapshotted:
             return False
+        self.remove_native_snapshots()
         disks_to_backup = [x for x in self.disks if x.snapshot_path is not None]
-        if self.dom.isActive():
+        if len(disks_to_backup) == 0:
+            pass
+        elif self.dom.isActive():
             # the domain is online. we can use libvirt's blockcommit feature
             # to commit the contents & automatically pivot afterwards
             self.blockcommit(disks_to_backup)
@@ -0,0 +1,249 @@
+import subprocess
+import tempfile
+import fcntl
+import time
+import os
+
+
+class NativeSnapshot:
+
+    """A storage-level snapshot of a single disk.
+
+    Subclasses implement snapshots for one kind of storage. They are created
+    while the guest's filesystems are frozen (if possible), just like the qcow2
+    overlays, but as the original disk keeps being written to directly there
+    is nothing to commit afterwards; the snapshot is simply dropped.
+
+    Only the point-in-time snapshot itself is taken by create(), while the
+    guest is frozen. Whatever else it takes to read it (e.g. activating it &
+    waiting for udev to create its device node) is left to expose(), which is
+    called once the guest has been thawed.
+
+    Attributes:
+        disk: The Disk the snapshot is of.
+        path: The path of the snapshot (block device or file) to back up from,
+            once it has been exposed.
+    """
+
+    kind = None
+
+    def __init__(self, disk):
+        self.disk = disk
+        self.path = None
+
+    @classmethod
+    def detect(cls, disk):
+        """Checks if the storage under a disk supports this kind of snapshot.
+
+        Returns:
+            An (uncreated) snapshot of the disk, or None if it's not supported.
+        """
+        raise NotImplementedError
+
+    def create(self):
+        """Creates the snapshot.
+
+        Raises:
+            subprocess.CalledProcessError, OSError: The snapshot couldn't be
+                created (nothing is left behind).
+        """
+        raise NotImplementedError
+
+    def expose(self):
+        """Makes the snapshot readable at path.
+
+        Raises:
+            subprocess.CalledProcessError, OSError: The snapshot couldn't be
+                exposed (it still has to be removed).
+        """
+        pass
+
+    def remove(self):
+        """Removes the snapshot.
+
+        Raises:
+            subprocess.CalledProcessError, OSError: The snapshot couldn't be
+                removed.
+        """
+        raise NotImplementedError
+
+
+def run(*args):
+    """Runs a command, returning its (stripped) output."""
+    return subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          check=True).stdout.decode("utf-8").strip()
+
+
+def disk_path(disk):
+    return os.path.realpath(disk.path)
+
+
+def wait_for_path(path, timeout=10):
+    """Waits for a device node to show up (e.g. after udev creates it)."""
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > deadline:
+            raise FileNotFoundError("device '{}' did not appear".format(path))
+        time.sleep(0.1)
+
+
+class LVMThinSnapshot(NativeSnapshot):
+
+    """A snapshot of a logical volume in an LVM thin pool."""
+
+    kind = "LVM thin"
+
+    def __init__(self, disk, vg, lv):
+        super().__init__(disk)
+        self.vg = vg
+        self.lv = lv
+        self.snapshot_lv = lv + "-backup-vm"
+
+    @classmethod
+    def detect(cls, disk):
+        if disk.type != "dev":
+            return None
+        try:
+            vg, lv, segtype = run("lvs", "--noheadings", "--separator", ",",
+                                  "-o", "vg_name,lv_name,segtype", disk.path).split(",")
+        except (subprocess.CalledProcessError, OSError, ValueError):
+            return None
+        return cls(disk, vg, lv) if segtype == "thin" else None
+
+    def create(self):
+        # thin snapshots share the pool, so they don't need a size. they also
+        # skip activation by default, which is left for later
+        run("lvcreate", "--snapshot", "--permission", "r",
+            "--name", self.snapshot_lv, self.vg + "/" + self.lv)
+        self.path = os.path.join("/dev", self.vg, self.snapshot_lv)
+
+    def expose(self):
+        run("lvchange", "--activate", "y", "--ignoreactivationskip", self.vg + "/" + self.snapshot_lv)
+        wait_for_path(self.path)
+
+    def remove(self):
+        run("lvremove", "--yes", self.vg + "/" + self.snapshot_lv)
+
+
+class ZFSSnapshot(NativeSnapshot):
+
+    """A snapshot of a ZFS volume, exposed as a block device with a clone."""
+
+    kind = "ZFS"
+
+    def __init__(self, disk, dataset):
+        super().__init__(disk)
+        self.dataset = dataset
+        self.snapshot = dataset + "@backup-vm"
+        self.clone = dataset + "-backup-vm"
+        self.cloned = False
+
+    @classmethod
+    def detect(cls, disk):
+        if disk.type != "dev":
+            return None
+        realpath = os.path.realpath(disk.path)
+        try:
+            volumes = run("zfs", "list", "-H", "-o", "name", "-t", "volume").split("\n")
+        except (subprocess.CalledProcessError, OSError):
+            return None
+        for volume in volumes:
+            if volume and os.path.realpath(os.path.join("/dev/zvol", volume)) == realpath:
+                return cls(disk, volume)
+        return None
+
+    def create(self):
+        run("zfs", "snapshot", self.snapshot)
+        self.path = os.path.join("/dev/zvol", self.clone)
+
+    def expose(self):
+        run("zfs", "clone", "-o", "readonly=on", self.snapshot, self.clone)
+        self.cloned = True
+        wait_for_path(self.path)
+
+    def remove(self):
+        if self.cloned:
+            run("zfs", "destroy", self.clone)
+            self.cloned = False
+        run("zfs", "destroy", self.snapshot)
+
+
+class ReflinkSnapshot(NativeSnapshot):
+
+    """A reflinked copy of a disk image on a filesystem like btrfs or XFS.
+
+    The copy shares all of its extents with the original, so it takes no time
+    or space to make until the original is written to.
+    """
+
+    kind = "reflink"
+
+    # from linux/fs.h
+    FICLONE = 0x40049409
+
+    # whether each filesystem (by device number) supports reflinks
+    supported = {}
+
+    @classmethod
+    def detect(cls, disk):
+        if disk.type != "file":
+            return None
+        directory = os.path.dirname(disk_path(disk))
+        try:
+            dev = os.stat(directory).st_dev
+        except OSError:
+            return None
+        if dev not in cls.supported:
+            cls.supported[dev] = cls.probe(directory)
+        return cls(disk) if cls.supported[dev] else None
+
+    @classmethod
+    def probe(cls, directory):
+        """Checks if reflinks can be made in a directory by making one.
+
+        There's no cheap way to ask if a filesystem supports reflinks, but
+        finding out when the snapshot is made would waste time while the guest
+        is frozen, so a small test file is cloned beforehand instead.
+        """
+        try:
+            with tempfile.TemporaryFile(dir=directory) as src, tempfile.TemporaryFile(dir=directory) as dst:
+                src.write(bytes(4096))
+                src.flush()
+                fcntl.ioctl(dst.fileno(), cls.FICLONE, src.fileno())
+        except OSError:
+            return False
+        return True
+
+    def create(self):
+        head, tail = os.path.split(disk_path(self.disk))
+        path = os.path.join(head, "." + tail + ".backup-vm")
+        with open(disk_path(self.disk), "rb") as src, open(path, "xb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), self.FICLONE, src.fileno())
+            except OSError:
+                os.remove(path)
+                raise
+        self.path = path
+
+    def remove(self):
+        os.remove(self.path)
+
+
+BACKENDS = [LVMThinSnapshot, ZFSSnapshot, ReflinkSnapshot]
+
+
+def detect(disk):
+    """Finds a kind of storage-level snapshot the storage under a disk supports.
+
+    Args:
+        disk: A Disk to check.
+
+    Returns:
+        An (uncreated) NativeSnapshot of the disk, or None if the disk needs a
+        qcow2 overlay instead.
+    """
+    for backend in BACKENDS:
+        snapshot = backend.detect(disk)
+        if snapshot is not None:
+            return snapshot
+    return None
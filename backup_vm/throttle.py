@@ -0,0 +1,229 @@
+import itertools
+import threading
+import time
+import sys
+import os
+from .lazy import lazy_import
+
+libvirt = lazy_import("libvirt")
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+class Throttle:
+
+    """Limits the rate data is read at, to leave some I/O for the guests.
+
+    Attributes:
+        max_rate: The most bytes per second to ever read at, or None for no
+            limit.
+        rate: The current limit in bytes per second (None for no limit). This
+            is lowered & raised again by a LatencyMonitor.
+    """
+
+    def __init__(self, max_rate=None):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    def wait(self, length):
+        """Sleeps long enough to keep reading length bytes within the limit."""
+        with self.lock:
+            now = time.monotonic()
+            self.window_bytes += length
+            if self.rate is None:
+                self.next_time = now
+                return
+            # don't save up unused time for a burst later
+            start = max(self.next_time, now)
+            self.next_time = start + length / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def measured_rate(self):
+        """Returns the average rate data was read at since the last call."""
+        with self.lock:
+            now = time.monotonic()
+            rate = self.window_bytes / max(now - self.window_start, 0.001)
+            self.window_start = now
+            self.window_bytes = 0
+        return rate
+
+    def pace(self, blocks):
+        """Passes on an iterable of blocks of data at the limited rate."""
+        for block in blocks:
+            self.wait(len(block))
+            yield block
+
+
+class LatencyMonitor(threading.Thread):
+
+    """Slows down a Throttle while the guest's disks are slow to respond.
+
+    Every interval, the average latency of the domain's disk requests (from
+    virDomainBlockStatsFlags) is compared to the lowest seen so far. If it's
+    more than threshold times higher, the backup is competing with the guest,
+    so the throttle's rate is halved; if the guest is idle or its latency is
+    back to normal, the rate is raised again up to its maximum.
+
+    Attributes:
+        dom: The libvirt domain to watch.
+        disks: The Disks of the domain to watch.
+        throttle: The Throttle to adjust.
+    """
+
+    def __init__(self, dom, disks, throttle, interval=2, threshold=2, min_rate=1024 * 1024):
+        super().__init__(daemon=True)
+        self.dom = dom
+        self.disks = disks
+        self.throttle = throttle
+        self.interval = interval
+        self.threshold = threshold
+        self.min_rate = min_rate
+        self.baseline = None
+        self.stopped = threading.Event()
+
+    def totals(self):
+        """Sums up the number & total time (in ns) of all requests so far."""
+        requests = times = 0
+        for disk in self.disks:
+            stats = self.dom.blockStatsFlags(disk.target)
+            for kind in ("rd", "wr", "flush"):
+                requests += stats.get(kind + "_operations", 0)
+                times += stats.get(kind + "_total_times", 0)
+        return requests, times
+
+    def run(self):
+        try:
+            last = self.totals()
+        except libvirt.libvirtError:
+            print("Can't get disk statistics of the domain, not adapting the backup's speed", file=sys.stderr)
+            return
+        while not self.stopped.wait(self.interval):
+            try:
+                current = self.totals()
+            except libvirt.libvirtError:
+                continue
+            requests, times = current[0] - last[0], current[1] - last[1]
+            last = current
+            measured = self.throttle.measured_rate()
+            if requests == 0:
+                latency = None
+            else:
+                latency = times / requests
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+            if latency is not None and latency > self.baseline * self.threshold:
+                self.throttle.rate = max(self.min_rate, min(measured, self.throttle.rate or measured) / 2)
+            elif self.throttle.rate is not None:
+                rate = self.throttle.rate * 1.5
+                if self.throttle.max_rate is not None:
+                    rate = min(rate, self.throttle.max_rate)
+                elif rate > measured * 4:
+                    # nowhere near the limit anymore, so lift it entirely
+                    rate = None
+                self.throttle.rate = rate
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return False
+
+
+class CPULimit:
+
+    """Limits the CPU time borg processes can use together, with cgroup v2.
+
+    A cgroup is created for the duration of the backup with cpu.max set, and
+    each borg process moves itself into it before borg is even started (see
+    preexec()), so anything borg starts (e.g. ssh) is under the limit too.
+
+    Attributes:
+        percent: The share of one CPU core the processes can use (e.g. 150 for
+            one and a half cores).
+        path: The path of the cgroup, or None if it couldn't be created (in
+            which case processes are only niced).
+    """
+
+    # several domains of a batch can each have their own limit
+    ids = itertools.count()
+
+    def __init__(self, percent, period=100000):
+        self.percent = percent
+        self.period = period
+        self.path = None
+        self.procs_path = None
+
+    def __enter__(self):
+        path = os.path.join(CGROUP_ROOT, "backup-vm-{}-{}".format(os.getpid(), next(self.ids)))
+        try:
+            os.mkdir(path)
+        except OSError:
+            print("Can't create a cgroup to limit CPU usage in (is {} cgroup v2?), "
+                  "lowering the priority of borg instead".format(CGROUP_ROOT), file=sys.stderr)
+            return self
+        self.path = path
+        self.procs_path = os.path.join(path, "cgroup.procs")
+        try:
+            with open(os.path.join(path, "cpu.max"), "w") as f:
+                f.write("{} {}".format(self.period * self.percent // 100, self.period))
+        except OSError:
+            print("The cpu controller isn't enabled for {}, lowering the priority of borg instead".format(
+                CGROUP_ROOT), file=sys.stderr)
+            self.cleanup()
+        return self
+
+    def preexec(self):
+        """Puts the calling process under the limit.
+
+        Meant to be the preexec_fn of a borg process, run in the child process
+        right before borg is executed. It sticks to plain system calls, as
+        other threads may have held locks when the process was forked.
+        """
+        if self.path is None:
+            try:
+                os.setpriority(os.PRIO_PROCESS, 0, 19)
+            except OSError:
+                pass
+            return
+        try:
+            fd = os.open(self.procs_path, os.O_WRONLY)
+        except OSError:
+            return
+        try:
+            # (the cgroup moves the process writing 0 to cgroup.procs)
+            os.write(fd, b"0")
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def cleanup(self):
+        if self.path is None:
+            return
+        # a cgroup can only be removed once every process in it has exited
+        for _ in range(50):
+            try:
+                os.rmdir(self.path)
+                break
+            except FileNotFoundError:
+                break
+            except OSError:
+                time.sleep(0.1)
+        else:
+            print("Couldn't remove cgroup '{}'".format(self.path), file=sys.stderr)
+        self.path = None
+
+    def __exit__(self, *args):
+        self.cleanup()
+        return False
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Shows how much of a disk image is left in the page cache by a backup read.
+
+Reads a test file the way backup-vm does (fanout.read_file()), once normally
+and once with --drop-cache, and reports how much of it is in the host's page
+cache (from mincore(2)) before and after each read:
+
+    python3 benchmarks/cache_residency.py [FILE [SIZE_MIB]]
+
+FILE (default: a temporary file in the current directory) is filled with
+SIZE_MIB (default: 512) MiB of random data if it doesn't exist yet. It should
+be on the same kind of storage as the disk images, not on a tmpfs.
+"""
+
+import tempfile
+import ctypes
+import mmap
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup_vm import fanout  # noqa: E402
+
+libc = ctypes.CDLL(None, use_errno=True)
+libc.mmap.restype = ctypes.c_void_p
+libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_long]
+libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+MAP_FAILED = ctypes.c_void_p(-1).value
+
+
+def residency(path):
+    """Returns the fraction of a file's pages that are in the page cache."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0.0
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    with open(path, "rb") as f:
+        addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, f.fileno(), 0)
+        if addr == MAP_FAILED:
+            raise OSError(ctypes.get_errno(), "mmap failed")
+        try:
+            vec = ctypes.create_string_buffer(pages)
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), "mincore failed")
+        finally:
+            libc.munmap(addr, size)
+    return sum(b & 1 for b in vec.raw) / pages
+
+
+def evict(path):
+    """Drops a file's (clean) pages from the page cache."""
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def create(path, size):
+    with open(path, "wb") as f:
+        for _ in range(size // fanout.BLOCK_SIZE):
+            f.write(os.urandom(fanout.BLOCK_SIZE))
+        f.write(os.urandom(size % fanout.BLOCK_SIZE))
+
+
+def measure(path, drop_cache):
+    evict(path)
+    before = residency(path)
+    start = time.monotonic()
+    total = sum(len(block) for block in fanout.read_file(path, drop_cache=drop_cache))
+    elapsed = time.monotonic() - start
+    after = residency(path)
+    print("{:<14} cached before: {:6.1%}  after: {:6.1%}  ({:.0f} MiB/s)".format(
+        "--drop-cache" if drop_cache else "normal read", before, after, total / elapsed / 1024 ** 2))
+
+
+def main():
+    if len(sys.argv) > 3 or sys.argv[1:2] in (["-h"], ["--help"]):
+        print("usage: python3 benchmarks/cache_residency.py [FILE [SIZE_MIB]]", file=sys.stderr)
+        sys.exit(2)
+    size = int(sys.argv[2]) * 1024 ** 2 if len(sys.argv) > 2 else 512 * 1024 ** 2
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+        tmp = None
+    else:
+        tmp = tempfile.NamedTemporaryFile(dir=".", prefix=".cache-residency-", delete=False)
+        tmp.close()
+        path = tmp.name
+    try:
+        if tmp is not None or not os.path.exists(path):
+            create(path, size)
+        print("{} ({} MiB)".format(path, os.path.getsize(path) // 1024 ** 2))
+        measure(path, drop_cache=False)
+        measure(path, drop_cache=True)
+    finally:
+        if tmp is not None:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Measures how fast borg's --log-json output is parsed & at what CPU cost.
+
+Runs multi.assimilate() (the same code that runs borg for backup-vm) with a
+fake borg on the PATH that floods its stderr with --log-json progress
+messages (with the odd log message) at RATE messages per second for SECONDS
+seconds, then prints its --json stats pretty-printed over many lines like
+borg does, from each of PROCESSES processes at once:
+
+    python3 benchmarks/message_rate.py [RATE [SECONDS [PROCESSES]]]
+
+The defaults are 100000 messages/s for 5 s from 1 process. Reported are the
+messages parsed per second (less than wanted if they can't be parsed as fast
+as they're sent, or the fake borgs don't get enough CPU time to send them on
+a machine with few cores), and the CPU time spent in this process (parsing &
+handling the messages) against that spent in the fake borgs.
+"""
+
+import tempfile
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backup_vm import multi  # noqa: E402
+from backup_vm import parse  # noqa: E402
+
+FAKE_BORG = r"""
+import json
+import time
+import sys
+import os
+
+if sys.argv[1:] == ["--version"]:
+    print("borg 1.2.4")
+    sys.exit(0)
+rate = float(os.environ["FAKE_BORG_RATE"])
+seconds = float(os.environ["FAKE_BORG_SECONDS"])
+total = int(os.environ["FAKE_BORG_TOTAL"])
+progress = ('{{"type": "archive_progress", "original_size": {}, "compressed_size": {}, '
+            '"deduplicated_size": 0, "nfiles": 0, "path": "stdin", "time": {}}}\n')
+log = '{{"type": "log_message", "levelname": "DEBUG", "name": "borg.archive", "message": "{}", "time": {}}}\n'
+target = int(seconds * rate)
+sent = 0
+start = time.monotonic()
+now = start
+while sent < target:
+    # catch up to where the rate says we should be, 1 ms at a time (if
+    # writing blocks because the messages aren't read fast enough, this falls
+    # behind & takes longer)
+    due = min(int((now - start) * rate), target)
+    lines = []
+    for i in range(sent, due):
+        if i % 10000 == 9999:
+            lines.append(log.format("message " + str(i), now))
+        else:
+            done = total * i // target
+            lines.append(progress.format(done, done // 2, now))
+    sent = due
+    os.write(2, "".join(lines).encode("utf-8"))
+    time.sleep(0.001)
+    now = time.monotonic()
+stats = {"archive": {"name": "bench", "duration": now - start,
+                     "stats": {"original_size": total, "compressed_size": total // 2,
+                                "deduplicated_size": 0, "nfiles": 1, "messages": sent}}}
+print(json.dumps(stats, indent=4))
+"""
+
+
+def main():
+    if len(sys.argv) > 4 or sys.argv[1:2] in (["-h"], ["--help"]):
+        print("usage: python3 benchmarks/message_rate.py [RATE [SECONDS [PROCESSES]]]", file=sys.stderr)
+        sys.exit(2)
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+    processes = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    total = 10 * 1024 ** 3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        borg = os.path.join(tmp, "borg")
+        with open(borg, "w") as f:
+            f.write("#!" + sys.executable + FAKE_BORG)
+        os.chmod(borg, 0o755)
+        os.environ["PATH"] = tmp + os.pathsep + os.environ.get("PATH", "")
+        os.environ.update(FAKE_BORG_RATE=str(rate), FAKE_BORG_SECONDS=str(seconds), FAKE_BORG_TOTAL=str(total))
+        multi.BORG_VERSION_CACHE = os.path.join(tmp, "borg-version.json")
+        multi.get_borg_version()
+
+        archives = [parse.Location("{}/repo{}::bench".format(tmp, i)) for i in range(processes)]
+        results = {}
+        before = os.times()
+        start = time.monotonic()
+        failed = multi.assimilate(archives, total_size=total, dir_to_archive="-", passphrases={},
+                                  interactive=False, results=results)
+        elapsed = time.monotonic() - start
+        after = os.times()
+
+    if failed:
+        print("the fake borg failed", file=sys.stderr)
+        sys.exit(1)
+    missing = [a.orig for a in archives if "stats" not in results[a]]
+    if missing:
+        # the --json stats were lost (e.g. passed on as text)
+        print("no stats received from", ", ".join(missing), file=sys.stderr)
+        sys.exit(1)
+    sent = sum(results[a]["stats"]["messages"] for a in archives)
+    own_cpu = (after.user - before.user) + (after.system - before.system)
+    borg_cpu = (after.children_user - before.children_user) + (after.children_system - before.children_system)
+    print("messages parsed:  {:>10.0f}/s ({} in {:.1f} s from {} process{}, {:.0f}/s wanted)".format(
+        sent / elapsed, sent, elapsed, processes, "" if processes == 1 else "es", rate * processes))
+    print("parse throughput: {:>10.0f}/s of CPU time".format(sent / own_cpu if own_cpu else float("inf")))
+    print("CPU (this process): {:6.1%} of a core, {:.2f} us/message".format(
+        own_cpu / elapsed, own_cpu / sent * 1e6 if sent else 0))
+    print("CPU (fake borgs):   {:6.1%} of a core".format(borg_cpu / elapsed))
+
+
+if __name__ == "__main__":
+    main()
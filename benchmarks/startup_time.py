@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""Measures the fixed cost of starting backup-vm, borg-multi & friends.
+
+Runs each command (from this checkout) several times and prints the median
+wall time, next to that of an empty Python process for comparison, then
+checks which slow-to-import modules get imported just to print --help:
+
+    python3 benchmarks/startup_time.py [RUNS]
+
+If borg is installed, the time get_borg_version() takes with and without its
+on-disk cache is measured too.
+"""
+
+import statistics
+import subprocess
+import tempfile
+import shutil
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules that only some commands need, & that take a while to import
+SLOW_MODULES = ["asyncio", "concurrent.futures", "distutils", "libvirt"]
+
+RUN_MAIN = "import sys; from backup_vm.{} import main; sys.argv[0] = {!r}; main()"
+
+COMMANDS = [
+    ("python3 -c pass", ["-c", "pass"]),
+    ("backup-vm --help", ["-c", RUN_MAIN.format("backup", "backup-vm"), "--help"]),
+    ("backup-vm --submit", ["-c", RUN_MAIN.format("backup", "backup-vm"), "--submit", "--socket",
+                            "/nonexistent/backup-vm.sock", "vm", "repo::vm"]),
+    ("borg-multi --help", ["-c", RUN_MAIN.format("multi", "borg-multi"), "--help"]),
+    ("backup-vm-daemon --help", ["-c", RUN_MAIN.format("daemon", "backup-vm-daemon"), "--help"]),
+]
+
+IMPORTED = """
+import sys, contextlib, io
+sys.argv = ["backup-vm", "--help"]
+from backup_vm.backup import main
+with contextlib.redirect_stdout(io.StringIO()), contextlib.suppress(SystemExit):
+    main()
+for name in {!r}:
+    module = sys.modules.get(name)
+    # lazily imported modules are only really imported once used
+    if module is not None and type(module).__name__ != "_LazyModule":
+        print(name)
+""".format(SLOW_MODULES)
+
+BORG_VERSION = "import time; from backup_vm import multi; t = time.monotonic(); multi.get_borg_version(); " \
+    "print(time.monotonic() - t)"
+
+
+def environment(**extra):
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([ROOT] + [p for p in [env.get("PYTHONPATH")] if p])
+    env.update(extra)
+    return env
+
+
+def median_time(args, runs, env):
+    times = []
+    for _ in range(runs):
+        start = time.monotonic()
+        subprocess.run([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        times.append(time.monotonic() - start)
+    return statistics.median(times)
+
+
+def main():
+    if len(sys.argv) > 2 or sys.argv[1:2] in (["-h"], ["--help"]):
+        print("usage: python3 benchmarks/startup_time.py [RUNS]", file=sys.stderr)
+        sys.exit(2)
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    env = environment()
+    for name, args in COMMANDS:
+        print("{:<26} {:6.1f} ms".format(name, median_time(args, runs, env) * 1000))
+
+    if shutil.which("borg") is not None:
+        with tempfile.TemporaryDirectory() as cache:
+            env = environment(XDG_CACHE_HOME=cache)
+            for name in ("borg version (uncached)", "borg version (cached)"):
+                out = subprocess.run([sys.executable, "-c", BORG_VERSION], stdout=subprocess.PIPE,
+                                     env=env, check=True).stdout
+                print("{:<26} {:6.1f} ms".format(name, float(out) * 1000))
+
+    imported = subprocess.run([sys.executable, "-c", IMPORTED], stdout=subprocess.PIPE, env=env,
+                              check=True).stdout.decode("utf-8").split()
+    if imported:
+        print("backup-vm --help imports", ", ".join(imported), "(which it shouldn't need)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
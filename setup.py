@@ -91,6 +91,7 @@ setup(name="backup-vm",
           "console_scripts": [
               "backup-vm=backup_vm.backup:main",
               "borg-multi=backup_vm.multi:main",
+              "backup-vm-daemon=backup_vm.daemon:main",
           ],
       },
       cmdclass={"build_usage": build_usage},
@@ -0,0 +1,84 @@
+import unittest
+import asyncio
+import json
+import os
+from backup_vm import engine
+
+STATS = {
+    "archive": {
+        "name": "webserver-2018-01-01-sda",
+        "stats": {
+            "compressed_size": 8.5e8,
+            "deduplicated_size": 1234,
+            "original_size": 10737418240,
+            "nfiles": 1
+        },
+        "comment": "café \"\\\\\" ✓",
+        "limits": {"max_archive_size": 0.0001},
+        "checkpoint": None,
+        "partial": False,
+        "done": True
+    }
+}
+
+
+class TestMessageReader(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        self.messages = []
+        self.text = []
+        self.reader = engine.MessageReader(self.rfd, self.messages.append, self.text.append)
+
+    def tearDown(self):
+        self.reader.stop()
+        os.close(self.rfd)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def feed(self, *chunks, eof=True):
+        for chunk in chunks:
+            os.write(self.wfd, chunk)
+            self.reader.read()
+        if eof:
+            os.close(self.wfd)
+            self.reader.read()
+
+    def test_messages_and_text(self):
+        self.feed(b'{"type": "log_message", "message": "a"}\nSome text\r\n{"type": "x"}{"type": "y"}\n')
+        self.assertEqual(self.messages, [{"type": "log_message", "message": "a"}, {"type": "x"}, {"type": "y"}])
+        self.assertEqual(self.text, ["Some text"])
+
+    def test_split_multiline_object(self):
+        obj = json.dumps(STATS, indent=4, ensure_ascii=False).encode("utf-8")
+        data = b"before\n" + obj + b"\nafter\n"
+        # (a partial line of text is passed on as is, as it may be a prompt)
+        for split in range(len(b"before\n"), len(data) - len(b"after\n")):
+            with self.subTest(split=split):
+                self.tearDown()
+                self.setUp()
+                self.feed(data[:split], data[split:])
+                self.assertEqual(self.messages, [STATS])
+                self.assertEqual(self.text, ["before", "after"])
+
+    def test_text_that_looks_like_json(self):
+        self.feed(b'{not json} at all\n{"type": "x"}\n')
+        self.assertEqual(self.text, ["{not json} at all"])
+        self.assertEqual(self.messages, [{"type": "x"}])
+
+    def test_partial_prompt(self):
+        self.feed(b"Enter passphrase: ", eof=False)
+        self.assertEqual(self.text, ["Enter passphrase: "])
+        os.close(self.wfd)
+
+    def test_truncated_object_at_eof(self):
+        self.feed(b'{"type": "archive_progress", "nfiles": 1')
+        self.assertEqual(self.messages, [])
+        self.assertEqual(self.text, ['{"type": "archive_progress", "nfiles": 1'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+import tempfile
+import os
+from backup_vm import fingerprint
+from backup_vm.builder import Member
+
+
+class FakeDisk:
+    snapshot_stat = None
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.dir.name, "sda.img")
+        with open(self.image, "wb") as f:
+            f.write(os.urandom(3 * 4096))
+        self.member = Member(FakeDisk(), "sda.raw", self.image, 0, 3 * 4096, None)
+        self.index = fingerprint.Index(os.path.join(self.dir.name, "index.json"))
+        self.archives = {"repo": {"vm-2018-01-01-sda"}}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def back_up(self, archive="vm-2018-01-01-sda"):
+        with open(self.image, "rb") as f:
+            for _ in self.index.fingerprint(self.member, [f.read()], block_size=4096):
+                pass
+        self.index.commit({"sda.raw": {"repo": archive}})
+
+    def unchanged(self, repos=("repo",)):
+        return self.index.unchanged(self.member, repos, self.archives.get)
+
+    def test_unchanged(self):
+        self.assertFalse(self.unchanged())
+        self.back_up()
+        self.assertTrue(self.unchanged())
+        # reloaded from disk
+        self.index = fingerprint.Index(self.index.path)
+        self.assertTrue(self.unchanged())
+
+    def test_modified(self):
+        self.back_up()
+        with open(self.image, "r+b") as f:
+            f.write(b"changed")
+        os.utime(self.image, ns=(0, 0))
+        self.assertFalse(self.unchanged())
+
+    def test_other_repository(self):
+        self.back_up()
+        self.archives["other"] = set()
+        self.assertFalse(self.unchanged(("repo", "other")))
+
+    def test_pruned_archive(self):
+        self.back_up()
+        self.archives["repo"] = {"vm-2018-01-02-sda"}
+        self.assertFalse(self.unchanged())
+        # forgotten, so it's backed up again even if the archive comes back
+        self.archives["repo"] = {"vm-2018-01-01-sda"}
+        self.assertFalse(self.unchanged())
+        self.assertNotIn("sda.raw", self.index.entries)
+
+    def test_unlistable_repository(self):
+        self.back_up()
+        self.archives["repo"] = None
+        self.assertFalse(self.unchanged())
+
+    def test_changed_fraction(self):
+        self.back_up()
+        with open(self.image, "r+b") as f:
+            f.seek(4096)
+            f.write(b"changed")
+        with open(self.image, "rb") as f:
+            for _ in self.index.fingerprint(self.member, [f.read()], block_size=4096):
+                pass
+        self.assertAlmostEqual(self.index.changed_fraction("sda.raw"), 1 / 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+import unittest
+import io
+from backup_vm import incremental
+
+CONTEXT = "qemu:dirty-bitmap:backup-sda"
+
+
+class FakeHandle:
+
+    """Stands in for a libnbd handle to a disk with a dirty bitmap.
+
+    Attributes:
+        data: The contents of the disk.
+        bitmap: A list of (length, flags) entries covering the whole disk.
+        max_entries: The most entries to report per block_status() call (like
+            a server that only describes part of the requested range).
+    """
+
+    def __init__(self, data, bitmap, max_entries=None):
+        self.data = data
+        self.bitmap = bitmap
+        self.max_entries = max_entries
+        self.queries = []
+
+    def block_status(self, count, offset, callback):
+        self.queries.append((offset, count))
+        status = []
+        pos = 0
+        for length, flags in self.bitmap:
+            end = pos + length
+            if end > offset and pos < offset + count:
+                status.extend([end - max(pos, offset), flags])
+            pos = end
+        if self.max_entries is not None:
+            status = status[:2 * self.max_entries]
+        # other contexts are reported too, and have to be ignored
+        callback("base:allocation", offset, [count, 0], 0)
+        callback(CONTEXT, offset, status, 0)
+
+    def pread(self, count, offset):
+        return self.data[offset:offset + count]
+
+
+class TestDirtyExtents(unittest.TestCase):
+
+    def test_merges_adjacent_extents(self):
+        handle = FakeHandle(bytes(100), [(10, 0), (5, 1), (5, 1), (30, 0), (50, 1)])
+        self.assertEqual(incremental.dirty_extents(handle, CONTEXT, 100), [(10, 10), (50, 50)])
+
+    def test_queries_in_steps(self):
+        handle = FakeHandle(bytes(100), [(20, 1), (60, 0), (20, 1)])
+        extents = incremental.dirty_extents(handle, CONTEXT, 100, step=30)
+        self.assertEqual(extents, [(0, 20), (80, 20)])
+        self.assertTrue(all(count <= 30 for _, count in handle.queries))
+
+    def test_partial_replies(self):
+        handle = FakeHandle(bytes(100), [(10, 1), (10, 0), (10, 1), (70, 0)], max_entries=1)
+        self.assertEqual(incremental.dirty_extents(handle, CONTEXT, 100), [(0, 10), (20, 10)])
+
+    def test_clean_disk(self):
+        handle = FakeHandle(bytes(100), [(100, 0)])
+        self.assertEqual(incremental.dirty_extents(handle, CONTEXT, 100), [])
+
+    def test_missing_bitmap(self):
+        handle = FakeHandle(bytes(100), [])
+        with self.assertRaises(ValueError):
+            incremental.dirty_extents(handle, CONTEXT, 100)
+
+
+class TestApplyDelta(unittest.TestCase):
+
+    def make_delta(self, new, bitmap, block_size=7):
+        handle = FakeHandle(new, bitmap)
+        extents = incremental.dirty_extents(handle, CONTEXT, len(new))
+        header = incremental.delta_header(len(new), extents, "backup-vm-1", "backup-vm-2")
+        return b"".join(incremental.delta_blocks(handle, header, extents, block_size))
+
+    def test_round_trip(self):
+        old = bytes(range(64))
+        new = bytearray(old)
+        new[8:16] = b"x" * 8
+        new[40:48] = b"y" * 8
+        delta = self.make_delta(bytes(new), [(8, 0), (8, 1), (24, 0), (8, 1), (16, 0)])
+        image = io.BytesIO(old)
+        header = incremental.apply_delta(io.BytesIO(delta), image)
+        self.assertEqual(image.getvalue(), bytes(new))
+        self.assertEqual(header["parent"], "backup-vm-1")
+        self.assertEqual(header["checkpoint"], "backup-vm-2")
+
+    def test_resized_disk(self):
+        new = bytes(32) + b"z" * 32
+        delta = self.make_delta(new, [(32, 0), (32, 1)])
+        image = io.BytesIO(bytes(32))
+        incremental.apply_delta(io.BytesIO(delta), image)
+        self.assertEqual(image.getvalue(), new)
+
+    def test_truncated(self):
+        delta = self.make_delta(b"a" * 64, [(64, 1)])
+        with self.assertRaises(ValueError):
+            incremental.apply_delta(io.BytesIO(delta[:-1]), io.BytesIO(bytes(64)))
+
+    def test_not_a_delta(self):
+        with self.assertRaises(ValueError):
+            incremental.apply_delta(io.BytesIO(b'{"format": "something-else"}\n'), io.BytesIO())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from backup_vm import pull
+
+
+class FakeHandle:
+
+    """Stands in for a libnbd handle to an export of a given size.
+
+    Like a real NBD server, it refuses reads past the end of the export.
+
+    Attributes:
+        data: The contents of the export.
+        reads: The (offset, count) of every pread() so far.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def pread(self, count, offset):
+        self.reads.append((offset, count))
+        if offset + count > len(self.data):
+            raise OSError(22, "Invalid argument")
+        return self.data[offset:offset + count]
+
+
+class TestReadBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.handle = FakeHandle(bytes(range(256)) * 4)
+
+    def read(self, extents, block_size):
+        return list(pull.read_blocks(self.handle, extents, block_size))
+
+    def test_blocks(self):
+        blocks = self.read([(0, 1024)], 300)
+        self.assertEqual([len(b) for b in blocks], [300, 300, 300, 124])
+        self.assertEqual(b"".join(blocks), self.handle.data)
+
+    def test_coalesces_adjacent_extents(self):
+        extents = [(0, 10), (10, 20), (30, 0), (30, 70), (200, 50), (250, 50)]
+        blocks = self.read(extents, 64)
+        self.assertEqual(self.handle.reads, [(0, 64), (64, 36), (200, 64), (264, 36)])
+        self.assertEqual(b"".join(blocks), b"".join(self.handle.data[o:o + n] for o, n in extents))
+
+    def test_keeps_order(self):
+        # extents out of order (or overlapping) are read as given, not merged
+        extents = [(100, 10), (0, 10), (5, 10)]
+        self.assertEqual(self.read(extents, 64), [self.handle.data[o:o + n] for o, n in extents])
+
+    def test_reads_up_to_end(self):
+        # the last block is cut short at the end of the export
+        blocks = self.read([(1000, 24)], 64)
+        self.assertEqual(blocks, [self.handle.data[1000:]])
+        self.assertEqual(self.handle.reads, [(1000, 24)])
+
+    def test_past_end(self):
+        blocks = pull.read_blocks(self.handle, [(960, 128)], 64)
+        self.assertEqual(next(blocks), self.handle.data[960:])
+        with self.assertRaises(OSError):
+            next(blocks)
+
+    def test_nothing(self):
+        self.assertEqual(self.read([], 64), [])
+        self.assertEqual(self.read([(0, 0)], 64), [])
+        self.assertEqual(self.handle.reads, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import tempfile
+import errno
+import os
+from unittest import mock
+from backup_vm import storage
+
+# logs its arguments, and prints the output (or exits with the status) set
+# for the command in the environment
+FAKE_COMMAND = """#!/bin/sh
+echo "$(basename "$0") $*" >> "$FAKE_LOG"
+name=$(basename "$0" | tr a-z A-Z)
+eval "out=\\$FAKE_${name}_OUTPUT status=\\${FAKE_${name}_STATUS:-0}"
+printf '%s\\n' "$out"
+exit "$status"
+"""
+
+
+class FakeDisk:
+
+    def __init__(self, type, path, target="sda"):
+        self.type = type
+        self.path = path
+        self.target = target
+
+
+class TestStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        bin_dir = os.path.join(self.dir.name, "bin")
+        os.mkdir(bin_dir)
+        for name in ("lvs", "lvcreate", "lvchange", "lvremove", "zfs"):
+            path = os.path.join(bin_dir, name)
+            with open(path, "w") as f:
+                f.write(FAKE_COMMAND)
+            os.chmod(path, 0o755)
+        self.log = os.path.join(self.dir.name, "log")
+        env = {"PATH": bin_dir + os.pathsep + os.environ["PATH"], "FAKE_LOG": self.log,
+               "FAKE_LVS_STATUS": "5", "FAKE_ZFS_OUTPUT": ""}
+        patcher = mock.patch.dict(os.environ, env)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        storage.ReflinkSnapshot.supported.clear()
+
+    def tearDown(self):
+        storage.ReflinkSnapshot.supported.clear()
+        self.dir.cleanup()
+
+    def commands(self):
+        try:
+            with open(self.log) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return []
+
+    def test_lvm_thin(self):
+        os.environ.update(FAKE_LVS_OUTPUT="  vg0,vm1,thin", FAKE_LVS_STATUS="0")
+        snapshot = storage.detect(FakeDisk("dev", "/dev/vg0/vm1"))
+        self.assertIsInstance(snapshot, storage.LVMThinSnapshot)
+        self.assertEqual((snapshot.vg, snapshot.lv), ("vg0", "vm1"))
+        snapshot.create()
+        self.assertEqual(snapshot.path, "/dev/vg0/vm1-backup-vm")
+        snapshot.remove()
+        self.assertEqual(self.commands()[1:], [
+            "lvcreate --snapshot --permission r --name vm1-backup-vm vg0/vm1",
+            "lvremove --yes vg0/vm1-backup-vm",
+        ])
+
+    def test_lvm_not_thin(self):
+        os.environ.update(FAKE_LVS_OUTPUT="  vg0,vm1,linear", FAKE_LVS_STATUS="0")
+        self.assertIsNone(storage.detect(FakeDisk("dev", "/dev/vg0/vm1")))
+
+    def test_zfs(self):
+        os.environ.update(FAKE_ZFS_OUTPUT="tank/other\ntank/vm1")
+        snapshot = storage.detect(FakeDisk("dev", "/dev/zvol/tank/vm1"))
+        self.assertIsInstance(snapshot, storage.ZFSSnapshot)
+        snapshot.create()
+        self.assertEqual(snapshot.path, "/dev/zvol/tank/vm1-backup-vm")
+        # never exposed, so there is no clone to destroy
+        snapshot.remove()
+        self.assertEqual(self.commands()[-2:], ["zfs snapshot tank/vm1@backup-vm", "zfs destroy tank/vm1@backup-vm"])
+
+    def test_plain_block_device(self):
+        self.assertIsNone(storage.detect(FakeDisk("dev", "/dev/sdb")))
+        self.assertEqual([c.split()[0] for c in self.commands()], ["lvs", "zfs"])
+
+    def test_reflink_unsupported(self):
+        image = os.path.join(self.dir.name, "vm1.img")
+        error = OSError(errno.EOPNOTSUPP, "Operation not supported")
+        with mock.patch("fcntl.ioctl", side_effect=error) as ioctl:
+            self.assertIsNone(storage.detect(FakeDisk("file", image)))
+            self.assertIsNone(storage.detect(FakeDisk("file", image, "sdb")))
+        # only probed once per filesystem
+        self.assertEqual(ioctl.call_count, 1)
+        # & never by asking LVM or ZFS
+        self.assertEqual(self.commands(), [])
+
+    def test_reflink_supported(self):
+        image = os.path.join(self.dir.name, "vm1.img")
+        with open(image, "wb") as f:
+            f.write(b"data")
+        with mock.patch("fcntl.ioctl", return_value=0) as ioctl:
+            snapshot = storage.detect(FakeDisk("file", image))
+            self.assertIsInstance(snapshot, storage.ReflinkSnapshot)
+            snapshot.create()
+        self.assertEqual(ioctl.call_count, 2)
+        self.assertEqual(snapshot.path, os.path.join(self.dir.name, ".vm1.img.backup-vm"))
+        snapshot.remove()
+        self.assertFalse(os.path.exists(snapshot.path))
+
+
+if __name__ == "__main__":
+    unittest.main()